@@ -13,7 +13,7 @@ Overview:      This script uses Selenium to remotely access weather information
 How to use:    TBC
 Requirements:  - A webdriver which for Chrome can be accessed here: http://chromedriver.chromium.org/downloads
                - A niwa Cliflo account which can be sourced from https://cliflo.niwa.co.nz/
-TODO:          - Add method that allows for automatic reset of rows if login falls below 10,000.
+TODO:          NA
 """
 
 ############
@@ -24,16 +24,31 @@ from selenium                   import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException
 from collections                import defaultdict
-from sqlalchemy                 import create_engine
-from sqlalchemy                 import Table, Column, String, MetaData, select, update
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm             import sessionmaker
+from sqlalchemy                 import Table, Column, String, MetaData, select, update, text
+from sqlalchemy                 import Integer, SmallInteger, Float, Date, Index, Computed, inspect
+from sqlalchemy.orm             import sessionmaker, scoped_session
+import datetime
+import io
 import os
 import re
 import time
+import queue
+import threading
 import pandas as pd
 import numpy as np
+import Cliflo_HTTP as CH
+import Cliflo_Manifest as CM
+import Cliflo_Cache as CC
+import Cliflo_Store as CS
+import Cliflo_Parser as CP
+import Cliflo_Gaps as CG
+import Cliflo_Status as CST
+import Cliflo_Metrics as CMT
+import Cliflo_Quota as CQ
+import Cliflo_Catalogue as CCT
+import Db_Registry as DB
 
 ###########
 # CLASSES #
@@ -48,6 +63,9 @@ class Cliflo:
                                        data sets that can be acced from each key. These are the same strings as in
                                        Cliflo.
 
+                     - wait_log: seconds spent waiting on each page step (login, station_search etc.) as
+                                 {step: [seconds, ...]}. Filled in by cf_wait, see wait_summary.
+
                      - station_clean_dict: A python dictionary in the form:
                                            {keyword: [{column name: new column name},[list of columns to keep]]}
                                            where column name is the colum name in Cliflo, and list of columns to keep
@@ -74,12 +92,20 @@ class Cliflo:
                           'evaporation': [{'Amount(mm)': 'amount_mm', 'Station': 'station'},
                                           ['amount_mm']]}
 
+    # most rows a station can have in a year for each frequency, used to size range queries
+    freq_rows_dict = {'daily': 366, 'hourly': 8784, 'monthly': 12}
+
+    wait_log = defaultdict(list)
+
     def __init__(self, **kwargs):
         """Initalises the Class and establishes the database. Option to not set up a database with kwarg input
         connect_db = False however if you want to execute the key methods to a database this need toe be True.
 
         :param kwargs:
             - connect_db: Default is set to true. Otherwise all other kwargs are self explanatory.
+            - transport: 'selenium' (default) drives a Chrome browser. 'http' posts the Cliflo forms directly with
+                         a cookie holding HTTP session (see Cliflo_HTTP), no browser needed.
+            - website: Cliflo url. Change to point the class at a local stand in server.
             - See below for rest. All kwargs are set up to establish the username, password, and database.
         """
 
@@ -93,11 +119,30 @@ class Cliflo:
         self.db_user_pw = kwargs.get('db_user_password', os.environ.get('CLIFLO_USER'))
         self.host = kwargs.get('host', "127.0.0.1")
         self.port = kwargs.get('port', '5432')
-        self.diver = kwargs.get('driver', 'psycopg2')
+        self.driver = kwargs.get('driver', 'psycopg2')
         self.db_type = kwargs.get('db_type', 'postgresql')
         self.station_info_table_name = kwargs.get('stations_table_name', 'station_info_test_v2')
-
-        self.cf_website = 'https://cliflo.niwa.co.nz/'
+        self.transport = kwargs.get('transport', 'selenium')
+        self.http_timeout = kwargs.get('http_timeout', 360)
+
+        self.cf_website = kwargs.get('website', 'https://cliflo.niwa.co.nz/')
+        # stops worker threads racing each other to create the same table
+        self.table_lock = threading.Lock()
+        # checkpoint of update_data jobs, set by update_data (see Cliflo_Manifest)
+        self.manifest = None
+        # compressed store of raw downloads used instead of loose csv files, set by update_data (see Cliflo_Cache)
+        self.cache = None
+        # parquet observation store, set by update_data when sink='parquet' (see Cliflo_Store)
+        self.store = None
+        # how station_obs tables are parsed, set by update_data ('read_html' or 'stream', see Cliflo_Parser)
+        self.parser = 'read_html'
+        # long format status table of every station year, set by update_data (see Cliflo_Status)
+        self.status = None
+        # rows left on the Cliflo account and when to log in again to refresh them (see Cliflo_Quota)
+        self.quota = CQ.RowQuota()
+        # jobs reaching each state (and their rows) since the object was made, see manifest_state
+        self.job_counts = defaultdict(int)
+        self.count_lock = threading.Lock()
 
         if self.connect_db:
             # Set up string to use for database connection.
@@ -109,13 +154,12 @@ class Cliflo:
                                                          self.port,
                                                          self.db_name)
 
-            # Connecting to database
-            self.engine = create_engine(self.db_string, pool_size=50, max_overflow=0)
-            Session = sessionmaker(bind=self.engine)
-            self.session = Session()
-            self.Base = declarative_base()
-            # Look up the existing tables from database
-            self.Base.metadata.reflect(self.engine)
+            # Connecting to database, the engine is shared with every other object using the same database
+            self.engine = DB.get_engine(self.db_string)
+            # scoped session so each worker thread in update_data gets its own session
+            self.session = scoped_session(sessionmaker(bind=self.engine))
+            # tables are looked up from the database when first used (see Cliflo.table_class)
+            self.Base = DB.get_base(self.db_string)
             self.station_df = pd.DataFrame(columns=['stations'])
 
     def extract_stations(self, **kwargs):
@@ -135,6 +179,13 @@ class Cliflo:
             - use_file: if you already have a file containing the stations you want use that instead of
                         generating a list again. Must be in same format as was downloaded from Cliflo.
             - to_excel: if set to True, send dataframe of results to excel. Default set to True.
+            - catalogue: folder (or Cliflo_Catalogue.StationCatalogue) to keep the station list in. The station
+                         search is only run when the saved list is older than its ttl_hours, and then only the
+                         stations that were added or changed are updated in the database. Default is False (search
+                         every time).
+            - refresh_catalogue: run the station search even if the saved list is fresh. Default is False.
+            - status_table: same as update_data. Stations whose details changed have their empty years forgotten
+                            so update_data checks them again.
 
         :return: a dataframe of the stations
         """
@@ -148,26 +199,72 @@ class Cliflo:
         table_name = kwargs.get('station_table_name',  'NA')
         use_file = kwargs.get('use_file', False)
         create_excl_file = kwargs.get('to_excel', True)
+        catalogue = kwargs.get('catalogue', False)
+        # None means every station is treated as changed, as when there is no catalogue
+        changes = None
 
         if use_file:
             df_clean = pd.read_excel(use_file)
         else:
             # Get all stations for a given data_type
-            df = Cliflo.cf_get_stations(self, data_type)
+            if catalogue:
+                catalogue = CCT.StationCatalogue(catalogue) if type(catalogue) is str else catalogue
+                df, changes = catalogue.get(data_type, lambda data_type: Cliflo.cf_get_stations(self, data_type),
+                                            refresh=kwargs.get('refresh_catalogue', False))
+                # a saved list that is still fresh has no changes
+                changes = changes or {'added': [], 'removed': [], 'changed': {}}
+            else:
+                df = Cliflo.cf_get_stations(self, data_type)
             # filter out stations using kwargs then send to excel.
-            df_clean = Cliflo.clean_stations(df, start_year, end_year, min_perc_complete)
+            df_clean = Cliflo.clean_stations(df.copy(), start_year, end_year, min_perc_complete)
             if create_excl_file:
-                df_clean.to_excel(destination_folder + '\\' + file_name + '.xlsx')
+                df_clean.to_excel(os.path.join(destination_folder, file_name + '.xlsx'))
 
         if self.connect_db:
             # If there is no stations table, create one, then update the latidute and longitued of each station in the
             # table
-            if not self.engine.dialect.has_table(self.engine, table_name):
+            if not Cliflo.has_table(self, table_name):
                 Cliflo.create_stations_table(self, df_clean, start_year, end_year, data_type, table_name)
-            Cliflo.update_lat_long(self, df_clean, table_name)
+                changes = None
+            if changes is None:
+                Cliflo.update_lat_long(self, df_clean, table_name)
+            else:
+                Cliflo.update_changed_stations(self, df_clean, changes, data_type, table_name,
+                                               kwargs.get('status_table', 'cliflo_status'))
 
         return df_clean
 
+    def update_changed_stations(self, df_clean, changes, data_type, table_name, status_table):
+        """
+        Stations table and status work for only the stations a catalogue refresh found added or changed (see
+        Cliflo_Catalogue.StationCatalogue.compare): new stations get a row in the stations table, both get their lat
+        / long set, and changed stations have their empty years forgotten in the status table so update_data
+        queries them again (e.g a station with a later End Date may have data for years that came back empty).
+        """
+        stations = set(changes['added']) | set(changes['changed'])
+        df_changed = df_clean[df_clean['AgentNumber'].astype(str).isin(stations)]
+        # stations filtered out by clean_stations are left alone
+        kept = set(df_changed['AgentNumber'].astype(str))
+        if df_changed.empty:
+            print('no station changes to update')
+            return
+
+        # stations is an integer in typed tables and text in tables made before them
+        typed = isinstance(Cliflo.table_class(self, table_name).__table__.columns['stations'].type, Integer)
+        with self.engine.begin() as conn:
+            result = conn.execute(text('INSERT INTO %s (stations) SELECT CAST(v.stations AS %s) '
+                                       'FROM unnest(CAST(:stations AS text[])) AS v (stations) '
+                                       'WHERE NOT EXISTS (SELECT 1 FROM %s t WHERE CAST(t.stations AS text) = '
+                                       'v.stations)' % (table_name, 'integer' if typed else 'text', table_name)),
+                                  {'stations': sorted(kept)})
+        print(str(result.rowcount) + ' new stations added to ' + table_name)
+        Cliflo.update_lat_long(self, df_changed, table_name)
+
+        Cliflo.open_status(self, status_table)
+        changed = [station for station in changes['changed'] if station in kept]
+        if self.status is not None and changed:
+            print(str(self.status.forget(data_type, changed, 'empty')) + ' empty station years to check again')
+
     def update_data(self, **kwargs):
         """given a list of stations this method uses selenium to then access the weather data for each year and data
         type specified. THis is th main function of the clifo class.
@@ -185,7 +282,36 @@ class Cliflo:
             - use_existing_data: Only add new data if exixing data is not already downloaded.
             - csv_only: If True, only retun data as a CSV and do not bother with the database component.
                         Default is False.
+            - sink: where cleaned observations go. 'db' (default) the database table, 'csv' same as csv_only=True,
+                    'parquet' a parquet store partitioned by data_type / station / year (see Cliflo_Store).
+            - parquet_folder: folder (or Cliflo_Store.ParquetStore) for the parquet sink. Default is a parquet
+                              folder in to_folder.
             - station_table_name: name of table to store data is csv_only is set to False.
+            - workers: number of browser sessions to run at once. Each worker logs in separately and pulls
+                       (station, year) jobs from a shared queue. Default is 1 (single session, run in order).
+            - range_mode: If True, consecutive missing years for a station are fetched with one query and split into
+                          the usual per year csv files. Default is False (one query per year).
+            - row_limit: most rows Cliflo will return for one query. Range queries are kept under this. Default is
+                         40,000.
+            - station_batch_size: number of stations to select on Cliflo at once. Their data comes back in one
+                                  table that is split back into stations using the Station column. Default is 1.
+            - manifest: sqlite file (or Cliflo_Manifest.Manifest) to record the state of every station year in. On a
+                        restart the remaining jobs are read from it rather than working them out again. Default is
+                        False (no manifest).
+            - cache: folder (or Cliflo_Cache.RawCache) to keep raw downloads in, compressed, instead of one csv
+                     file per station year in to_folder. Default is False (csv files).
+            - status_table: name of the long format status table (or a Cliflo_Status.StatusTable) to record each
+                            station year in. Default is cliflo_status. False records it in the data_type_year
+                            columns of station_table_name as before.
+            - parser: 'read_html' (default) parses results with pd.read_html. 'stream' uses Cliflo_Parser which
+                      only keeps the station_clean_dict columns and reads the values as numbers. Raw downloads are
+                      then stored without the header rows, both layouts can be read back.
+            - metrics: folder to write stage timings, rows / min, jobs / min and the ETA to, as json lines and a
+                       Prometheus text file (see Cliflo_Metrics). Default is False (kept in memory only).
+            - refresh_below: log in again, which refreshes the row allowance, before a query would leave fewer rows
+                             than this (see cf_query). Default is 10,000.
+            - prioritise: download the most valuable station years first, holes in the years a station already has
+                          before anything else (see Cliflo_Quota.prioritise). Default is True.
 
         :return:
         """
@@ -201,6 +327,20 @@ class Cliflo:
         use_existing_data = kwargs.get('use_existing_data', True)
         csv_only = kwargs.get('csv_only', False)
         station_table_name = kwargs.get('station_table_name', 'NA')
+        workers = kwargs.get('workers', 1)
+        range_mode = kwargs.get('range_mode', False)
+        row_limit = kwargs.get('row_limit', 40000)
+        station_batch_size = kwargs.get('station_batch_size', 1)
+        manifest = kwargs.get('manifest', False)
+        cache = kwargs.get('cache', False)
+        sink = kwargs.get('sink', 'csv' if csv_only else 'db')
+        parquet_folder = kwargs.get('parquet_folder', os.path.join(destination_folder, 'parquet'))
+        self.parser = kwargs.get('parser', 'read_html')
+        Cliflo.open_status(self, kwargs.get('status_table', 'cliflo_status'))
+        Cliflo.open_metrics(self, kwargs.get('metrics', False))
+        self.quota.refresh_below = kwargs.get('refresh_below', 10000)
+        self.quota.prioritise = kwargs.get('prioritise', True)
+        max_years = Cliflo.max_query_years(data_freq, row_limit) if range_mode else 1
 
        # Get list of staions to query.
         if type(station_info) is str:
@@ -209,32 +349,419 @@ class Cliflo:
             stations = station_info
         #list of stations to search on Cliflo
         station_list = stations['AgentNumber']
+
+        if manifest:
+            self.manifest = CM.Manifest(manifest) if type(manifest) is str else manifest
+        if cache:
+            self.cache = CC.RawCache(cache) if type(cache) is str else cache
+        # the csv and parquet sinks both skip the database, the parquet one also writes to the store
+        csv_only = sink != 'db'
+        if sink == 'parquet':
+            self.store = CS.ParquetStore(parquet_folder) if type(parquet_folder) is str else parquet_folder
+
+        if Cliflo.has_table(self, table_name):
+            Table = Cliflo.table_class(self, table_name)
+        else:
+            Table = False
+
+        print(Table)
+        TableX = Cliflo.table_class(self, station_table_name) if self.status is None else None
+
+        if workers > 1:
+            Cliflo.run_worker_pool(self, workers, station_list, start_year, end_year, data_type, data_freq,
+                                   table_name, destination_folder, use_existing_data, csv_only, Table, TableX,
+                                   max_years, station_batch_size)
+            print(Cliflo.wait_summary())
+            Cliflo.metrics_report()
+            Cliflo.quota_report(self)
+            Cliflo.manifest_report(self, data_type)
+            Cliflo.flush_status(self)
+            return
+
         # Connect to NIWA and select the type of data we want.
         driver, main_window_handle = Cliflo.cf_login(self)
         driver, main_window_handle = Cliflo.cf_specify_data(data_type, driver, main_window_handle)
 
-        if self.engine.dialect.has_table(self.engine, table_name):
-            Table = type('Station_Obs_Class', (self.Base,),  {'__tablename__': table_name})
+        current_stations = None
+        # if table exists, get years not in table for each station
+        try:
+            for station_ids, years, year_lists in Cliflo.batch_jobs(self, station_list, station_batch_size,
+                                                                    max_years, table_name, start_year, end_year,
+                                                                    csv_only, use_existing_data, Table, TableX,
+                                                                    data_type):
+                Cliflo.run_batch_update(self, driver, station_ids, years, year_lists, data_type, data_freq,
+                                        table_name, destination_folder, main_window_handle, use_existing_data,
+                                        csv_only, TableX, select_station=station_ids != current_stations)
+                current_stations = station_ids
+        except CQ.QuotaError as e:
+            # the rest of the jobs are still missing so the next run picks them up
+            print('stopping update: ' + str(e))
+            self.session.rollback()
+
+        driver.quit()
+        print(Cliflo.wait_summary())
+        Cliflo.metrics_report()
+        Cliflo.quota_report(self)
+        Cliflo.manifest_report(self, data_type)
+        Cliflo.flush_status(self)
+
+    def run_worker_pool(self, workers, station_list, start_year, end_year, data_type, data_freq, table_name,
+                        destination_folder, use_existing_data, csv_only, Table, TableX, max_years=1,
+                        station_batch_size=1):
+        """
+        Runs update_data with several browser sessions at once. The years still needed for every station are worked
+        out first (in this thread), then each (stations, years) job is put on a shared queue that the workers pull
+        from until it is empty. Every worker writes to the same folder and tables as the single session update.
+
+        :param workers: number of browser sessions (threads) to start.
+        :param max_years: most years in one job (see range_mode in update_data). Default is 1.
+        :param station_batch_size: most stations in one job (see update_data). Default is 1.
+        :return: number of jobs that failed.
+        """
+        jobs = queue.Queue()
+        [jobs.put(job) for job in Cliflo.batch_jobs(self, station_list, station_batch_size, max_years, table_name,
+                                                    start_year, end_year, csv_only, use_existing_data, Table,
+                                                    TableX, data_type)]
+
+        print(str(jobs.qsize()) + ' jobs queued for ' + str(workers) + ' workers')
+        failed = []
+        errors = []
+        threads = [threading.Thread(target=Cliflo.cf_worker,
+                                    args=(self, jobs, failed, data_type, data_freq, table_name, destination_folder,
+                                          use_existing_data, csv_only, TableX, errors),
+                                    name='cliflo_worker_' + str(n))
+                   for n in range(min(workers, max(jobs.qsize(), 1)))]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        # jobs no worker got to, e.g every worker failed to log in
+        while True:
+            try:
+                station_ids, years, year_lists = jobs.get_nowait()
+            except queue.Empty:
+                break
+            failed.append((station_ids, years))
+
+        if errors:
+            print(str(len(errors)) + ' of ' + str(len(threads)) + ' workers stopped early: ' + str(errors))
+        if failed:
+            print(str(len(failed)) + ' jobs failed and will be picked up on the next run: ' + str(failed))
+        with self.count_lock:
+            self.job_counts['failed'] += len(failed)
+            self.job_counts['worker_errors'] += len(errors)
+        return len(failed)
+
+    def cf_worker(self, jobs, failed, data_type, data_freq, table_name, destination_folder, use_existing_data,
+                  csv_only, TableX, errors=None):
+        """
+        A single worker in the pool. Logs in and selects the data type once, then takes (stations, years) jobs off
+        the queue until it is empty. The stations are only re-selected on Cliflo when they change between jobs.
+
+        :param errors: list the worker adds (worker name, error) to if it can not log in. Its jobs stay on the queue
+                       for the other workers (see run_worker_pool).
+        """
+        driver = None
+        try:
+            driver, main_window_handle = Cliflo.cf_login(self)
+            driver, main_window_handle = Cliflo.cf_specify_data(data_type, driver, main_window_handle)
+        except Exception as e:
+            print(threading.current_thread().name + ' could not log in: ' + repr(e))
+            if errors is not None:
+                errors.append((threading.current_thread().name, repr(e)))
+            if driver is not None:
+                driver.quit()
+            self.session.remove()
+            return
+        current_stations = None
+
+        try:
+            while True:
+                try:
+                    station_ids, years, year_lists = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    Cliflo.run_batch_update(self, driver, station_ids, years, year_lists, data_type, data_freq,
+                                            table_name, destination_folder, main_window_handle, use_existing_data,
+                                            csv_only, TableX, select_station=station_ids != current_stations)
+                    current_stations = station_ids
+                except CQ.QuotaError as e:
+                    # no rows left for any worker, the job is left for the next run
+                    print(threading.current_thread().name + ' stopping: ' + str(e))
+                    failed.append((station_ids, years))
+                    if errors is not None:
+                        errors.append((threading.current_thread().name, repr(e)))
+                    self.session.rollback()
+                    break
+                except Exception as e:
+                    # page state is unknown after an error so make sure the next job selects its stations again
+                    print(threading.current_thread().name + ' failed on stations ' + str(station_ids) + ', years '
+                          + str(years) + ': ' + str(e))
+                    failed.append((station_ids, years))
+                    current_stations = None
+                    self.session.rollback()
+                finally:
+                    jobs.task_done()
+        finally:
+            driver.quit()
+            self.session.remove()
+
+    def queue_jobs(self, job_queue, **kwargs):
+        """
+        Adds a job to the job table for every station and year that update_data would download. Jobs already in the
+        table are left as they are, so every host can run this before run_job_queue.
+
+        :param job_queue: Cliflo_Jobs.JobQueue to add the jobs to.
+        :param kwargs: stations, data_type, start_year, end_year, table_name, use_existing_data, csv_only,
+                       station_table_name and status_table are the same as update_data.
+        :return: number of jobs offered to the job table.
+        """
+        station_info = kwargs.get('stations', 'NA')
+        data_type = kwargs.get('data_type', 'rainfall')
+        start_year = kwargs.get('start_year', 1988)
+        end_year = kwargs.get('end_year', 2018)
+        table_name = kwargs.get('table_name', 'niwa_rainfall')
+        use_existing_data = kwargs.get('use_existing_data', True)
+        csv_only = kwargs.get('csv_only', False)
+        station_table_name = kwargs.get('station_table_name', 'NA')
+        Cliflo.open_status(self, kwargs.get('status_table', 'cliflo_status'))
+
+        if type(station_info) is str:
+            stations = pd.read_excel(station_info)
+        else:
+            stations = station_info
+
+        if Cliflo.has_table(self, table_name):
+            Table = Cliflo.table_class(self, table_name)
         else:
             Table = False
+        TableX = Cliflo.table_class(self, station_table_name) if self.status is None else None
 
-        print(Table)
-        TableX = type('Table_X_classname', (self.Base,), {'__tablename__': station_table_name})
+        queued = 0
+        year_lists = Cliflo.plan_years(self, stations['AgentNumber'], table_name, start_year, end_year, csv_only,
+                                       use_existing_data, TableX, data_type)
+        for station_id, year_list in year_lists.items():
+            queued += job_queue.add_jobs(data_type, [station_id], year_list)
 
-        for station_id in station_list:
-            # if table exists, get years not in table for given station
-            year_list = Cliflo.create_year_list(self, table_name, station_id, start_year, end_year, csv_only,
-                                                use_existing_data, Table, TableX)
+        print(str(queued) + ' jobs offered to ' + job_queue.table_name)
+        return queued
 
-            [Cliflo.run_data_update(self, driver, station_id, year, data_type, data_freq, table_name,
-                                    destination_folder, main_window_handle, use_existing_data, csv_only, TableX,
-                                    year_list)
-             for year in year_list if year_list]
+    def run_job_queue(self, job_queue, **kwargs):
+        """
+        Same as update_data but instead of working through a station list, (station, year) jobs are claimed from a
+        shared job table (see Cliflo_Jobs.JobQueue). Any number of processes on any number of machines can run this
+        against the same job table without downloading the same data twice.
+
+        :param job_queue: Cliflo_Jobs.JobQueue that jobs are claimed from.
+        :param kwargs: to_folder, data_type, freq, table_name, use_existing_data, csv_only and station_table_name are
+                       the same as update_data.
+            - batch_size: number of jobs to claim at a time. Default is 10.
+            - range_mode & row_limit: same as update_data. Claimed jobs for consecutive years of a station are
+                                      fetched in one query.
+            - parser, status_table, metrics & refresh_below: same as update_data.
+        :return: number of jobs completed by this worker.
+        """
+        destination_folder = kwargs.get('to_folder', 'NA')
+        data_type = kwargs.get('data_type', 'rainfall')
+        data_freq = kwargs.get('freq', 'daily')
+        table_name = kwargs.get('table_name', 'niwa_rainfall')
+        use_existing_data = kwargs.get('use_existing_data', True)
+        csv_only = kwargs.get('csv_only', False)
+        station_table_name = kwargs.get('station_table_name', 'NA')
+        batch_size = kwargs.get('batch_size', 10)
+        range_mode = kwargs.get('range_mode', False)
+        row_limit = kwargs.get('row_limit', 40000)
+        max_years = Cliflo.max_query_years(data_freq, row_limit) if range_mode else 1
+        self.parser = kwargs.get('parser', 'read_html')
+        Cliflo.open_status(self, kwargs.get('status_table', 'cliflo_status'))
+        Cliflo.open_metrics(self, kwargs.get('metrics', False))
+        self.quota.refresh_below = kwargs.get('refresh_below', 10000)
+
+        TableX = Cliflo.table_class(self, station_table_name) if self.status is None else None
+        driver, main_window_handle = Cliflo.cf_login(self)
+        driver, main_window_handle = Cliflo.cf_specify_data(data_type, driver, main_window_handle)
+        current_station = None
+        completed = 0
+        stopped = False
 
-        driver.quit()
+        job_queue.start_heartbeat()
+        try:
+            while not stopped:
+                jobs = job_queue.claim(data_type, batch_size)
+                if not jobs:
+                    break
+                station_years = defaultdict(list)
+                [station_years[station_id].append(year) for station_id, year in jobs]
+                for station_id, years in [(station_id, years) for station_id, year_list in station_years.items()
+                                          for years in Cliflo.year_ranges(year_list, max_years)]:
+                    try:
+                        Cliflo.run_range_update(self, driver, station_id, years, data_type, data_freq, table_name,
+                                                destination_folder, main_window_handle, use_existing_data, csv_only,
+                                                TableX, select_station=station_id != current_station)
+                        current_station = station_id
+                        [job_queue.complete(data_type, station_id, year) for year in years]
+                        completed += len(years)
+                    except CQ.QuotaError as e:
+                        # jobs still leased are handed back by release below, without using up an attempt
+                        print('stopping ' + job_queue.worker_id + ': ' + str(e))
+                        self.session.rollback()
+                        stopped = True
+                        break
+                    except Exception as e:
+                        print('job failed on station ' + str(station_id) + ', years ' + str(years) + ': ' + str(e))
+                        [job_queue.fail(data_type, station_id, year) for year in years]
+                        current_station = None
+                        self.session.rollback()
+        finally:
+            job_queue.stop_heartbeat()
+            job_queue.release()
+            Cliflo.flush_status(self)
+            driver.quit()
+
+        Cliflo.metrics_report()
+        Cliflo.quota_report(self)
+        print(str(completed) + ' jobs completed by ' + job_queue.worker_id)
+        return completed
+
+    def delta_sync(self, **kwargs):
+        """
+        Brings an observation table up to date without going back over whole years. Each station's latest stored day
+        is read from table_name (or, for stations with no rows, the last year the status table has as loaded) and only
+        the days from there to until are queried. Stations with the same latest day are queried together. New rows
+        are appended with copy_df_to_db so re-running a sync adds nothing twice. Raw downloads are not kept as they
+        are not whole years.
+
+        :param kwargs:
+            - stations, data_type, table_name, station_table_name, parser, status_table, metrics & refresh_below:
+              same as update_data.
+            - until: last day to fetch (datetime.date). Default is today.
+            - first_year: where stations with nothing stored start from. Default is the year of until.
+            - station_batch_size: most stations to query at once. Default is 50, fewer if the window is long enough
+                                  that the rows would go over row_limit.
+            - row_limit: same as update_data.
+        :return: number of new rows added.
+        """
+        station_info = kwargs.get('stations', 'NA')
+        data_type = kwargs.get('data_type', 'rainfall')
+        table_name = kwargs.get('table_name', 'niwa_rainfall')
+        station_table_name = kwargs.get('station_table_name', 'NA')
+        until = kwargs.get('until', datetime.date.today())
+        first_year = kwargs.get('first_year', until.year)
+        station_batch_size = kwargs.get('station_batch_size', 50)
+        row_limit = kwargs.get('row_limit', 40000)
+        self.parser = kwargs.get('parser', 'read_html')
+        Cliflo.open_status(self, kwargs.get('status_table', 'cliflo_status'))
+        Cliflo.open_metrics(self, kwargs.get('metrics', False))
+        self.quota.refresh_below = kwargs.get('refresh_below', 10000)
+
+        stations = pd.read_excel(station_info) if type(station_info) is str else station_info
+        station_list = [str(station_id) for station_id in stations['AgentNumber']]
+        TableX = Cliflo.table_class(self, station_table_name) if self.status is None else None
+
+        latest = Cliflo.latest_dates(self, table_name, station_list, data_type, first_year)
+        windows = defaultdict(list)
+        [windows[latest[station_id]].append(station_id) for station_id in station_list
+         if latest[station_id] < until]
+        print(str(sum(len(ids) for ids in windows.values())) + ' of ' + str(len(station_list)) +
+              ' stations have days to fetch')
+        if not windows:
+            return 0
+        # one job per station for the ETA, a window over new year is counted as two when it is done
+        CMT.metrics.add_planned(sum(len(station_ids) for station_ids in windows.values()))
+
+        driver, main_window_handle = Cliflo.cf_login(self)
+        driver, main_window_handle = Cliflo.cf_specify_data(data_type, driver, main_window_handle)
+        added = 0
+        try:
+            for last_day, station_ids in sorted(windows.items()):
+                days = (until - last_day).days
+                batch_size = max(1, min(station_batch_size, row_limit // days))
+                for n in range(0, len(station_ids), batch_size):
+                    batch = station_ids[n:n + batch_size]
+                    print('delta sync - stations: ' + str(batch) + ', ' + str(last_day + datetime.timedelta(1)) +
+                          ' to ' + str(until))
+                    driver = Cliflo.cf_get_station_data(driver, main_window_handle, batch)
+                    cf_df = Cliflo.cf_query(self, driver, main_window_handle, batch, last_day + datetime.timedelta(1),
+                                            until + datetime.timedelta(1), data_type, days * len(batch))
+                    station_dfs = Cliflo.split_cf_stations(cf_df, batch)
+                    added += sum(Cliflo.delta_load(self, station_dfs[station_id], station_id, last_day, until,
+                                                   data_type, table_name, TableX) for station_id in batch)
+        except CQ.QuotaError as e:
+            # stations not synced still end before until so the next sync picks them up
+            print('stopping delta sync: ' + str(e))
+        finally:
+            Cliflo.flush_status(self)
+            driver.quit()
+
+        Cliflo.metrics_report()
+        Cliflo.quota_report(self)
+        print(str(added) + ' new rows added to ' + table_name)
+        return added
+
+    def latest_dates(self, table_name, station_list, data_type, first_year):
+        """
+        Latest stored day of each station for delta_sync. Stations with no rows in table_name start from 1 Jan of the
+        last year the status table has loaded for them, or from 1 Jan first_year, so their first day is included.
+
+        :return: {station (str): datetime.date}
+        """
+        latest = {}
+        if Cliflo.has_table(self, table_name):
+            if 'date' in Cliflo.table_class(self, table_name).__table__.columns:
+                # typed table, one index lookup per station on (station, date)
+                args = text('SELECT s.station, (SELECT max(t.date) FROM %s t WHERE t.station = s.station) AS latest '
+                            'FROM unnest(CAST(:stations AS integer[])) AS s (station)' % table_name)
+                params = {'stations': [int(station_id) for station_id in station_list]}
+            else:
+                args = text('SELECT station, max(make_date(CAST(year AS integer), CAST(month AS integer), '
+                            'CAST(day AS integer))) AS latest FROM %s GROUP BY station' % table_name)
+                params = {}
+            with self.engine.connect() as conn:
+                latest = {str(station): day for station, day in conn.execute(args, params) if day is not None}
+
+        loaded = self.status.years(data_type, 'loaded') if self.status is not None else {}
+        start = {station_id: datetime.date(max(loaded[station_id]) if loaded.get(station_id) else first_year, 1, 1)
+                 - datetime.timedelta(1) for station_id in station_list}
+        return {station_id: latest.get(station_id, start[station_id]) for station_id in station_list}
+
+    def delta_load(self, cf_df, station_id, last_day, until, data_type, table_name, TableX):
+        """
+        Loads the rows of a delta_sync query for one station that come after last_day and records the years they are
+        in with the status table (or stations table) and the manifest. A year's completeness is worked out again from
+        all its stored rows, not just the new ones, so each sync adds to it rather than replacing it.
+        Returns the number of new rows.
+        """
+        cf_df = Cliflo.station_obs_quick_clean(cf_df)
+        if cf_df.empty:
+            return 0
+        clean_df = Cliflo.station_obs_preprocess(cf_df, data_type)
+        days = pd.to_datetime(clean_df['year'].astype(str) + clean_df['month'].astype(str).str.zfill(2) +
+                              clean_df['day'].astype(str).str.zfill(2), format='%Y%m%d', errors='coerce').dt.date
+        clean_df = clean_df[(days > last_day) & (days <= until)]
+        if clean_df.empty:
+            return 0
+
+        with self.table_lock:
+            if not Cliflo.has_table(self, table_name):
+                Cliflo.create_typed_table(self, Cliflo.obs_table_schema(table_name, data_type))
+        rows = Cliflo.copy_df_to_db(clean_df, table_name, self.engine)
+        # fraction of the year's stored values that were estimated, as analyse_cf_data gives it
+        estimated = Cliflo.station_clean_dict[data_type][1][0] + '_estimated'
+        args = text('SELECT CAST(year AS integer), count(*), count(*) FILTER (WHERE CAST("%s" AS text) = \'1\') '
+                    'FROM %s WHERE CAST(station AS text) = :station AND CAST(year AS integer) = ANY(:years) '
+                    'GROUP BY CAST(year AS integer)' % (estimated, table_name))
+        with self.engine.connect() as conn:
+            stored = {year: str(missing / total) for year, total, missing in conn.execute(
+                args, {'station': str(station_id), 'years': sorted(set(clean_df['year'].astype(int)))})}
+        for year, year_df in clean_df.groupby(clean_df['year'].astype(int)):
+            Cliflo.update_stations_table(self, stored[year], station_id, year, data_type, TableX)
+            Cliflo.manifest_state(self, data_type, station_id, year, 'parsed', len(year_df))
+            Cliflo.manifest_state(self, data_type, station_id, year, 'loaded')
+        return rows
 
     def run_data_update(self, driver, station_id, year, data_type, data_freq, table_name,
-                        destination_folder, main_window_handle, use_existing_data, csv_only, TableX, year_list):
+                        destination_folder, main_window_handle, use_existing_data, csv_only, TableX, year_list,
+                        select_station=None, cf_df=None, clean_df=None):
 
         # TODO run to db for all downloaded files html and csv files in a folder
         """
@@ -253,61 +780,380 @@ class Cliflo:
         :param table_name: name of table in database we are updating
         :param destination_folder: name of folder we want to save any new csv downloads
         :param main_window_handle: used in selenium webdriver to access the main page of Cliflo
+        :param select_station: select the station on Cliflo before querying. Default (None) selects it on the
+                               first year in year_list.
+        :param cf_df: data for the year if it has already been downloaded (see run_range_update). Default is None
+                      which looks for a csv file and otherwise downloads it.
+        :param clean_df: cf_df already put through station_obs_preprocess (see station_obs_batch). Default is None
+                         which preprocesses it here.
         :return:
         """
         print('data update - station: ' + str(station_id) + ', year: ' + str(year))
-        file_name = 'station ' + str(station_id) + ' - ' + data_type + ' - ' + data_freq + ' (' + str(year) \
-                    + ' - ' + str(year + 1) + ')'
-
-
-        if year == year_list[0]:
+        if select_station is None:
+            select_station = year == year_list[0]
+        if select_station and cf_df is None:
             driver = Cliflo.cf_get_station_data(driver, main_window_handle, station_id)
 
         # check if data already downloaded (return True) or if file is empty or does not exist(return False).
-        cf_df = Cliflo.file_to_df_if_exists(destination_folder, file_name)
+        if cf_df is None:
+            cf_df = Cliflo.load_raw(self, destination_folder, station_id, data_type, data_freq, year)
         if cf_df is False:
             print('getting data from CliFlo...')
             # Executes a few different methods that makes extracting the data from Cliflo more efficient and then
             # sends data as a csv.
-            Cliflo.cf_change_year(driver, main_window_handle, year)
-            cf_df = Cliflo.cf_get_data(driver, data='station_obs', data_type=data_type)
-            Cliflo.cf_data_to_csv(cf_df, destination_folder, file_name)
-            driver.back()
+            cf_df = Cliflo.cf_query(self, driver, main_window_handle, [station_id], datetime.date(year, 1, 1),
+                                    datetime.date(year + 1, 1, 1), data_type, Cliflo.freq_rows_dict[data_freq])
+            Cliflo.save_raw(self, cf_df, destination_folder, station_id, data_type, data_freq, year)
+        Cliflo.manifest_state(self, data_type, station_id, year, 'downloaded', len(cf_df))
 
         #Excute a basic cleaning scrips on the downloaded data.
         cf_df = Cliflo.station_obs_quick_clean(cf_df)
-
-        # if there is data and we want to alo put it into a database...
-        if not cf_df.empty and not csv_only:
-            Cliflo.df_to_db(self, cf_df, table_name, data_type, station_id, year, use_existing_data)
+        Cliflo.manifest_state(self, data_type, station_id, year, 'parsed', len(cf_df))
+        # preprocessed once here and shared by the database / store and analyse_cf_data
+        if clean_df is None and not cf_df.empty:
+            clean_df = Cliflo.station_obs_preprocess(cf_df, data_type)
+
+        # if there is data and we want to alo put it into a database (or the parquet store)...
+        if not cf_df.empty and self.store is not None:
+            Cliflo.df_to_store(self, clean_df, data_type, station_id, year)
+            print('sent to parquet store')
+        elif not cf_df.empty and not csv_only:
+            Cliflo.df_to_db(self, clean_df, table_name, data_type, station_id, year, use_existing_data)
             print('sent to database')
 
         # Storing status of operation in Stations DF so if the entry is empty in future it will not call it again.
-        output = Cliflo.analyse_cf_data(cf_df, data_type, Cliflo.station_clean_dict[data_type][1][0])
+        output = Cliflo.analyse_cf_data(cf_df if clean_df is None else clean_df, data_type,
+                                        Cliflo.station_clean_dict[data_type][1][0])
         Cliflo.update_stations_table(self, output, station_id, year, data_type, TableX)
 
+        if cf_df.empty:
+            Cliflo.manifest_state(self, data_type, station_id, year, 'empty', 0)
+        elif not csv_only or self.store is not None:
+            Cliflo.manifest_state(self, data_type, station_id, year, 'loaded')
+
+    def manifest_state(self, data_type, station_id, year, state, rows=None):
+        """Records the state of a job in the manifest if update_data was given one and counts it in job_counts."""
+        with self.count_lock:
+            self.job_counts[state] += 1
+            self.job_counts[state + '_rows'] += rows or 0
+        if state == 'parsed':
+            CMT.metrics.record_job(data_type, station_id, year, rows)
+        if self.manifest is not None:
+            self.manifest.set_state(data_type, station_id, year, state, rows)
+
+    def table_class(self, table_name):
+        """ORM class for an existing table, only that table is reflected and only the first time (see Db_Registry)."""
+        return DB.table_class(self.db_string, table_name)
+
+    def has_table(self, table_name):
+        """True if table_name is in the database. dialect.has_table needs a connection rather than the engine."""
+        return inspect(self.engine).has_table(table_name)
+
+    def open_status(self, status_table):
+        """Sets self.status from the status_table kwarg: a table name, a Cliflo_Status.StatusTable or False."""
+        if status_table is False or not self.connect_db:
+            self.status = None
+        elif type(status_table) is str:
+            self.status = CST.StatusTable(self.engine, table_name=status_table)
+        else:
+            self.status = status_table
+
+    def flush_status(self):
+        if self.status is not None:
+            self.status.flush()
+
+    def open_metrics(self, folder):
+        """Points Cliflo_Metrics.metrics at the folder from the metrics kwarg, False leaves it as it is."""
+        if folder:
+            CMT.metrics.configure(folder)
+
+    @staticmethod
+    def metrics_report():
+        print(CMT.metrics.summary())
+        print(CMT.metrics.rates())
+        CMT.metrics.export(Cliflo.wait_log)
+
+    def quota_report(self):
+        print('row quota: ' + str(self.quota.summary()))
+
+    def manifest_report(self, data_type):
+        if self.manifest is not None:
+            print('manifest progress for ' + data_type + ': ' + str(self.manifest.progress(data_type)))
+
+    def run_range_update(self, driver, station_id, years, data_type, data_freq, table_name, destination_folder,
+                         main_window_handle, use_existing_data, csv_only, TableX, select_station=True):
+        """
+        Range mode of run_data_update. Years without a csv file are downloaded with a single Cliflo query covering
+        all of them, split into the usual per year csv files, then each year goes through run_data_update as normal.
+        A single year is passed straight to run_data_update.
+
+        :param years: consecutive years to update (see year_ranges).
+        :param select_station: select the station on Cliflo before querying.
+        :return:
+        """
+        if len(years) == 1:
+            Cliflo.run_data_update(self, driver, station_id, years[0], data_type, data_freq, table_name,
+                                   destination_folder, main_window_handle, use_existing_data, csv_only, TableX, years,
+                                   select_station=select_station)
+            return
+
+        print('range update - station: ' + str(station_id) + ', years: ' + str(years[0]) + ' - ' + str(years[-1]))
+        if select_station:
+            driver = Cliflo.cf_get_station_data(driver, main_window_handle, station_id)
+
+        year_dfs = {year: Cliflo.load_raw(self, destination_folder, station_id, data_type, data_freq, year)
+                    for year in years}
+        missing = [year for year in years if year_dfs[year] is False]
+
+        # a query covers every year between its first and last, so years already downloaded split it in two
+        for run in Cliflo.year_ranges(missing, len(missing)):
+            print('getting ' + str(len(run)) + ' years from CliFlo in one query...')
+            cf_df = Cliflo.cf_query(self, driver, main_window_handle, [station_id], datetime.date(run[0], 1, 1),
+                                    datetime.date(run[-1] + 1, 1, 1), data_type,
+                                    len(run) * Cliflo.freq_rows_dict[data_freq])
+            split_dfs = Cliflo.split_cf_years(cf_df, run)
+            for year in run:
+                Cliflo.save_raw(self, split_dfs[year], destination_folder, station_id, data_type, data_freq, year)
+                year_dfs[year] = split_dfs[year]
+
+        clean_dfs = Cliflo.station_obs_batch([year_dfs[year] for year in years], data_type)
+        [Cliflo.run_data_update(self, driver, station_id, year, data_type, data_freq, table_name, destination_folder,
+                                main_window_handle, use_existing_data, csv_only, TableX, years, select_station=False,
+                                cf_df=year_dfs[year], clean_df=clean_df)
+         for year, clean_df in zip(years, clean_dfs)]
+
+    def run_batch_update(self, driver, station_ids, years, year_lists, data_type, data_freq, table_name,
+                         destination_folder, main_window_handle, use_existing_data, csv_only, TableX,
+                         select_station=True):
+        """
+        Batch version of run_range_update. All stations in station_ids are selected on Cliflo together and the years
+        that have no csv file yet are downloaded with one query. The combined table is split by the Station column
+        and by year into the usual per station, per year csv files, then each goes through run_data_update.
+        A single station is passed straight to run_range_update.
+
+        :param station_ids: stations to select together (see batch_jobs).
+        :param years: consecutive years to query.
+        :param year_lists: {station: years needed} so only the years each station is missing are processed.
+        :param select_station: select the stations on Cliflo before querying.
+        :return:
+        """
+        if len(station_ids) == 1:
+            Cliflo.run_range_update(self, driver, station_ids[0], years, data_type, data_freq, table_name,
+                                    destination_folder, main_window_handle, use_existing_data, csv_only, TableX,
+                                    select_station=select_station)
+            return
+
+        print('batch update - stations: ' + str(station_ids) + ', years: ' + str(years[0]) + ' - ' + str(years[-1]))
+        if select_station:
+            driver = Cliflo.cf_get_station_data(driver, main_window_handle, station_ids)
+
+        wanted = [(station_id, year) for station_id in station_ids for year in years
+                  if year in year_lists[station_id]]
+        job_dfs = {job: Cliflo.load_raw(self, destination_folder, job[0], data_type, data_freq, job[1])
+                   for job in wanted}
+        missing = [job for job in wanted if job_dfs[job] is False]
+
+        missing_years = sorted(set(year for station_id, year in missing))
+        # a query covers every year between its first and last, so years no station needs split it in two
+        for run in Cliflo.year_ranges(missing_years, len(missing_years)):
+            run_missing = [(station_id, year) for station_id, year in missing if year in run]
+            print('getting ' + str(len(run_missing)) + ' station years from CliFlo in one query...')
+            cf_df = Cliflo.cf_query(self, driver, main_window_handle, station_ids, datetime.date(run[0], 1, 1),
+                                    datetime.date(run[-1] + 1, 1, 1), data_type,
+                                    len(station_ids) * len(run) * Cliflo.freq_rows_dict[data_freq])
+            station_dfs = Cliflo.split_cf_stations(cf_df, station_ids)
+            split_dfs = {station_id: Cliflo.split_cf_years(station_dfs[station_id], run)
+                         for station_id in station_ids}
+            for station_id, year in run_missing:
+                Cliflo.save_raw(self, split_dfs[station_id][year], destination_folder, station_id, data_type,
+                                data_freq, year)
+                job_dfs[(station_id, year)] = split_dfs[station_id][year]
+
+        clean_dfs = Cliflo.station_obs_batch([job_dfs[job] for job in wanted], data_type)
+        [Cliflo.run_data_update(self, driver, station_id, year, data_type, data_freq, table_name, destination_folder,
+                                main_window_handle, use_existing_data, csv_only, TableX, years, select_station=False,
+                                cf_df=job_dfs[(station_id, year)], clean_df=clean_df)
+         for (station_id, year), clean_df in zip(wanted, clean_dfs)]
+
+    def batch_jobs(self, station_list, station_batch_size, max_years, table_name, start_year, end_year, csv_only,
+                   use_existing_data, Table, TableX, data_type=None):
+        """
+        Works out the queries update_data needs to make. Stations are grouped into batches of station_batch_size,
+        the years any station in the batch is missing are split into ranges of at most max_years (fewer for bigger
+        batches so the rows stay under the same limit). Stations missing no years are left out.
+
+        If there is a manifest, stations it has already planned for the same years take their remaining jobs from
+        it, the rest are worked out together with plan_years (before any browser work) and added to it.
+
+        :return: list of (station_ids, years, {station: years needed}) jobs.
+        """
+        station_list = list(station_list)
+        planned, remaining = set(), {}
+        if self.manifest is not None and use_existing_data:
+            planned = self.manifest.planned_stations(data_type, start_year, end_year)
+            remaining = self.manifest.remaining(data_type, ('parsed', 'loaded', 'empty')
+                                                if csv_only and self.store is None else ('loaded', 'empty'))
+            print(str(len(planned)) + ' stations already planned in the manifest')
+        year_plan = Cliflo.plan_years(self, [station_id for station_id in station_list
+                                             if str(station_id) not in planned],
+                                      table_name, start_year, end_year, csv_only, use_existing_data, TableX, data_type)
+
+        jobs = []
+        for n in range(0, len(station_list), station_batch_size):
+            year_lists = {station_id: Cliflo.plan_station(self, station_id, planned, remaining, year_plan, data_type,
+                                                          start_year, end_year, use_existing_data)
+                          for station_id in station_list[n:n + station_batch_size]}
+            year_lists = {station_id: year_list for station_id, year_list in year_lists.items() if year_list}
+            if not year_lists:
+                continue
+            all_years = sorted(set(year for year_list in year_lists.values() for year in year_list))
+            jobs += [(list(year_lists), years, year_lists)
+                     for years in Cliflo.year_ranges(all_years, max(1, max_years // len(year_lists)))]
+        if self.quota.prioritise and data_type is not None and self.status is not None:
+            jobs = CQ.prioritise(jobs, self.status.years(data_type, 'loaded'), self.status.years(data_type, 'empty'))
+        # station years to go, for the ETA (see Cliflo_Metrics)
+        CMT.metrics.add_planned(sum(len(set(years) & set(year_lists[station_id]))
+                                    for station_ids, years, year_lists in jobs for station_id in station_ids))
+        return jobs
+
+    def plan_station(self, station_id, planned, remaining, year_plan, data_type, start_year, end_year,
+                     use_existing_data):
+        """Years a station still needs, from the manifest if it was planned before, otherwise from plan_years."""
+
+        if str(station_id) in planned:
+            return remaining.get(str(station_id), [])
+
+        year_list = year_plan[station_id]
+        if self.store is not None and use_existing_data:
+            year_list = sorted(set(year_list) - self.store.years(data_type, station_id))
+        if self.manifest is not None:
+            self.manifest.plan(data_type, station_id, start_year, end_year, year_list)
+        return year_list
+
+    def load_raw(self, destination_folder, station_id, data_type, data_freq, year):
+        """
+        Raw download for a station year from the cache if update_data was given one, otherwise from its csv file.
+        Returns False if it has not been downloaded.
+        """
+        if self.cache is not None:
+            return self.cache.get(data_type, data_freq, station_id, year, year + 1)
+        return Cliflo.file_to_df_if_exists(destination_folder,
+                                           Cliflo.cf_file_name(station_id, data_type, data_freq, year))
+
+    def save_raw(self, df, destination_folder, station_id, data_type, data_freq, year):
+        """Stores a raw download for a station year in the cache, or as a csv file if there is no cache."""
+        if self.cache is not None:
+            self.cache.put(df, data_type, data_freq, station_id, year, year + 1)
+        else:
+            Cliflo.cf_data_to_csv(df, destination_folder, Cliflo.cf_file_name(station_id, data_type, data_freq, year))
+
+    @staticmethod
+    def cf_file_name(station_id, data_type, data_freq, year):
+        return 'station ' + str(station_id) + ' - ' + data_type + ' - ' + data_freq + ' (' + str(year) \
+               + ' - ' + str(year + 1) + ')'
+
+    @staticmethod
+    def max_query_years(data_freq, row_limit):
+        """Most whole years of data_freq data for one station that fit under row_limit (at least 1)."""
+        return max(1, row_limit // Cliflo.freq_rows_dict.get(data_freq, Cliflo.freq_rows_dict['hourly']))
+
+    @staticmethod
+    def year_ranges(year_list, max_years):
+        """
+        Splits a list of years into runs of consecutive years no longer than max_years.
+        e.g year_ranges([1990, 1991, 1992, 1995], 2) returns [[1990, 1991], [1992], [1995]]
+        """
+        ranges = []
+        for year in sorted(year_list):
+            if ranges and year == ranges[-1][-1] + 1 and len(ranges[-1]) < max_years:
+                ranges[-1].append(year)
+            else:
+                ranges.append([year])
+        return ranges
+
+    @staticmethod
+    def split_cf_stations(cf_df, station_ids):
+        """
+        Splits a raw Cliflo table with several stations in it into one raw table per station using the Station
+        column (header rows are kept on each). Stations with no rows get an empty dataframe.
+
+        :return: {station: dataframe}
+        """
+        empty = {station_id: pd.DataFrame() for station_id in station_ids}
+        station_col, header, data = Cliflo.cf_column(cf_df, 'Station')
+        if station_col is None:
+            return empty
+
+        data_stations = data[station_col].astype(str)
+        for station_id in station_ids:
+            rows = data[data_stations == str(station_id)]
+            if not rows.empty:
+                empty[station_id] = pd.concat([header, rows])
+        return empty
+
+    @staticmethod
+    def cf_column(cf_df, name):
+        """
+        Finds a Cliflo column in a raw table from either parser. read_html tables have the column names in their
+        second row, Cliflo_Parser tables have them as the column names.
+
+        :return: (column, header rows, data rows), column is None if the table is empty or has no such column.
+        """
+        if name in cf_df.columns:
+            return name, cf_df.iloc[:0], cf_df
+        if cf_df.empty or len(cf_df) < 2:
+            return None, None, None
+        cols = [col for col in cf_df.columns if str(cf_df.at[cf_df.index[1], col]) == name]
+        if not cols:
+            return None, None, None
+        return cols[0], cf_df.iloc[:2], cf_df.iloc[2:]
+
+    @staticmethod
+    def split_cf_years(cf_df, years):
+        """
+        Splits a raw multi year Cliflo table (as returned by cf_get_data, header rows kept if it has them) into one raw
+        table per year, in the same format as a single year download. Years with no rows get an empty dataframe.
+
+        :return: {year: dataframe}
+        """
+        empty = {year: pd.DataFrame() for year in years}
+        date_col, header, data = Cliflo.cf_column(cf_df, 'Date(NZST)')
+        if date_col is None:
+            return empty
+
+        data_years = data[date_col].astype(str).str[:4]
+        for year in years:
+            rows = data[data_years == str(year)]
+            if not rows.empty:
+                empty[year] = pd.concat([header, rows])
+        return empty
+
     def cf_get_stations(self, data_type):
 
         driver, main_window_handle = Cliflo.cf_login(self)
         driver, main_window_handle = Cliflo.cf_specify_data(data_type, driver, main_window_handle)
+        if isinstance(driver, CH.CliFloSession):
+            driver.search_stations(-41, 174, 1500)
+            cf_station_df = Cliflo.cf_get_data(driver, data='station_list')
+            driver.quit()
+            return cf_station_df
+
         driver.switch_to.window(main_window_handle)
+        handles = driver.window_handles
         driver.find_element_by_name('agent').click()
-        time.sleep(1)
+        Cliflo.cf_wait(driver, EC.new_window_is_opened(handles), 'station_popup')
         driver.switch_to.window(driver.window_handles[-1])
-        driver.find_element_by_css_selector("input[type='radio'][value='latlongc']").click()
-        time.sleep(1)
+        Cliflo.cf_wait(driver, EC.element_to_be_clickable((By.CSS_SELECTOR, "input[type='radio'][value='latlongc']")),
+                       'station_search_form').click()
         driver.find_element_by_name('clat1').clear()
         driver.find_element_by_name('clat1').send_keys(-41)
-        time.sleep(1)
         driver.find_element_by_name('clong1').clear()
         driver.find_element_by_name('clong1').send_keys(174)
-        time.sleep(1)
         driver.find_element_by_name('crad').clear()
         driver.find_element_by_name('crad').send_keys(1500)
-        time.sleep(1)
         driver.find_element_by_name('Submit').click()
-        time.sleep(1)
-        driver.switch_to.window(driver.window_handles[-1])
+        Cliflo.cf_wait(driver, Cliflo.cf_last_window_has("//form[@action='/pls/niwp/wstn.update_stn_query']"),
+                       'station_list', delay=360)
         cf_station_df = Cliflo.cf_get_data(driver, data='station_list')
         driver.quit()
 
@@ -336,13 +1182,22 @@ class Cliflo:
         return x_filtered
 
     def update_lat_long(self, df, station_table_name):
-
-        TableY = type('Table_Y_classname', (self.Base,), {'__tablename__': station_table_name})
-        for station in df['AgentNumber']:
-            self.session.query(TableY).filter(TableY.stations == str(station)).update(
-                {'lat': df.loc[df['AgentNumber'] == station, 'lat'].values[0],
-                 'long':df.loc[df['AgentNumber'] == station, 'long'].values[0]})
-            self.session.commit()
+        """
+        Sets lat / long for every station in df with one UPDATE joined to the coordinates sent as arrays, committed
+        once. Works on typed and text stations tables. The first row of a station is used if it appears twice.
+        """
+        coords = df.drop_duplicates('AgentNumber')
+        params = {'stations': [str(station) for station in coords['AgentNumber']]}
+        for col in ['lat', 'long']:
+            values = pd.to_numeric(coords[col], errors='coerce')
+            params[col] = [None if pd.isna(value) else float(value) for value in values]
+
+        with self.engine.begin() as conn:
+            result = conn.execute(text('UPDATE %s AS t SET lat = v.lat, long = v.long '
+                                       'FROM unnest(CAST(:stations AS text[]), CAST(:lat AS double precision[]), '
+                                       'CAST(:long AS double precision[])) AS v (stations, lat, long) '
+                                       'WHERE CAST(t.stations AS text) = v.stations' % station_table_name), params)
+        print(str(result.rowcount) + ' station coordinates updated')
 
     def create_stations_table(self, stations_df, start_year, end_year, data_type, table_name):
 
@@ -352,9 +1207,98 @@ class Cliflo:
         cols = [data_type +'_'+ str(year) for year in list(range(start_year, end_year+1))] +['lat', 'long']
         df = pd.DataFrame(columns=cols, index=stations_df['AgentNumber'].unique())
         df['stations'] = df.index
-        Cliflo.create_table(self, table_name, df, 'stations')
+        Cliflo.create_typed_table(self, Cliflo.station_table_schema(table_name, data_type, start_year, end_year))
         df.to_sql(table_name, self.engine, if_exists='append', index=False)
 
+    @staticmethod
+    def obs_table_schema(table_name, data_type):
+        """
+        Typed observation table for a data_type: day, month and year as small ints, station as an int, values as
+        floats and *_estimated flags as 0 / 1. date is generated by the database from year, month and day and
+        (station, date) is indexed so a station's series is an index range scan.
+        Requires PostgreSQL 12 or later for the generated column, which is stored as an index can not be on a virtual
+        one (the default from PostgreSQL 18).
+        """
+        vals = Cliflo.station_clean_dict[data_type][1]
+        return Table(table_name, MetaData(),
+                     Column('rowid', String, primary_key=True),
+                     Column('day', SmallInteger),
+                     Column('year', SmallInteger),
+                     Column('month', SmallInteger),
+                     Column('station', Integer),
+                     *([Column(val, Float) for val in vals] + [Column(val + '_estimated', SmallInteger) for val in vals]
+                       + [Column('date', Date, Computed('make_date(year, month, day)', persisted=True))]),
+                     Index(table_name + '_station_date_idx', 'station', 'date'))
+
+    @staticmethod
+    def station_table_schema(table_name, data_type, start_year, end_year):
+        """
+        Typed stations table: stations as an int primary key, lat / long as floats (indexed together for nearest
+        station searches) and a status column per year (see update_stations_table).
+        """
+        return Table(table_name, MetaData(),
+                     Column('stations', Integer, primary_key=True),
+                     Column('lat', Float),
+                     Column('long', Float),
+                     *[Column(data_type + '_' + str(year), String) for year in range(start_year, end_year + 1)],
+                     Index(table_name + '_lat_long_idx', 'lat', 'long'))
+
+    def create_typed_table(self, table):
+        """Creates a table from obs_table_schema / station_table_schema with its indexes."""
+
+        print('creating table named: ', table.name)
+        table.create(self.engine, checkfirst=True)
+        DB.forget(self.db_string, table.name)
+        print('table created')
+
+    def migrate_table(self, table_name, data_type, **kwargs):
+        """
+        Converts a table made by create_table (every column text) to the typed schema in place, in one transaction.
+        Text that is not a number ('-', 'nan', '') becomes NULL. Columns that are already typed are left alone so
+        it is safe to run again.
+
+        :param table_name: table to migrate.
+        :param data_type: keyword for station_clean_dict so either 'rainfall', 'sunshine_hours' etc.
+        :param kwargs:
+            - stations: True if table_name is a stations table rather than an observation table. Default is False.
+        :return: list of columns converted.
+        """
+        stations = kwargs.get('stations', False)
+        if stations:
+            table = Cliflo.station_table_schema(table_name, data_type, 0, -1)
+        else:
+            table = Cliflo.obs_table_schema(table_name, data_type)
+
+        int_pattern = "'^\\s*-?[0-9]+(\\.0*)?\\s*$'"
+        float_pattern = "'^\\s*-?([0-9]+\\.?[0-9]*|\\.[0-9]+)([eE][-+]?[0-9]+)?\\s*$'"
+        with self.engine.begin() as conn:
+            text_cols = [row[0] for row in conn.execute(text(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = :table_name "
+                "AND table_schema = current_schema() AND data_type IN ('text', 'character varying')"),
+                {'table_name': table_name})]
+            converted = []
+            for col in table.columns:
+                if col.name not in text_cols or isinstance(col.type, String) or col.computed is not None:
+                    continue
+                if isinstance(col.type, Float):
+                    sql_type, pattern, cast = 'double precision', float_pattern, '::double precision'
+                else:
+                    sql_type, pattern = ('smallint' if isinstance(col.type, SmallInteger) else 'integer'), int_pattern
+                    cast = '::numeric::' + sql_type
+                conn.execute(text('ALTER TABLE %s ALTER COLUMN "%s" TYPE %s USING CASE WHEN "%s" ~ %s THEN "%s"%s '
+                                  'END' % (table_name, col.name, sql_type, col.name, pattern, col.name, cast)))
+                converted.append(col.name)
+            if not stations:
+                conn.execute(text('ALTER TABLE %s ADD COLUMN IF NOT EXISTS date date GENERATED ALWAYS AS '
+                                  '(make_date(year, month, day)) STORED' % table_name))
+            for index in table.indexes:
+                conn.execute(text('CREATE INDEX IF NOT EXISTS %s ON %s (%s)'
+                                  % (index.name, table_name, ', '.join('"%s"' % col.name for col in index.columns))))
+            conn.execute(text('ANALYZE %s' % table_name))
+        DB.forget(self.db_string, table_name)
+        print(table_name + ' migrated, converted: ' + str(converted))
+        return converted
+
     def create_table(self, table_name, df, primary_key_string):
         """
 
@@ -383,59 +1327,73 @@ class Cliflo:
                             for col_name, primary_key_flag in zip(df.columns, primary_key_flags)))
             table.create(self.engine)
 
-            self.Base.metadata.reflect(self.engine)
+            DB.forget(self.db_string, table_name)
             primaryKeyColName = table.primary_key.columns.values()[0].name
             print('table created')
 
         except Exception as e:
             print(e)
 
-    def create_year_list(self, table_name, station_id, start_year, end_year, csv_only, use_existing_data,
-                         Table, TableX):
-        print('creating year list')
-        year_list = list(range(start_year, end_year))
-
-        if (self.engine.dialect.has_table(self.engine, table_name)) and (csv_only == False) and use_existing_data:
-            # switch Table connection back on once table has been made (i.e not table - mkes Table False so we make
-            # a table then need to switch it back on again
-            if Table is False:
-                Table = type('Station_Obs_Class', (self.Base,), {'__tablename__': table_name})
-
-            print('creating dict of stations and years already in database...')
-
-            empty_years = []
-            [empty_years.append(int(re.sub('[^0-9]', '', key))) for
-             key, value in self.session.query(TableX).filter_by(stations=str(station_id)).one().__dict__.items()
-             if value == 'empty']
-
-            station_data_dict = defaultdict(list)
-            [station_data_dict[int(station_id)].append(int(year[0])) for year in
-                 self.session.query(getattr(Table, 'year')).filter_by(station=str(station_id)).distinct() if Table]
-
-            year_list = list((set(list(range(start_year, end_year))) - set(station_data_dict[station_id])
-                              - set(empty_years)))
-
-            print('years ' + str(year_list) + ' from station ' + str(station_id) + ' are NOT in DB')
+    def plan_years(self, station_list, table_name, start_year, end_year, csv_only, use_existing_data, TableX,
+                   data_type='rainfall'):
+        """
+        Years each station in a station list is missing. The years already loaded come from one grouped query on
+        the observation table and the years marked empty from one read of the status table (or the stations table
+        if there is no status table), rather than two queries per station. The csv and parquet sinks have no
+        observation table (the parquet store is checked in plan_station) but still skip the empty years.
 
-        return year_list
+        :param TableX: stations table class (as in update_data).
+        :return: {station: [years not in the database]} for every station in station_list.
+        """
+        station_list = list(station_list)
+        all_years = set(range(start_year, end_year))
+        if not use_existing_data:
+            return {station_id: sorted(all_years) for station_id in station_list}
+
+        print('planning ' + str(len(station_list)) + ' stations...')
+        done = defaultdict(set)
+        if Cliflo.has_table(self, table_name) and csv_only == False:
+            # year is text in tables made before the typed schema, the cast works for both
+            for station, year in pd.read_sql('SELECT station, CAST(year AS integer) AS year FROM %s '
+                                             'GROUP BY station, CAST(year AS integer)' % table_name,
+                                             self.engine).itertuples(index=False):
+                done[str(station)].add(int(year))
+
+        if self.status is not None:
+            [done[station].update(years) for station, years in self.status.years(data_type, 'empty').items()]
+        elif Cliflo.has_table(self, TableX.__tablename__):
+            status = pd.read_sql('SELECT * FROM %s' % TableX.__tablename__, self.engine)
+            year_cols = {col: int(re.sub('[^0-9]', '', col)) for col in status.columns if re.sub('[^0-9]', '', col)}
+            for row in status.to_dict('records'):
+                done[str(row['stations'])].update(year for col, year in year_cols.items() if row[col] == 'empty')
+
+        year_plan = {station_id: sorted(all_years - done[str(station_id)]) for station_id in station_list}
+        print(str(sum(len(years) for years in year_plan.values())) + ' station years are NOT in DB')
+        return year_plan
 
     @ staticmethod
     def file_to_df_if_exists(destination_folder, file_name):
-        file = destination_folder + "\\" + file_name
+        file = os.path.join(destination_folder, file_name)
         print('checking file...')
-        try:
-            df = pd.read_csv(file + '.csv')
-            print('yes - csv')
-        except:
+        if os.path.exists(file + '.csv'):
             try:
-                df = pd.read_html(file + 'html')[0]
-                print('yes - html')
-            except:
-                df = False
+                df = pd.read_csv(file + '.csv')
+                print('yes - csv')
+                return df
+            except pd.errors.EmptyDataError:
+                pass
+        if os.path.exists(file + '.html'):
+            df = pd.read_html(file + '.html')[0]
+            print('yes - html')
+            return df
 
-        return df
+        return False
 
     def update_stations_table(self, entry_status, station_id, year, data_type, TableX):
+        if self.status is not None:
+            # buffered, written in batches (see Cliflo_Status)
+            self.status.record(data_type, station_id, year, entry_status)
+            return
         print('updating stations table...')
         col_name = data_type + '_' + str(year)
         self.session.query(TableX).filter(TableX.stations == str(station_id)).update({col_name: str(entry_status)})
@@ -447,16 +1405,37 @@ class Cliflo:
         # Logging into Cliflo Website #
         ###############################
 
+        if self.transport == 'http':
+            session = CH.CliFloSession(self.cf_website, self.cf_username, self.cf_pw, timeout=self.http_timeout)
+            return Cliflo.cf_sign_in(self, session)
+
         driver = webdriver.Chrome(self.webdriver)
         driver.set_page_load_timeout(100)
+        return Cliflo.cf_sign_in(self, driver)
+
+    @CMT.timed('cf_login')
+    def cf_sign_in(self, driver):
+        """
+        Logs in on an open driver (or CliFloSession) and clicks sub_refresh, which resets the row allowance. Used by
+        cf_login and again by cf_relogin. The rows left shown afterwards are read into self.quota.
+        """
+        if isinstance(driver, CH.CliFloSession):
+            driver.login()
+            self.quota.read_page(driver.page_source, login=True)
+            return driver, None
+
+        # an old session would skip the login page
+        driver.delete_all_cookies()
         driver.get(self.cf_website)
+        Cliflo.cf_wait(driver, EC.element_to_be_clickable((By.NAME, 'cusername')), 'login_page')
         driver.find_element_by_name('cusername').send_keys(self.cf_username)
         driver.find_element_by_name('cpwd').send_keys(self.cf_pw)
-        time.sleep(1)
         driver.find_element_by_name('submit').click()
-        time.sleep(1)
-        driver.find_element_by_name('sub_refresh').click()
-        time.sleep(1)
+        refresh = Cliflo.cf_wait(driver, EC.element_to_be_clickable((By.NAME, 'sub_refresh')), 'login_submit')
+        refresh.click()
+        Cliflo.cf_wait(driver, EC.staleness_of(refresh), 'login_refresh', required=False, delay=10)
+        Cliflo.cf_wait(driver, EC.element_to_be_clickable((By.NAME, 'datatype2')), 'login_main_page')
+        self.quota.read_page(driver.page_source, login=True)
         # store current window handle
         main_window_handle = driver.current_window_handle
         driver.switch_to.window(main_window_handle)
@@ -469,109 +1448,236 @@ class Cliflo:
         ############################
         # Selecting Metric we want #
         ############################
+        if isinstance(driver, CH.CliFloSession):
+            driver.specify_data(data_type)
+            return driver, main_window_handle
+
         driver.switch_to.window(main_window_handle)
+        handles = driver.window_handles
         driver.find_element_by_name('datatype2').click()
+        Cliflo.cf_wait(driver, EC.new_window_is_opened(handles), 'datatype_popup')
         driver.switch_to.window(driver.window_handles[-1])
-        driver.find_element_by_link_text("Daily and Hourly Observations").click()
-        time.sleep(1)
-        driver.find_element_by_link_text(Cliflo.data_type_dict[data_type][0]).click()
-        time.sleep(1)
-        driver.find_element_by_link_text(Cliflo.data_type_dict[data_type][1]).click()
-        time.sleep(1)
+        for link in ["Daily and Hourly Observations"] + Cliflo.data_type_dict[data_type]:
+            Cliflo.cf_wait(driver, EC.element_to_be_clickable((By.LINK_TEXT, link)), 'datatype_select').click()
+        # the popup closes itself once the data type has been written back to the main page
+        Cliflo.cf_wait(driver, EC.number_of_windows_to_be(len(handles)), 'datatype_close', required=False, delay=5)
         driver.switch_to.window(main_window_handle)
 
         return driver, main_window_handle
 
     @staticmethod
+    @CMT.timed('cf_get_station_data')
     def cf_get_station_data(driver, main_window_handle, station_id):
+        """Selects a station on the Cliflo query page. station_id can also be a list to select several at once."""
+
+        station_ids = station_id if isinstance(station_id, list) else [station_id]
+        if isinstance(driver, CH.CliFloSession):
+            driver.select_stations(station_ids)
+            return driver
 
         driver.switch_to.window(main_window_handle)
+        handles = driver.window_handles
         driver.find_element_by_name('agent').click()
-        time.sleep(0.3)
+        Cliflo.cf_wait(driver, EC.new_window_is_opened(handles), 'station_popup')
         # Extract station data
         driver.switch_to.window(driver.window_handles[-1])
-        time.sleep(0.3)
-        driver.find_element_by_css_selector("input[type='radio'][value='ag']").click()
-        time.sleep(0.3)
+        Cliflo.cf_wait(driver, EC.element_to_be_clickable((By.CSS_SELECTOR, "input[type='radio'][value='ag']")),
+                       'station_search_form').click()
         driver.find_element_by_name('cAgent').clear()
-        time.sleep(0.3)
-        driver.find_element_by_name('cAgent').send_keys(station_id)
-        time.sleep(0.3)
+        driver.find_element_by_name('cAgent').send_keys(','.join(str(station) for station in station_ids))
         driver.find_element_by_name('Submit').click()
-        time.sleep(0.3)
-        driver.switch_to.window(driver.window_handles[-1])
-        time.sleep(1)
-        driver.find_element_by_xpath(
-            "//input[@name='cstn' and @value='" + str(station_id) + "']").click()
-        time.sleep(0.3)
-        driver.find_element_by_xpath(
-            "//input[@name='Submit' and @value='Replace Selected Stations']").click()
-        time.sleep(0.3)
+        station_boxes = ["//input[@name='cstn' and @value='" + str(station) + "']" for station in station_ids]
+        Cliflo.cf_wait(driver, Cliflo.cf_last_window_has(station_boxes[-1]), 'station_search')
+        [driver.find_element_by_xpath(station_box).click() for station_box in station_boxes]
+        replace = driver.find_element_by_xpath("//input[@name='Submit' and @value='Replace Selected Stations']")
+        replace.click()
+        Cliflo.cf_wait(driver, EC.staleness_of(replace), 'station_replace', required=False, delay=5)
         driver.close()
 
         return driver
 
     @staticmethod
-    def cf_change_year(driver, main_window_handle, year):
+    def cf_change_year(driver, main_window_handle, year, end_year=None):
             ##### Selecting Dates we wnat ####
+            # query runs from 1 Jan year to 1 Jan end_year, which is the following year unless a range is given
+            if end_year is None:
+                end_year = year + 1
+            return Cliflo.cf_change_dates(driver, main_window_handle, datetime.date(year, 1, 1),
+                                          datetime.date(end_year, 1, 1))
+
+    @staticmethod
+    @CMT.timed('cf_change_dates')
+    def cf_change_dates(driver, main_window_handle, start_date, end_date):
+            """Queries the selected stations from midnight on start_date to midnight on end_date (datetime.date)."""
+            if isinstance(driver, CH.CliFloSession):
+                driver.send_dates(start_date, end_date)
+                return driver
 
             driver.switch_to.window(main_window_handle)
+            Cliflo.cf_wait(driver, EC.element_to_be_clickable((By.NAME, 'date1_1')), 'query_form')
             driver.find_element_by_name('date1_1').clear()
             driver.find_element_by_name('date1_2').clear()
             driver.find_element_by_name('date1_3').clear()
             driver.find_element_by_name('date1_4').clear()
 
-            time.sleep(1)
-
             driver.find_element_by_name('date2_1').clear()
             driver.find_element_by_name('date2_2').clear()
             driver.find_element_by_name('date2_3').clear()
             driver.find_element_by_name('date2_4').clear()
 
-            driver.find_element_by_name('date1_1').send_keys(year)
-            driver.find_element_by_name('date1_2').send_keys(1)
-            driver.find_element_by_name('date1_3').send_keys(1)
+            driver.find_element_by_name('date1_1').send_keys(start_date.year)
+            driver.find_element_by_name('date1_2').send_keys(start_date.month)
+            driver.find_element_by_name('date1_3').send_keys(start_date.day)
             driver.find_element_by_name('date1_4').send_keys(00)
 
-            time.sleep(1)
-
-            driver.find_element_by_name('date2_1').send_keys(year+1)
-            driver.find_element_by_name('date2_2').send_keys(1)
-            driver.find_element_by_name('date2_3').send_keys(1)
+            driver.find_element_by_name('date2_1').send_keys(end_date.year)
+            driver.find_element_by_name('date2_2').send_keys(end_date.month)
+            driver.find_element_by_name('date2_3').send_keys(end_date.day)
             driver.find_element_by_name('date2_4').send_keys(00)
 
-            time.sleep(1)
-
             driver.find_element_by_name('submit_sq').click()
             delay = 360  # seconds
-            WebDriverWait(driver, delay).until(EC.presence_of_element_located((By.LINK_TEXT, 'CliFlo Home')))
+            # an expired session comes back to the login page, which cf_query logs in again from
+            Cliflo.cf_wait(driver, lambda d: d.find_elements_by_link_text('CliFlo Home') or
+                           d.find_elements_by_name('cusername'), 'query', delay=delay)
 
             return driver
 
+    def cf_query(self, driver, main_window_handle, station_ids, start_date, end_date, data_type, rows):
+        """
+        Queries the selected stations from start_date to end_date (see cf_change_dates), returns the results table
+        (see cf_get_data) and goes back to the query form. Keeps the row allowance topped up (see Cliflo_Quota): if
+        the query could take the rows left below refresh_below it logs in again first, and if Cliflo sends back its
+        allowance or login page instead of results it logs in again and sends the query once more.
+
+        :param station_ids: stations selected on Cliflo, selected again after logging in.
+        :param rows: most rows the query can return.
+        :return: dataframe of the results table.
+        """
+        for attempt in range(2):
+            if self.quota.needs_refresh(rows):
+                Cliflo.cf_relogin(self, driver, main_window_handle, data_type, station_ids, rows)
+            Cliflo.cf_change_dates(driver, main_window_handle, start_date, end_date)
+            reason = self.quota.read_page(driver.page_source)
+            if reason is None:
+                cf_df = Cliflo.cf_get_data(driver, data='station_obs', data_type=data_type, parser=self.parser)
+                driver.back()
+                self.quota.use(len(cf_df))
+                return cf_df
+            if reason == 'row_limit':
+                driver.back()
+                raise ValueError('Cliflo row limit exceeded for stations ' + str(station_ids) + ' from ' +
+                                 str(start_date) + ' to ' + str(end_date) + ', lower row_limit')
+            if attempt:
+                raise CQ.QuotaError(reason, 'Cliflo ' + reason + ' page again after logging in, rows: ' +
+                                    str(self.quota.summary()))
+            print('Cliflo sent its ' + reason + ' page, logging in again')
+            Cliflo.cf_relogin(self, driver, main_window_handle, data_type, station_ids, rows)
+
+    def cf_relogin(self, driver, main_window_handle, data_type, station_ids, rows):
+        """
+        Logs in again on the same driver, refreshing the row allowance, then selects data_type and station_ids again.
+        Raises Cliflo_Quota.QuotaError if there are still not enough rows left for a query of rows.
+        """
+        print('logging in to CliFlo again to refresh the row allowance')
+        Cliflo.cf_sign_in(self, driver)
+        if not self.quota.refreshed(rows):
+            raise CQ.QuotaError('allowance', 'Cliflo row allowance used up, ' + str(self.quota.rows_left) +
+                                ' rows left after refreshing')
+        Cliflo.cf_specify_data(data_type, driver, main_window_handle)
+        Cliflo.cf_get_station_data(driver, main_window_handle, station_ids)
+
     @staticmethod
+    @CMT.timed('cf_get_data')
     def cf_get_data(driver, **kwargs):
         """
         Gets table from cliflo as a data frame then cleans the data frame if it is not empty.
         :param driver:
         :param kwargs:
-        :return:
+            - data: 'station_list' or 'station_obs'.
+            - data_type & parser: with parser='stream' station_obs tables are parsed by Cliflo_Parser for data_type
+                                  instead of pd.read_html.
+        :return: the table as a dataframe, empty if Cliflo found no rows. Raises Cliflo_Parser.ResultsPageError if
+                 the page has no results table and does not say no rows were found.
         """
         data = kwargs.get('data', 'NA')
+        data_type = kwargs.get('data_type', 'rainfall')
+        stream = data == 'station_obs' and kwargs.get('parser', 'read_html') == 'stream'
+
+        if isinstance(driver, CH.CliFloSession):
+            # the query has already been sent so the page is here, it only needs parsing
+            if stream:
+                return CP.parse_obs_table(driver.page_source, data_type)
+            table = driver.get_table(data)
+            if table is False:
+                if CP.ObsTableParser.no_rows_re.search(driver.page_source):
+                    return pd.DataFrame()
+                raise CP.ResultsPageError('no ' + data + ' table on the results page')
+            return pd.read_html(io.StringIO(table))[0]
+
         delay = 1000  # seconds
-        WebDriverWait(driver, delay).until(EC.presence_of_element_located((By.LINK_TEXT, 'CliFlo Home')))
-        time.sleep(0.3)
+        Cliflo.cf_wait(driver, EC.presence_of_element_located((By.LINK_TEXT, 'CliFlo Home')), 'results_page',
+                       delay=delay)
 
         if data == 'station_list':
-            table = driver.find_element_by_xpath(
-                "//form[@action='/pls/niwp/wstn.update_stn_query']/table[1]").get_attribute('outerHTML')
-
+            xpath = "//form[@action='/pls/niwp/wstn.update_stn_query']/table[1]"
         elif data == 'station_obs':
-            table = driver.find_element_by_xpath("//table[3]").get_attribute('outerHTML')
+            xpath = "//table[3]"
 
-        df = pd.read_html(table)[0]
+        Cliflo.cf_wait(driver, EC.presence_of_element_located((By.XPATH, xpath)), 'results_table', required=False,
+                       delay=5)
+        table = driver.find_element_by_xpath(xpath).get_attribute('outerHTML')
+        if stream:
+            return CP.parse_obs_table(table, data_type)
+
+        df = pd.read_html(io.StringIO(table))[0]
 
         return df
 
+    @staticmethod
+    def cf_wait(driver, condition, step, delay=30, required=True):
+        """
+        Waits until condition is true on the current page and adds the time it took to Cliflo.wait_log under step.
+
+        :param driver: selenium webdriver
+        :param condition: an expected_conditions object or any function of the driver, same as WebDriverWait.until
+        :param step: name to record the wait under
+        :param delay: longest time to wait in seconds
+        :param required: if False a timeout is recorded and returns False instead of raising TimeoutException. Used
+                         for steps where the page may or may not change (e.g a popup closing itself).
+        :return: whatever the condition returned (usually the element)
+        """
+        start = time.perf_counter()
+        try:
+            result = WebDriverWait(driver, delay).until(condition)
+        except TimeoutException:
+            Cliflo.wait_log[step + '_timeout'].append(time.perf_counter() - start)
+            if required:
+                raise
+            return False
+        Cliflo.wait_log[step].append(time.perf_counter() - start)
+        return result
+
+    @staticmethod
+    def cf_last_window_has(xpath):
+        """Wait condition for pages that can open in a new window: switches to the newest window and looks for xpath."""
+
+        def condition(driver):
+            driver.switch_to.window(driver.window_handles[-1])
+            return driver.find_elements_by_xpath(xpath)
+
+        return condition
+
+    @staticmethod
+    def wait_summary():
+        """Count, total, mean and max seconds waited for each page step as a dataframe, slowest total first."""
+
+        summary = pd.DataFrame([{'step': step, 'count': len(times), 'total_s': sum(times),
+                                 'mean_s': sum(times) / len(times), 'max_s': max(times)}
+                                for step, times in list(Cliflo.wait_log.items()) if times],
+                               columns=['step', 'count', 'total_s', 'mean_s', 'max_s'])
+        return summary.sort_values('total_s', ascending=False).reset_index(drop=True)
+
     @staticmethod
     def analyse_cf_data(cf_df, data_type, col):
 
@@ -581,9 +1687,14 @@ class Cliflo:
         if cf_df.empty:
             df_status = 'empty'
         else:
-            df = Cliflo.station_obs_preprocess(cf_df, data_type)
-            df_status = str(df.loc[df[df_metric] == np.nan, df_metric].count() /
-                            len(df[df_metric]))
+            # already preprocessed frames have a rowid
+            df = cf_df if 'rowid' in cf_df.columns else Cliflo.station_obs_preprocess(cf_df, data_type)
+            # missing values are filled in by station_obs_preprocess, the _estimated flag records which they were
+            if df_metric + '_estimated' in df.columns:
+                missing = df[df_metric + '_estimated'].astype(str) == '1'
+            else:
+                missing = df[df_metric].isna()
+            df_status = str(missing.sum() / len(df[df_metric]))
             print('% empty: ', df_status)
 
         return df_status
@@ -595,19 +1706,28 @@ class Cliflo:
         if not os.path.exists(destination_folder):
             os.makedirs(destination_folder)
         if not df.empty:
-            df.to_csv(destination_folder+'\\'+file_name+'.csv', encoding='utf-8', index=False)
+            df.to_csv(os.path.join(destination_folder, file_name + '.csv'), encoding='utf-8', index=False)
 
     @staticmethod
     def station_obs_quick_clean(df):
+        if df.empty:
+            return df
+        if 'Date(NZST)' in df.columns:
+            # already has its header (Cliflo_Parser), a csv read back can turn the station numbers into ints
+            df['Station'] = df['Station'].astype(str)
+            df['Date(NZST)'] = df['Date(NZST)'].astype(str)
+            return df
         df.columns = df.iloc[1]
         df.drop([0, 1], axis=0, inplace=True)
         df.reset_index(inplace=True)
         return df
 
+    @CMT.timed('df_to_db')
     def df_to_db(self, x, table_name, data_type, station_id, year, use_existing):
         """
         STAGE 1:    Loads html file into a pandas dataframe, checks table exists otherwise creates table.
-        STAGE 3:    Only adds dataframe rows to database if those rows are not already in it.
+        STAGE 3:    Loads the rows with copy_df_to_db. With use_existing rows already in the table are kept, otherwise
+                    they are replaced.
 
         :param html_file: html_file from Cliflo to be sent to database
         :param table_name: table name of where file will be downloaded.
@@ -617,23 +1737,140 @@ class Cliflo:
         status = False
         # will not add empty data frame to database
         if not x.empty:
-            # Clean dataframe into a method that allows for analysis
-            x = Cliflo.station_obs_preprocess(x, data_type)
+            # Clean dataframe into a method that allows for analysis (unless run_data_update already has)
+            if 'rowid' not in x.columns:
+                x = Cliflo.station_obs_preprocess(x, data_type)
             # creates database if not already in
-            if not self.engine.dialect.has_table(self.engine, table_name):
-                Cliflo.create_table(self, table_name, x, 'rowid')
-            if use_existing:
-                # Creates a dataframe of values not already in table
-                clean_df = Cliflo.clean_df_db_dups(x, table_name, self.engine, dup_cols=['rowid'])
-            else:
-                pass
-            # TODO create finction that removes rows in table so new values can be added in next step
-            # Writes data into a database
-            clean_df.to_sql(table_name, self.engine, if_exists='append', index=False)
+            with self.table_lock:
+                if not Cliflo.has_table(self, table_name):
+                    Cliflo.create_typed_table(self, Cliflo.obs_table_schema(table_name, data_type))
+            # Writes data into a database, the database skips (or replaces) rows it already has
+            Cliflo.copy_df_to_db(x, table_name, self.engine, update=not use_existing)
             status = True
             print('uploaded to database sucessfully')
         return status
 
+    @CMT.timed('df_to_store')
+    def df_to_store(self, x, data_type, station_id, year):
+        """Cleans a station year the same way as df_to_db and writes it to the parquet store."""
+
+        print('running station ' + str(station_id) + ' year ' + str(year) + ' to parquet store')
+        if x.empty:
+            return False
+        if 'rowid' not in x.columns:
+            x = Cliflo.station_obs_preprocess(x, data_type)
+        self.store.write(x, data_type)
+        return True
+
+    def fill_gaps(self, **kwargs):
+        """
+        Re-estimates every estimated value of a data_type from its neighbouring stations (see Cliflo_Gaps) across the
+        whole observation table or parquet store at once, rather than one downloaded file at a time.
+
+        :param kwargs:
+            - data_type: keyword for station_clean_dict so either 'rainfall', 'sunshine_hours' etc.
+            - table_name: observation table to fill when sink='db'.
+            - sink: 'db' (default) or 'parquet', same as update_data.
+            - parquet_folder: folder (or Cliflo_Store.ParquetStore) for the parquet sink.
+            - stations: excel file or dataframe of stations with AgentNumber, lat and long (as from
+                        extract_stations). Default is False which reads them from station_table_name.
+            - station_table_name: stations table with the lat / long set by update_lat_long.
+            - k, power & max_km: neighbours to use, inverse distance power and furthest neighbour in km. Defaults
+                                 are 5, 2 and 100.
+        :return: number of rows re-estimated.
+        """
+        data_type = kwargs.get('data_type', 'rainfall')
+        table_name = kwargs.get('table_name', 'niwa_rainfall')
+        sink = kwargs.get('sink', 'db')
+        parquet_folder = kwargs.get('parquet_folder', None)
+        station_info = kwargs.get('stations', False)
+        station_table_name = kwargs.get('station_table_name', 'NA')
+        k = kwargs.get('k', 5)
+        power = kwargs.get('power', 2)
+        max_km = kwargs.get('max_km', 100)
+        vals = Cliflo.station_clean_dict[data_type][1]
+
+        if station_info is False:
+            stations = pd.read_sql('SELECT stations, lat, long FROM %s' % station_table_name, self.engine)
+        else:
+            stations = pd.read_excel(station_info) if type(station_info) is str else station_info
+            stations = stations.rename(columns={'AgentNumber': 'stations'})[['stations', 'lat', 'long']]
+
+        if sink == 'parquet':
+            store = CS.ParquetStore(parquet_folder) if type(parquet_folder) is str else parquet_folder or self.store
+            obs = store.read(data_type)
+        else:
+            cols = ['rowid', 'station', 'year', 'month', 'day'] + vals + [val + '_estimated' for val in vals]
+            obs = pd.read_sql('SELECT %s FROM %s' % (', '.join('"%s"' % col for col in cols), table_name),
+                              self.engine)
+        print('filling gaps in ' + str(len(obs)) + ' ' + data_type + ' observations')
+
+        df, changed = CG.fill_gaps(obs, stations, data_type, k=k, power=power, max_km=max_km)
+        if not changed.any():
+            return 0
+
+        if sink == 'parquet':
+            # the store replaces whole station years so write back every row of the ones that changed
+            partitions = df.loc[changed, ['station', 'year']].drop_duplicates()
+            store.write(df.merge(partitions, on=['station', 'year']), data_type)
+        else:
+            # values go into a staging table and the observation table is updated from it in one statement
+            stage = df.loc[changed, ['rowid'] + vals]
+            stage[vals] = stage[vals].apply(pd.to_numeric, errors='coerce')
+            stage_name = table_name + '_gap_fill'
+            with self.engine.begin() as conn:
+                stage.to_sql(stage_name, conn, if_exists='replace', index=False)
+                conn.execute(text('UPDATE %s AS t SET %s FROM %s AS s WHERE t.rowid = s.rowid'
+                                  % (table_name, ', '.join('"%s" = s."%s"' % (val, val) for val in vals),
+                                     stage_name)))
+                conn.execute(text('DROP TABLE %s' % stage_name))
+        print(str(int(changed.sum())) + ' rows re-estimated from neighbouring stations')
+        return int(changed.sum())
+
+    @staticmethod
+    def copy_df_to_db(df, tablename, engine, update=False, key='rowid'):
+        """
+        Loads a dataframe into a table with PostgreSQL COPY. Rows are copied into a temporary staging table then
+        merged with INSERT ... ON CONFLICT on the key, so the keys already in the table are never read back into
+        python (see clean_df_db_dups, which this replaces in df_to_db).
+
+        Required:
+            df: dataframe with a subset of the table's columns, including key.
+            tablename: table to load, key must be its primary key.
+            engine: SQLAlchemy engine object (psycopg2).
+        Optional:
+            update: replace rows already in the table (DO UPDATE) rather than keep them (DO NOTHING).
+            key: primary key column. Default is rowid.
+        Returns
+            number of rows inserted (or updated).
+        """
+        df = df.drop_duplicates(key, keep='last')
+        cols = ', '.join('"%s"' % col for col in df.columns)
+        if update:
+            conflict = 'DO UPDATE SET ' + ', '.join('"%s" = excluded."%s"' % (col, col) for col in df.columns
+                                                    if col != key)
+        else:
+            conflict = 'DO NOTHING'
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+
+        conn = engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute('CREATE TEMP TABLE cliflo_stage (LIKE %s INCLUDING DEFAULTS) ON COMMIT DROP' % tablename)
+            cur.copy_expert('COPY cliflo_stage (%s) FROM STDIN WITH (FORMAT csv)' % cols, buffer)
+            cur.execute('INSERT INTO %s (%s) SELECT %s FROM cliflo_stage ON CONFLICT ("%s") %s'
+                        % (tablename, cols, cols, key, conflict))
+            rows = cur.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return rows
+
     @staticmethod
     def clean_df_db_dups(df, tablename, engine, dup_cols=[],
                          filter_continuous_col=None, filter_categorical_col=None):
@@ -680,34 +1917,72 @@ class Cliflo:
         df.drop(['_merge'], axis=1, inplace=True)
         return df
 
+    @staticmethod
+    def station_obs_batch(raw_dfs, data_type):
+        """
+        Quick cleans and preprocesses a list of raw downloads in one station_obs_preprocess_batch call. The raw
+        frames are left as they are. Empty downloads give None so run_data_update treats them as before.
+
+        :return: list of cleaned frames (or None) in the same order as raw_dfs.
+        """
+        dfs = [Cliflo.station_obs_quick_clean(df.copy()) for df in raw_dfs]
+        full = [n for n, df in enumerate(dfs) if not df.empty]
+        clean_dfs = [None] * len(dfs)
+        if full:
+            for n, clean_df in zip(full, Cliflo.station_obs_preprocess_batch([dfs[n] for n in full], data_type)):
+                clean_dfs[n] = clean_df
+        return clean_dfs
+
     @staticmethod
     def station_obs_preprocess(df, data_type):
+        """Cleans one station year of quick cleaned Cliflo data, see station_obs_preprocess_batch."""
+
+        return Cliflo.station_obs_preprocess_batch([df], data_type)[0]
 
-        print('preprocess')
-        #striping out day month and year
-        df['year'] = df['Date(NZST)'].str[:4]
-        df['month'] = df['Date(NZST)'].str[4:6]
-        df['day'] = df['Date(NZST)'].str[6:8]
-        for val in Cliflo.station_clean_dict[data_type][1]:
-            df[val+'_estimated'] = str(0)
-
-        # Make sure that there is no missing  rows - if so add them.
-        period = pd.Period('2018', freq='Y')
-        x = pd.Series(pd.DatetimeIndex(start=period.start_time, end=period.end_time, freq='D')).to_frame('date')
-        x['year'], x['month'], x['day'] = x['date'].astype(str).str.split('-', 2).str
-        z = x.merge(df, how='right')
-        z.rename(columns=Cliflo.station_clean_dict[data_type][0], inplace=True)
-        z.fillna('-', inplace=True)
+    @staticmethod
+    @CMT.timed('station_obs_preprocess')
+    def station_obs_preprocess_batch(dfs, data_type):
+        """
+        Cleans many station years at once. The frames are stacked and every step is done on whole columns:
+            - day, month and year are sliced out of Date(NZST).
+            - values that are missing ('-' on Cliflo) are flagged in val_estimated ('1', otherwise '0') and filled
+              with the median of their own frame (station year).
+            - rowid is data_type + station + year + month + day.
+        Rows are kept as they are, no rows are added for days Cliflo did not return (the old calendar merge was a
+        right join so it never added any).
+
+        :param dfs: list of quick cleaned frames (see station_obs_quick_clean), one per station year.
+        :param data_type: keyword for station_clean_dict so either 'rainfall', 'sunshine_hours' etc.
+        :return: list of cleaned frames in the same order as dfs, each the same as station_obs_preprocess gives.
+        """
+        print('preprocess ' + str(len(dfs)) + ' station years')
+        rename = Cliflo.station_clean_dict[data_type][0]
+        vals = Cliflo.station_clean_dict[data_type][1]
+        source = {new: old for old, new in rename.items()}
+        cols = (['rowid', 'day', 'year', 'month', 'station'] + vals + [val + '_estimated' for val in vals])
+
+        lengths = [len(df) for df in dfs]
+        if sum(lengths) == 0:
+            return [pd.DataFrame(columns=cols) for df in dfs]
+        df = pd.concat([df for df in dfs if len(df)], ignore_index=True, sort=False)
+        # which station year each row came from, used for the medians and to split the result back up
+        group = np.repeat(np.arange(len(dfs)), lengths)
+
+        date = df['Date(NZST)'].fillna('-').astype(str)
+        z = pd.DataFrame({'day': date.str[6:8], 'year': date.str[:4], 'month': date.str[4:6],
+                          'station': df[source['station']].fillna('-').astype(str)})
         # applying an average for misssing data
         # TODO make this into a multivariate anlaysis as an average is incorrect for rainfall
-        for val in Cliflo.station_clean_dict[data_type][1]:
-            z.loc[z[val] == '-', val+'_estimated'] = str(1)
-        [z[val].replace({'-': np.nan}, inplace=True) for val in Cliflo.station_clean_dict[data_type][1]]
-        [z[val].fillna((z[val].median()), inplace=True) for val in Cliflo.station_clean_dict[data_type][1]]
-        z['station'].fillna((z['station'].mode()), inplace=True)
-        z['rowid'] = data_type + z[['station', 'year', 'month', 'day']].apply(lambda p: ''.join(p), axis=1)
-        cols = (['rowid', 'day', 'year', 'month', 'station']
-                + [val for val in Cliflo.station_clean_dict[data_type][1]]
-                + [val + '_estimated' for val in Cliflo.station_clean_dict[data_type][1]])
+        for val in vals:
+            values = df[source[val]].fillna('-') if source[val] in df.columns else pd.Series('-', index=df.index)
+            missing = (values == '-').to_numpy()
+            numbers = pd.to_numeric(values.where(~missing), errors='coerce')
+            medians = numbers.groupby(group).transform('median')
+            z[val] = values.where(~missing, medians)
+            z[val + '_estimated'] = np.where(missing, '1', '0')
+        z['rowid'] = data_type + z['station'] + z['year'] + z['month'] + z['day']
+        z = z[cols]
+
+        ends = np.cumsum(lengths)
         print('preprocess sucessful')
-        return z[cols]
\ No newline at end of file
+        return [z.iloc[end - n:end].reset_index(drop=True) for n, end in zip(lengths, ends)]
\ No newline at end of file
@@ -0,0 +1,344 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Benchmarks
+Status:        In Progress
+Maintained:    Yes
+Overview:      Benchmarks for the slow parts of the Cliflo pipeline. Results are returned as dicts and appended to a
+               json lines file, with the git commit they were run on, so runs can be compared between versions.
+                   - bench_pipeline: clean_stations, parsing result pages (pd.read_html and Cliflo_Parser),
+                     station_obs_quick_clean, station_obs_preprocess, analyse_cf_data and (given a database)
+                     clean_df_db_dups and the database write paths, at several numbers of station years. Runs on
+                     saved Cliflo result pages (.html files, whole pages or just the observation table) or on
+                     synthetic ones made here. tests/fixtures/cliflo has three one station year rainfall pages in
+                     the Cliflo layout with made up values.
+                   - bench_db_load: loading station years into an observation table that already holds a lot of rows,
+                     the old clean_df_db_dups + to_sql path against Cliflo.copy_df_to_db.
+                   - compare_results: each benchmark's latest version against the one before it, flagging the ones
+                     that got slower.
+How to use:    python Cliflo_Benchmarks.py pipeline [--fixtures <folder of .html pages>] [--scales 1,10,100]
+                                                    [--db <database url>] [--results <file>]
+               python Cliflo_Benchmarks.py db_load <database url> [--rows 10000000] [--results <file>]
+               python Cliflo_Benchmarks.py compare [--results <file>] [--threshold 1.2]
+               e.g. python Cliflo_Benchmarks.py pipeline --fixtures ../tests/fixtures/cliflo
+                    python Cliflo_Benchmarks.py db_load postgresql+psycopg2://user:pw@127.0.0.1:5432/sandpit
+Requirements:  PostgreSQL database for the database benchmarks (the benchmark tables are dropped afterwards).
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+from sqlalchemy                 import create_engine, text
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+import Cliflo
+import Cliflo_Parser as CP
+
+#############
+# FUNCTIONS #
+#############
+
+obs_cols = ['rowid', 'day', 'year', 'month', 'station', 'amount_mm', 'amount_mm_estimated']
+
+
+def make_obs_table(engine, table_name, rows):
+    """
+    Creates a rainfall observation table the way Cliflo.create_table does (text columns, rowid primary key) and
+    fills it with rows of made up data, 10 years per station starting at station 100000, generated in the database.
+    """
+    with engine.begin() as conn:
+        conn.execute(text('DROP TABLE IF EXISTS %s' % table_name))
+        conn.execute(text('CREATE TABLE %s (%s)' % (table_name, ', '.join(
+            '"%s" VARCHAR%s' % (col, ' PRIMARY KEY' if col == 'rowid' else '') for col in obs_cols))))
+        conn.execute(text("""
+            INSERT INTO {0}
+            SELECT 'rainfall' || station || to_char(d, 'YYYYMMDD'), to_char(d, 'DD'), to_char(d, 'YYYY'),
+                   to_char(d, 'MM'), station::text, round((random() * 20)::numeric, 1)::text, '0'
+            FROM (SELECT 100000 + g / 3653 AS station, date '1990-01-01' + (g % 3653) AS d
+                  FROM generate_series(0, :rows - 1) AS g) AS s""".format(table_name)), {'rows': rows})
+        conn.execute(text('ANALYZE %s' % table_name))
+
+
+def station_year_frame(station, year, seed=0):
+    """A cleaned station year (the same columns as Cliflo.station_obs_preprocess gives) of made up rainfall."""
+
+    days = pd.date_range(str(year) + '-01-01', str(year) + '-12-31')
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'day': days.strftime('%d'), 'year': days.strftime('%Y'), 'month': days.strftime('%m'),
+                       'station': str(station), 'amount_mm': np.round(rng.random(len(days)) * 20, 1).astype(str),
+                       'amount_mm_estimated': '0'})
+    df.insert(0, 'rowid', 'rainfall' + df['station'] + df['year'] + df['month'] + df['day'])
+    return df
+
+
+def bench_db_load(engine, rows=10000000, loads=5, table_name='cliflo_bench_obs'):
+    """
+    Times loading new station years into an observation table of rows rows, then loading the same station years
+    again (every row already there), with the old and new loaders.
+
+    :param loads: station years loaded by each loader.
+    :return: dict of results, times are mean seconds per station year.
+    """
+    print('building table of ' + str(rows) + ' rows...')
+    start = time.perf_counter()
+    make_obs_table(engine, table_name, rows)
+    results = {'benchmark': 'db_load', 'table_rows': rows, 'loads': loads,
+               'build_s': time.perf_counter() - start}
+
+    def old_path(df):
+        clean_df = Cliflo.Cliflo.clean_df_db_dups(df.copy(), table_name, engine, dup_cols=['rowid'])
+        clean_df.to_sql(table_name, engine, if_exists='append', index=False)
+
+    def new_path(df):
+        Cliflo.Cliflo.copy_df_to_db(df, table_name, engine)
+
+    for name, load, first_station in [('old', old_path, 900000), ('copy', new_path, 950000)]:
+        frames = [station_year_frame(first_station + n, 2000, seed=n) for n in range(loads)]
+        for run in ['new', 'existing']:
+            start = time.perf_counter()
+            [load(df) for df in frames]
+            results[name + '_' + run + '_s'] = (time.perf_counter() - start) / loads
+            print(name + ' ' + run + ': ' + str(round(results[name + '_' + run + '_s'], 3)) + 's per station year')
+
+    with engine.connect() as conn:
+        results['rows_after'] = conn.execute(text('SELECT count(*) FROM %s' % table_name)).scalar()
+    with engine.begin() as conn:
+        conn.execute(text('DROP TABLE %s' % table_name))
+    results['speed_up'] = results['old_new_s'] / results['copy_new_s']
+    return results
+
+
+def synthetic_obs_page(stations, years, data_type='rainfall', seed=0, missing=0.05):
+    """
+    A Cliflo result page for data_type with a row per day for every station and year, laid out the way cf_get_data
+    finds it (observation table third, a title row then the column names). About missing of the values are '-'.
+    """
+    rng = np.random.default_rng(seed)
+    value_cols = [col for col in Cliflo.Cliflo.station_clean_dict[data_type][0] if col != 'Station']
+    header = ['Station', 'Date(NZST)'] + value_cols + ['Period(Hrs)', 'Freq']
+    rows = []
+    for station in stations:
+        for year in years:
+            days = pd.date_range(str(year) + '-01-01', str(year) + '-12-31').strftime('%Y%m%d:0900')
+            values = np.round(rng.random((len(days), len(value_cols))) * 20, 1).astype(str)
+            values[rng.random(values.shape) < missing] = '-'
+            rows += ['<tr><td>' + '</td><td>'.join([str(station), day] + list(day_values) + ['24', 'D']) +
+                     '</td></tr>' for day, day_values in zip(days, values)]
+    return ('<html><body><table><tr><td>CliFlo Home</td></tr></table><table><tr><td>query</td></tr></table>'
+            '<table><tr><td colspan="' + str(len(header)) + '">' + data_type + ': Daily</td></tr>'
+            '<tr><td>' + '</td><td>'.join(header) + '</td></tr>' + ''.join(rows) + '</table></body></html>')
+
+
+def synthetic_station_page(stations, seed=0):
+    """A Cliflo station search result table (what cf_get_stations reads) of made up stations."""
+
+    rng = np.random.default_rng(seed)
+    header = ['Select', 'Name', 'AgentNumber', 'Network', 'Start Date', 'End Date', 'PercentComplete',
+              'Lat(dec deg)', 'Long(dec deg)']
+    rows = ['<tr><td>' + '</td><td>'.join(['', 'Station ' + str(n), str(100000 + n), 'X' + str(n),
+                                           '01-Jan-' + str(rng.integers(1900, 2000)),
+                                           '31-Dec-' + str(rng.integers(2000, 2020)), str(rng.integers(50, 101)),
+                                           str(round(-47 + rng.random() * 13, 4)),
+                                           str(round(166 + rng.random() * 12, 4))]) + '</td></tr>'
+            for n in range(stations)]
+    return '<table><tr><td>' + '</td><td>'.join(header) + '</td></tr>' + ''.join(rows) + '</table>'
+
+
+def load_fixtures(folder):
+    """Saved Cliflo result pages (.html) in a folder, in name order."""
+
+    pages = []
+    for file_name in sorted(os.listdir(folder)):
+        if file_name.endswith('.html'):
+            with open(os.path.join(folder, file_name), encoding='utf-8') as f:
+                pages.append(f.read())
+    return pages
+
+
+def obs_frame(page):
+    """The observation table of a result page as read_html gives it (what cf_get_data returns)."""
+
+    for df in pd.read_html(io.StringIO(page)):
+        if len(df) > 1 and 'Date(NZST)' in [str(value) for value in df.iloc[1]]:
+            return df
+    return pd.DataFrame()
+
+
+def best_time(run, setup, repeat):
+    """Best of repeat runs of run(setup()) in seconds, setup (e.g copying frames that get changed) is not timed."""
+
+    times = []
+    for n in range(repeat):
+        data = setup()
+        start = time.perf_counter()
+        run(data)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_pipeline(pages=None, data_type='rainfall', scales=(1, 10, 100), engine=None, repeat=3, stations=500,
+                   table_name='cliflo_bench_pipeline'):
+    """
+    Times each cleaning and loading step of a station year at several scales.
+
+    :param pages: recorded result pages (see load_fixtures), each should be one station year. They are repeated to
+                  make up the bigger scales. Default is None (synthetic pages).
+    :param scales: numbers of station years to time each step over.
+    :param engine: database to time clean_df_db_dups and the write paths in. Default is None (skipped).
+    :param stations: size of the synthetic station list for clean_stations.
+    :return: list of result dicts, one per step and scale. A step that raises gets its error instead of a time.
+    """
+    source = 'synthetic' if pages is None else 'fixtures'
+    if pages is None:
+        pages = [synthetic_obs_page([100000 + n], [2000], data_type, seed=n) for n in range(min(max(scales), 50))]
+    raw_dfs = [obs_frame(page) for page in pages]
+    station_page = synthetic_station_page(stations)
+    value_col = Cliflo.Cliflo.station_clean_dict[data_type][1][0]
+    results = []
+
+    def record(step, scale, rows, run, setup):
+        result = {'benchmark': 'pipeline', 'step': step, 'source': source, 'data_type': data_type, 'scale': scale,
+                  'rows': rows}
+        try:
+            result['seconds'] = best_time(run, setup, repeat)
+            result['rows_per_s'] = rows / result['seconds'] if result['seconds'] else None
+        except Exception as e:
+            result['error'] = repr(e)
+        print(step + ' x ' + str(scale) + ': ' + str(result.get('seconds', result.get('error'))))
+        results.append(result)
+
+    record('clean_stations', 1, stations, lambda df: Cliflo.Cliflo.clean_stations(df, 1990, 2018, 90),
+           lambda: pd.read_html(io.StringIO(station_page))[0])
+    for scale in scales:
+        scale_pages = [pages[n % len(pages)] for n in range(scale)]
+        scale_dfs = [raw_dfs[n % len(raw_dfs)] for n in range(scale)]
+        quick_dfs = [Cliflo.Cliflo.station_obs_quick_clean(df.copy()) for df in scale_dfs]
+        rows = sum(len(df) for df in quick_dfs)
+        clean_dfs = Cliflo.Cliflo.station_obs_preprocess_batch(quick_dfs, data_type)
+
+        record('read_html', scale, rows, lambda batch: [obs_frame(page) for page in batch], lambda: scale_pages)
+        record('parse_obs_table', scale, rows, lambda batch: [CP.parse_obs_table(page, data_type) for page in batch],
+               lambda: scale_pages)
+        record('station_obs_quick_clean', scale, rows,
+               lambda dfs: [Cliflo.Cliflo.station_obs_quick_clean(df) for df in dfs],
+               lambda: [df.copy() for df in scale_dfs])
+        record('station_obs_preprocess', scale, rows,
+               lambda dfs: [Cliflo.Cliflo.station_obs_preprocess(df, data_type) for df in dfs], lambda: quick_dfs)
+        record('station_obs_preprocess_batch', scale, rows,
+               lambda dfs: Cliflo.Cliflo.station_obs_preprocess_batch(dfs, data_type), lambda: quick_dfs)
+        record('analyse_cf_data', scale, rows,
+               lambda dfs: [Cliflo.Cliflo.analyse_cf_data(df, data_type, value_col) for df in dfs], lambda: clean_dfs)
+        if engine is None:
+            continue
+
+        # station years are made unique so every row is new to an empty table
+        load_dfs = [df.assign(station=str(200000 + n), rowid=data_type + str(200000 + n) + df['year'] + df['month']
+                              + df['day']) for n, df in enumerate(clean_dfs)]
+
+        def fresh_table(typed):
+            with engine.begin() as conn:
+                conn.execute(text('DROP TABLE IF EXISTS %s' % table_name))
+            if typed:
+                Cliflo.Cliflo.obs_table_schema(table_name, data_type).create(engine)
+            return load_dfs
+
+        record('copy_df_to_db', scale, rows,
+               lambda dfs: [Cliflo.Cliflo.copy_df_to_db(df, table_name, engine) for df in dfs],
+               lambda: fresh_table(True))
+        # every row is already in the table filled by the last copy_df_to_db run
+        record('clean_df_db_dups', scale, rows,
+               lambda dfs: [Cliflo.Cliflo.clean_df_db_dups(df, table_name, engine, dup_cols=['rowid']) for df in dfs],
+               lambda: [df.copy() for df in load_dfs])
+        record('to_sql', scale, rows,
+               lambda dfs: [df.to_sql(table_name, engine, if_exists='append', index=False) for df in dfs],
+               lambda: fresh_table(False))
+
+    if engine is not None:
+        with engine.begin() as conn:
+            conn.execute(text('DROP TABLE IF EXISTS %s' % table_name))
+    return results
+
+
+def code_version():
+    """Git commit the benchmarks are run on, or 'unknown' outside a git checkout."""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write_results(results, path):
+    """Appends a result dict, with when, where and on what version it was run, to a json lines file."""
+
+    results = dict(results, run_at=time.strftime('%Y-%m-%d %H:%M:%S'), host=platform.node(),
+                   python=platform.python_version(), pandas=pd.__version__, version=code_version())
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(results) + '\n')
+    return results
+
+
+def compare_results(path, threshold=1.2):
+    """
+    Compares the latest version of every benchmark in a results file with the version run before it (on the same
+    host, data and scale).
+
+    :param threshold: ratio of new to old seconds above which a result is flagged as a regression. Default is 1.2.
+    :return: dataframe of old and new seconds, their ratio and whether it is a regression.
+    """
+    df = pd.read_json(path, lines=True)
+    if 'seconds' not in df.columns:
+        return pd.DataFrame()
+    df = df[df['seconds'].notna()]
+    keys = [col for col in ['benchmark', 'step', 'source', 'data_type', 'scale', 'host'] if col in df.columns]
+    df = df.fillna({key: '' for key in keys})
+    # best time of each version, versions in the order they were first run
+    runs = df.groupby(keys + ['version'], sort=False).agg(seconds=('seconds', 'min'),
+                                                         run_at=('run_at', 'min')).reset_index()
+    runs = runs.sort_values('run_at')
+    last_two = runs.groupby(keys).tail(2)
+    old = last_two.groupby(keys).nth(0).set_index(keys)
+    new = last_two.groupby(keys).nth(-1).set_index(keys)
+    compare = old[['version', 'seconds']].join(new[['version', 'seconds']], lsuffix='_old', rsuffix='_new')
+    compare = compare[compare['version_old'] != compare['version_new']]
+    compare['ratio'] = compare['seconds_new'] / compare['seconds_old']
+    compare['regression'] = compare['ratio'] > threshold
+    return compare.reset_index().sort_values('ratio', ascending=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cliflo pipeline benchmarks.')
+    parser.add_argument('benchmark', choices=['pipeline', 'db_load', 'compare'])
+    parser.add_argument('db', nargs='?', default=None, help='database url, needed for db_load')
+    parser.add_argument('--db', dest='db_option', default=None, help='database url for the pipeline database steps')
+    parser.add_argument('--fixtures', default=None, help='folder of recorded result pages (default synthetic)')
+    parser.add_argument('--data-type', default='rainfall')
+    parser.add_argument('--scales', default='1,10,100', help='station years to run each step over')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=10000000, help='rows in the table for db_load')
+    parser.add_argument('--results', default='cliflo_benchmarks.jsonl')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args()
+    db_url = args.db_option or args.db
+
+    if args.benchmark == 'pipeline':
+        [write_results(result, args.results) for result in
+         bench_pipeline(load_fixtures(args.fixtures) if args.fixtures else None, args.data_type,
+                        [int(scale) for scale in args.scales.split(',')],
+                        create_engine(db_url) if db_url else None, args.repeat)]
+    elif args.benchmark == 'db_load':
+        print(write_results(bench_db_load(create_engine(db_url), args.rows), args.results))
+    if os.path.exists(args.results):
+        comparison = compare_results(args.results, args.threshold)
+        print(comparison.to_string(index=False) if not comparison.empty else 'nothing to compare yet')
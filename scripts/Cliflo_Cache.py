@@ -0,0 +1,160 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Cache
+Status:        In Progress
+Maintained:    Yes
+Overview:      Compressed cache of raw Cliflo downloads, used by Cliflo.update_data in place of the loose per station
+               per year csv files. Each download is stored once as a gzipped csv named after its sha256 checksum
+               (so identical downloads share a file) and an index maps (data_type, freq, station, start, end) to the
+               checksum, row count and when it was fetched. Lookups are a dictionary hit on the index rather than
+               trying to open files. Empty downloads are recorded too so they are not downloaded again.
+How to use:    cliflo.update_data(..., cache='C:\\data\\cliflo_cache')
+               RawCache(folder).import_folder(old_csv_folder) copies existing csv downloads into the cache.
+Requirements:  NA
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import pandas as pd
+
+###########
+# CLASSES #
+###########
+
+
+class RawCache:
+    """
+    Content addressed cache of raw Cliflo tables.
+
+    The index is an append only json lines file (index.jsonl), one entry per download, the last entry for a key
+    wins. Appending keeps writes O(1) however big the cache gets.
+    """
+
+    file_pattern = re.compile(r'station (\w+) - (\w+) - (\w+) \((\d+) - (\d+)\)\.csv$')
+
+    def __init__(self, folder, **kwargs):
+        """
+        :param folder: folder to keep the cache in, created if it does not exist.
+        :param kwargs:
+            - verify: check the checksum of a file each time it is read. Default is True.
+            - compress_level: gzip level 1 - 9. Default is 6.
+        """
+        self.folder = folder
+        self.verify = kwargs.get('verify', True)
+        self.compress_level = kwargs.get('compress_level', 6)
+        self.index_file = os.path.join(folder, 'index.jsonl')
+        self.lock = threading.Lock()
+        self.index = {}
+
+        if not os.path.exists(os.path.join(folder, 'objects')):
+            os.makedirs(os.path.join(folder, 'objects'))
+        if os.path.exists(self.index_file):
+            with open(self.index_file, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.index[entry['key']] = entry
+
+    @staticmethod
+    def cache_key(data_type, freq, station, start, end):
+        return '|'.join([data_type, freq, str(station), str(start), str(end)])
+
+    def object_path(self, checksum):
+        return os.path.join(self.folder, 'objects', checksum[:2], checksum + '.csv.gz')
+
+    def get(self, data_type, freq, station, start, end):
+        """
+        Returns the cached raw table as a dataframe (empty if the download was empty), or False if it is not in the
+        cache or the file does not match its checksum.
+        """
+        entry = self.index.get(RawCache.cache_key(data_type, freq, station, start, end))
+        if entry is None:
+            return False
+        if entry['sha256'] is None:
+            return pd.DataFrame()
+
+        with gzip.open(RawCache.object_path(self, entry['sha256']), 'rb') as f:
+            raw = f.read()
+        if self.verify and hashlib.sha256(raw).hexdigest() != entry['sha256']:
+            print('cache checksum does not match for ' + entry['key'] + ', ignoring cached copy')
+            return False
+        return pd.read_csv(io.BytesIO(raw))
+
+    def put(self, df, data_type, freq, station, start, end, fetched_at=None):
+        """Stores a raw table under its key and returns the index entry."""
+
+        key = RawCache.cache_key(data_type, freq, station, start, end)
+        checksum = None
+        size = 0
+        if not df.empty:
+            raw = df.to_csv(index=False).encode('utf-8')
+            checksum = hashlib.sha256(raw).hexdigest()
+            path = RawCache.object_path(self, checksum)
+            if not os.path.exists(path):
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                # write then rename so a crash never leaves a half written file under a good checksum
+                tmp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+                with gzip.open(tmp_path, 'wb', compresslevel=self.compress_level) as f:
+                    f.write(raw)
+                os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+
+        entry = {'key': key, 'sha256': checksum, 'rows': len(df), 'bytes': size,
+                 'fetched_at': fetched_at if fetched_at is not None else time.time()}
+        with self.lock:
+            with open(self.index_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.index[key] = entry
+        return entry
+
+    def import_folder(self, folder):
+        """
+        Adds every csv download in folder (named the way Cliflo.cf_file_name names them) to the cache. Files are
+        left where they are so they can be deleted once the cache has been checked.
+
+        :return: number of files imported.
+        """
+        imported = 0
+        for file_name in os.listdir(folder):
+            match = RawCache.file_pattern.match(file_name)
+            if match is None:
+                continue
+            station, data_type, freq, start, end = match.groups()
+            path = os.path.join(folder, file_name)
+            RawCache.put(self, pd.read_csv(path), data_type, freq, station, int(start), int(end),
+                         fetched_at=os.path.getmtime(path))
+            imported += 1
+        print(str(imported) + ' files imported into the cache')
+        return imported
+
+    def compact(self):
+        """Rewrites the index with only the latest entry for each key."""
+
+        with self.lock:
+            with open(self.index_file + '.tmp', 'w', encoding='utf-8') as f:
+                [f.write(json.dumps(entry) + '\n') for entry in self.index.values()]
+            os.replace(self.index_file + '.tmp', self.index_file)
+
+    def summary(self):
+        """Entries, rows and compressed size on disk, as a dict."""
+
+        checksums = set(entry['sha256'] for entry in self.index.values() if entry['sha256'])
+        return {'entries': len(self.index),
+                'empty': sum(1 for entry in self.index.values() if entry['sha256'] is None),
+                'rows': sum(entry['rows'] for entry in self.index.values()),
+                'files': len(checksums),
+                'bytes': sum(os.path.getsize(RawCache.object_path(self, checksum)) for checksum in checksums)}
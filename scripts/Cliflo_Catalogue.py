@@ -0,0 +1,183 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Catalogue
+Status:        In Progress
+Maintained:    Yes
+Overview:      Saved copy of the Cliflo station list for each data type, so Cliflo.extract_stations only logs in and
+               runs the 1500 km station search when the copy is older than ttl_hours. Each list is kept as a gzipped
+               csv of the table exactly as cf_get_stations returns it, and index.json holds when it was fetched.
+               When a list is fetched again it is compared with the saved one by AgentNumber and the stations added,
+               removed or changed (e.g a new End Date or PercentComplete) are appended to changes.jsonl and returned,
+               so only those stations need their downstream work done again. If the search fails a saved copy, however
+               old, is used instead.
+How to use:    cliflo.extract_stations(..., catalogue='C:\\data\\station_catalogue')
+               StationCatalogue(folder, ttl_hours=24).changes('rainfall') for the changes recorded so far.
+Requirements:  NA
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import pandas as pd
+
+###########
+# CLASSES #
+###########
+
+
+class StationCatalogue:
+    """
+    Folder of station lists, one per data type.
+
+    Class Variables: - key_col: column the stations are matched on when two lists are compared.
+                     - ignore_cols: columns left out of the comparison.
+    """
+
+    key_col = 'AgentNumber'
+    ignore_cols = ['Select']
+
+    def __init__(self, folder, **kwargs):
+        """
+        :param folder: folder to keep the lists in, created if it does not exist.
+        :param kwargs:
+            - ttl_hours: how old a saved list can be before the station search is run again. Default is 168 (a
+                         week), the station list changes very little.
+        """
+        self.folder = folder
+        self.ttl_hours = kwargs.get('ttl_hours', 168)
+        self.index_file = os.path.join(folder, 'index.json')
+        self.changes_file = os.path.join(folder, 'changes.jsonl')
+        self.lock = threading.Lock()
+        self.index = {}
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        if os.path.exists(self.index_file):
+            with open(self.index_file, encoding='utf-8') as f:
+                self.index = json.load(f)
+
+    def list_path(self, data_type):
+        return os.path.join(self.folder, data_type + '.csv.gz')
+
+    def is_fresh(self, data_type):
+        entry = self.index.get(data_type)
+        return entry is not None and time.time() - entry['fetched_at'] < self.ttl_hours * 3600 and \
+            os.path.exists(StationCatalogue.list_path(self, data_type))
+
+    def get(self, data_type, fetch, refresh=False):
+        """
+        Station list for data_type, from the saved copy if it is fresh, otherwise from fetch.
+
+        :param fetch: function of data_type that runs the station search (e.g Cliflo.cf_get_stations).
+        :param refresh: run the search even if the saved copy is fresh.
+        :return: (raw station table, changes). changes is None when the saved copy was used, otherwise a dict of
+                 added, removed and changed stations (see compare).
+        """
+        if not refresh and StationCatalogue.is_fresh(self, data_type):
+            print(data_type + ' station list from the catalogue, fetched ' +
+                  time.strftime('%Y-%m-%d %H:%M', time.localtime(self.index[data_type]['fetched_at'])))
+            return StationCatalogue.load(self, data_type), None
+
+        old = StationCatalogue.load(self, data_type)
+        try:
+            new = fetch(data_type)
+        except Exception as e:
+            if old is False:
+                raise
+            print('station search failed (' + str(e) + '), using the saved ' + data_type + ' station list')
+            return old, None
+
+        changes = StationCatalogue.compare(old, new)
+        StationCatalogue.save(self, data_type, new, changes)
+        return new, changes
+
+    def load(self, data_type):
+        """Saved raw station table for data_type, or False if there is none."""
+
+        if not os.path.exists(StationCatalogue.list_path(self, data_type)):
+            return False
+        with gzip.open(StationCatalogue.list_path(self, data_type), 'rb') as f:
+            df = pd.read_csv(f, dtype=str)
+        # columns are numbered like the table read_html returns, the header is the first row
+        df.columns = range(len(df.columns))
+        return df
+
+    def save(self, data_type, df, changes):
+        path = StationCatalogue.list_path(self, data_type)
+        # write then rename so a crash never leaves half a list
+        with gzip.open(path + '.tmp', 'wb') as f:
+            f.write(df.to_csv(index=False).encode('utf-8'))
+        os.replace(path + '.tmp', path)
+
+        now = time.time()
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now))
+        entries = [{'time': stamp, 'data_type': data_type, 'station': station, 'change': change}
+                   for change in ['added', 'removed'] for station in changes[change]]
+        entries += [{'time': stamp, 'data_type': data_type, 'station': station, 'change': 'changed', 'columns': cols}
+                    for station, cols in changes['changed'].items()]
+        with self.lock:
+            if entries:
+                with open(self.changes_file, 'a', encoding='utf-8') as f:
+                    [f.write(json.dumps(entry) + '\n') for entry in entries]
+            self.index[data_type] = {'fetched_at': now, 'stations': len(StationCatalogue.stations(df)),
+                                     'added': len(changes['added']), 'removed': len(changes['removed']),
+                                     'changed': len(changes['changed'])}
+            with open(self.index_file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(self.index_file + '.tmp', self.index_file)
+        print(data_type + ' station list saved to the catalogue: ' + str(len(changes['added'])) + ' added, ' +
+              str(len(changes['removed'])) + ' removed, ' + str(len(changes['changed'])) + ' changed')
+
+    def changes(self, data_type=None):
+        """Changes recorded so far as a dataframe, optionally for a single data_type."""
+
+        entries = []
+        if os.path.exists(self.changes_file):
+            with open(self.changes_file, encoding='utf-8') as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+        df = pd.DataFrame(entries, columns=['time', 'data_type', 'station', 'change', 'columns'])
+        if data_type is not None:
+            df = df[df['data_type'] == data_type]
+        return df.reset_index(drop=True)
+
+    @staticmethod
+    def stations(df):
+        """Raw station table (header in the first row) to text values indexed by AgentNumber."""
+
+        header = [str(col) for col in df.iloc[0]]
+        stations = pd.DataFrame(df.iloc[1:].values, columns=header).astype(str)
+        stations = stations.drop(columns=[col for col in StationCatalogue.ignore_cols if col in header])
+        return stations.drop_duplicates(StationCatalogue.key_col).set_index(StationCatalogue.key_col)
+
+    @staticmethod
+    def compare(old, new):
+        """
+        Stations added, removed and changed between two raw station tables. With no old table every station is added.
+
+        :return: {'added': [stations], 'removed': [stations], 'changed': {station: {column: [old, new]}}}
+        """
+        new = StationCatalogue.stations(new)
+        if old is False:
+            return {'added': list(new.index), 'removed': [], 'changed': {}}
+        old = StationCatalogue.stations(old)
+
+        common = old.index.intersection(new.index)
+        cols = [col for col in new.columns if col in old.columns]
+        old_common, new_common = old.loc[common, cols], new.loc[common, cols]
+        differ = old_common != new_common
+        changed = {station: {col: [old_common.at[station, col], new_common.at[station, col]]
+                             for col in cols if differ.at[station, col]}
+                   for station in common[differ.any(axis=1).values]}
+        return {'added': [station for station in new.index if station not in old.index],
+                'removed': [station for station in old.index if station not in new.index],
+                'changed': changed}
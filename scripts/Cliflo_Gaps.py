@@ -0,0 +1,145 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Gaps
+Status:        In Progress
+Maintained:    Yes
+Overview:      Fills missing days using the stations around each station rather than the station's own median, which
+               is what Cliflo.station_obs_preprocess does and is a poor guess for rainfall. Each station's k nearest
+               stations (by the lat / long stored by Cliflo.update_lat_long) are found once, the observations of a
+               data_type are put into a [station, day] matrix and every missing station day is estimated in one
+               array operation with inverse distance weighting of the neighbours that have a real value that day.
+               Station days with no neighbour data keep the value they already have. Estimated values keep the
+               *_estimated flag so they can still be told apart from observed ones.
+How to use:    cliflo.fill_gaps(data_type='rainfall', table_name=..., station_table_name=...)  (whole table)
+               df, changed = fill_gaps(obs_df, stations_df, 'rainfall')                          (any dataframe)
+Requirements:  NA
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+import numpy as np
+import pandas as pd
+
+#############
+# FUNCTIONS #
+#############
+
+earth_radius_km = 6371.0
+
+
+def station_distances(lat, long):
+    """Great circle distance in km between every pair of stations, as a [station, station] array."""
+
+    lat = np.radians(np.asarray(lat, dtype='float64'))
+    long = np.radians(np.asarray(long, dtype='float64'))
+    dlat = lat[:, None] - lat[None, :]
+    dlong = long[:, None] - long[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin(dlong / 2) ** 2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def nearest_stations(lat, long, k=5, max_km=None):
+    """
+    k nearest other stations for every station.
+
+    :param max_km: neighbours further away than this are dropped. Default is None (no limit).
+    :return: (neighbours, distances) both [station, k] arrays. Missing neighbours (fewer than k stations, too far
+             away or no lat / long) have index -1 and distance inf.
+    """
+    n = len(lat)
+    dist = station_distances(lat, long)
+    dist[np.isnan(dist)] = np.inf
+    np.fill_diagonal(dist, np.inf)
+    k = min(k, max(n - 1, 0))
+    if k == 0:
+        return np.full((n, 0), -1), np.full((n, 0), np.inf)
+
+    neighbours = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    distances = np.take_along_axis(dist, neighbours, axis=1)
+    order = np.argsort(distances, axis=1)
+    neighbours = np.take_along_axis(neighbours, order, axis=1)
+    distances = np.take_along_axis(distances, order, axis=1)
+    too_far = np.isinf(distances) if max_km is None else (distances > max_km)
+    neighbours[too_far] = -1
+    distances[too_far] = np.inf
+    return neighbours, distances
+
+
+def idw_estimates(matrix, rows, cols, neighbours, distances, power=2, min_km=0.1):
+    """
+    Inverse distance weighted estimates for a list of [station, day] cells.
+
+    :param matrix: [station, day] array of observed values, NaN where there is no observation.
+    :param rows & cols: station and day index of each cell to estimate.
+    :param neighbours & distances: from nearest_stations.
+    :param power: weights are 1 / distance ** power. Default is 2.
+    :param min_km: distances are at least this so stations on the same site do not get an infinite weight.
+    :return: array of estimates, NaN where none of the neighbours has a value that day.
+    """
+    cell_neighbours = neighbours[rows]
+    values = matrix[np.where(cell_neighbours < 0, 0, cell_neighbours), cols[:, None]]
+    weights = 1.0 / np.maximum(distances[rows], min_km) ** power
+    usable = (cell_neighbours >= 0) & ~np.isnan(values)
+    weights = np.where(usable, weights, 0.0)
+    total = weights.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total > 0, (weights * np.where(usable, values, 0.0)).sum(axis=1) / total, np.nan)
+
+
+def fill_gaps(df, stations_df, data_type, k=5, power=2, max_km=100, value_cols=None):
+    """
+    Re-estimates the values flagged as estimated in df from neighbouring stations.
+
+    :param df: cleaned observations (see Cliflo.station_obs_preprocess) for any number of stations and years.
+    :param stations_df: stations with columns stations, lat and long (the Cliflo stations table).
+    :param data_type: keyword for Cliflo.station_clean_dict, used for the value columns.
+    :param k: number of neighbours to use. Default is 5.
+    :param power: inverse distance power. Default is 2.
+    :param max_km: ignore neighbours further away than this. Default is 100.
+    :param value_cols: columns to fill. Default is the station_clean_dict columns for data_type.
+    :return: (df with the estimates in place, boolean array of the rows that changed). The index of df is kept.
+    """
+    if value_cols is None:
+        import Cliflo
+        value_cols = Cliflo.Cliflo.station_clean_dict[data_type][1]
+    df = df.copy()
+    changed = np.zeros(len(df), dtype=bool)
+    if df.empty:
+        return df, changed
+
+    station_codes, station_names = pd.factorize(df['station'].astype(str))
+    dates = pd.to_datetime(df['year'].astype(str) + df['month'].astype(str).str.zfill(2)
+                           + df['day'].astype(str).str.zfill(2), format='%Y%m%d', errors='coerce')
+    day_codes = ((dates - dates.min()).dt.days).to_numpy()
+    ok_date = ~np.isnan(day_codes)
+    day_codes = np.where(ok_date, day_codes, 0).astype('int64')
+
+    coords = stations_df.assign(stations=stations_df['stations'].astype(str)).drop_duplicates('stations')
+    coords = coords.set_index('stations').reindex(station_names)
+    neighbours, distances = nearest_stations(pd.to_numeric(coords['lat'], errors='coerce').to_numpy(),
+                                             pd.to_numeric(coords['long'], errors='coerce').to_numpy(), k, max_km)
+
+    for val in value_cols:
+        values = pd.to_numeric(df[val], errors='coerce').to_numpy(dtype='float64')
+        estimated = (df[val + '_estimated'].astype(str) == '1').to_numpy()
+        observed = ~estimated & ~np.isnan(values) & ok_date
+
+        matrix = np.full((len(station_names), day_codes.max() + 1), np.nan)
+        matrix[station_codes[observed], day_codes[observed]] = values[observed]
+
+        cells = np.flatnonzero(estimated & ok_date)
+        estimates = idw_estimates(matrix, station_codes[cells], day_codes[cells], neighbours, distances, power)
+        found = ~np.isnan(estimates)
+        if not pd.api.types.is_numeric_dtype(df[val]):
+            # text columns (straight from the database) take the estimates as numbers like the median fill does
+            df[val] = df[val].astype(object)
+        df.loc[df.index[cells[found]], val] = estimates[found]
+        changed[cells[found]] = True
+        print(val + ': ' + str(int(found.sum())) + ' of ' + str(len(cells)) + ' estimated values filled from '
+              'neighbouring stations')
+    return df, changed
@@ -0,0 +1,221 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_HTTP
+Status:        In Progress
+Maintained:    Yes
+Overview:      A browser free way of querying Niwas Cliflo database. CliFloSession logs in once with a cookie holding
+               HTTP session and then posts the same station / date / datatype form fields that the selenium methods
+               in Cliflo fill in by hand. It has the same methods the Cliflo class calls on a selenium webdriver
+               (back, quit, page_source) so it can be passed around as the "driver" in Cliflo.update_data.
+How to use:    Cliflo(username=..., password=..., transport='http'). Use website='http://127.0.0.1:8000/' to point
+               it at a local stand in server.
+Requirements:  - A niwa Cliflo account which can be sourced from https://cliflo.niwa.co.nz/
+               - lxml (already needed by pandas.read_html)
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+from html.parser                import HTMLParser
+from http.cookiejar             import CookieJar
+from urllib.parse               import urlencode, urljoin
+from urllib.request             import build_opener, HTTPCookieProcessor
+import datetime
+import lxml.html
+
+###########
+# CLASSES #
+###########
+
+
+class CliFloSession:
+    """
+    Cookie holding HTTP session for Cliflo.
+
+    Class Variables: - datatype_dict: form fields posted with the query for each data_type. These are the values the
+                                      datatype popup writes into the query form when the same options as
+                                      Cliflo.data_type_dict are clicked.
+                     - table_xpath_dict: xpath of the results table for each kind of page, the same xpaths used by
+                                         Cliflo.cf_get_data.
+    """
+
+    query_path = 'pls/niwp/wgenf.genform1_proc'
+    station_search_path = 'pls/niwp/wstn.get_stn_html'
+
+    datatype_dict = {'rainfall': {'dt1': 'ls_ra,1,2,3,4', 'prm1': '1'},
+                     'sunshine_hours': {'dt1': 'ls_sun,1', 'prm1': '1'},
+                     'temps': {'dt1': 'ls_mxmn,1', 'prm1': '1'},
+                     'soil_moisture': {'dt1': 'ls_sm,1', 'prm1': '1'},
+                     'evaporation': {'dt1': 'ls_evap,1', 'prm1': '1'}}
+
+    table_xpath_dict = {'station_list': "//form[@action='/pls/niwp/wstn.update_stn_query']/table[1]",
+                        'station_obs': "//table[3]"}
+
+    def __init__(self, website, username, password, **kwargs):
+        """
+        :param website: base url of Cliflo (or a stand in server).
+        :param username: Cliflo user name.
+        :param password: Cliflo password.
+        :param kwargs:
+            - timeout: seconds to wait on any single request. Default is 360 which is the same as the wait on a
+                       selenium query.
+        """
+        self.website = website if website.endswith('/') else website + '/'
+        self.username = username
+        self.password = password
+        self.timeout = kwargs.get('timeout', 360)
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+        self.query_fields = {}
+        self.stations = []
+        self.page_source = ''
+
+    def login(self):
+        """Logs in, refreshes the row allowance (same as clicking sub_refresh) and keeps the query form fields."""
+
+        page, url = self.request(self.website)
+        form = CliFloSession.find_form(page, 'cusername')
+        if form is None:
+            raise ValueError('no login form found at ' + self.website)
+        form['fields'].update({'cusername': self.username, 'cpwd': self.password, 'submit': 'login'})
+        page, url = self.request(urljoin(url, form['action']), form['fields'], form['method'])
+
+        form = CliFloSession.find_form(page, 'sub_refresh')
+        if form is not None:
+            form['fields']['sub_refresh'] = form['fields'].get('sub_refresh') or 'Refresh'
+            page, url = self.request(urljoin(url, form['action']), form['fields'], form['method'])
+
+        if CliFloSession.find_form(page, 'cusername') is not None:
+            raise ValueError('Cliflo login failed for user ' + str(self.username))
+
+        # Use the default values of the query form when the page has one
+        form = CliFloSession.find_form(page, 'submit_sq')
+        if form is not None:
+            self.query_fields = form['fields']
+        self.page_source = page
+
+        return self
+
+    def specify_data(self, data_type):
+        self.query_fields.update(CliFloSession.datatype_dict[data_type])
+
+    def select_stations(self, station_ids):
+        self.stations = [str(station_id) for station_id in station_ids]
+
+    def send_query(self, start_year, end_year):
+        """Posts the query form for the selected stations between 1 Jan start_year and 1 Jan end_year."""
+
+        return CliFloSession.send_dates(self, datetime.date(start_year, 1, 1), datetime.date(end_year, 1, 1))
+
+    def send_dates(self, start_date, end_date):
+        """Posts the query form for the selected stations between two dates (datetime.date, midnight to midnight)."""
+
+        fields = dict(self.query_fields)
+        fields.update({'agents': ','.join(self.stations),
+                       'date1_1': start_date.year, 'date1_2': start_date.month, 'date1_3': start_date.day,
+                       'date1_4': '00',
+                       'date2_1': end_date.year, 'date2_2': end_date.month, 'date2_3': end_date.day,
+                       'date2_4': '00',
+                       'cstn_id': 'A',  # station column holds the agent number
+                       'mimeselect': 'htmltable',
+                       'submit_sq': 'Send Query'})
+        self.page_source, url = self.request(self.website + CliFloSession.query_path, fields)
+
+        return self.page_source
+
+    def search_stations(self, lat, long, radius):
+        """Station search by distance from a point. Same fields as the station search popup."""
+
+        fields = dict(self.query_fields)
+        fields.update({'cstype': 'latlongc', 'clat1': lat, 'clong1': long, 'crad': radius, 'Submit': 'Get Station List'})
+        self.page_source, url = self.request(self.website + CliFloSession.station_search_path, fields)
+
+        return self.page_source
+
+    def get_table(self, data):
+        """Returns the outerHTML of the results table on the last page, or False if the page has no such table."""
+
+        tables = lxml.html.fromstring(self.page_source).xpath(CliFloSession.table_xpath_dict[data])
+        if not tables:
+            return False
+        return lxml.html.tostring(tables[0], encoding='unicode')
+
+    def request(self, url, fields=None, method='post'):
+        if fields is not None and method.lower() == 'get':
+            url = url + ('&' if '?' in url else '?') + urlencode(fields)
+            fields = None
+        data = urlencode(fields).encode('utf-8') if fields is not None else None
+        with self.opener.open(url, data=data, timeout=self.timeout) as response:
+            charset = response.headers.get_content_charset() or 'utf-8'
+            return response.read().decode(charset, errors='replace'), response.geturl()
+
+    def back(self):
+        # Nothing to navigate back from, the query form fields are kept on the session.
+        pass
+
+    def quit(self):
+        self.opener = None
+
+    @staticmethod
+    def find_form(page, field_name):
+        """Returns the first form on the page that has a field called field_name."""
+
+        parser = FormParser()
+        parser.feed(page)
+        parser.close()
+        for form in parser.forms:
+            if field_name in form['names']:
+                return form
+        return None
+
+
+class FormParser(HTMLParser):
+    """Collects each form on a page with its action, method and default field values."""
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self.select = None
+        self.textarea = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form':
+            self.forms.append({'action': attrs.get('action', ''), 'method': attrs.get('method', 'get'),
+                               'fields': {}, 'names': set()})
+        if not self.forms:
+            return
+        form = self.forms[-1]
+        name = attrs.get('name')
+
+        if tag == 'input' and name:
+            form['names'].add(name)
+            input_type = attrs.get('type', 'text').lower()
+            if input_type in ('submit', 'button', 'image', 'reset'):
+                return
+            if input_type in ('checkbox', 'radio') and 'checked' not in attrs:
+                return
+            form['fields'][name] = attrs.get('value', '')
+        elif tag == 'select' and name:
+            form['names'].add(name)
+            self.select = name
+        elif tag == 'option' and self.select:
+            if self.select not in form['fields'] or 'selected' in attrs:
+                form['fields'][self.select] = attrs.get('value', '')
+        elif tag == 'textarea' and name:
+            form['names'].add(name)
+            form['fields'][name] = ''
+            self.textarea = name
+
+    def handle_data(self, data):
+        if self.textarea and self.forms:
+            self.forms[-1]['fields'][self.textarea] += data
+
+    def handle_endtag(self, tag):
+        if tag == 'select':
+            self.select = None
+        elif tag == 'textarea':
+            self.textarea = None
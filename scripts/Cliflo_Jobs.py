@@ -0,0 +1,209 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Jobs
+Status:        In Progress
+Maintained:    Yes
+Overview:      A job table in PostgreSQL that lets Cliflo.update_data be spread over several processes and machines.
+               Each (data_type, station, year) is one job. Workers claim jobs with row leases
+               (SELECT ... FOR UPDATE SKIP LOCKED) so two workers never get the same job, keep the lease alive with a
+               heartbeat and hand the job back if they stop. If a worker crashes its lease runs out and any other
+               worker can claim the job again. Every JobQueue object is its own worker, so several queues in one
+               process (e.g ETL running data types at once) never touch each other's leases.
+How to use:    jobs = JobQueue(cliflo.engine)
+               jobs.add_jobs('rainfall', station_list, range(1987, 2018))   # safe to run on every host
+               cliflo.run_job_queue(jobs, data_type='rainfall', ...)
+Requirements:  PostgreSQL 9.5 or later (SKIP LOCKED).
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+from sqlalchemy                 import text
+import os
+import socket
+import threading
+import uuid
+
+###########
+# CLASSES #
+###########
+
+
+class JobQueue:
+    """
+    Lease based job queue stored in a PostgreSQL table.
+
+    Job status is one of:
+        - pending: waiting to be claimed.
+        - leased:  claimed by the worker in the worker column until lease_until.
+        - done:    finished.
+        - failed:  gave up after max_attempts.
+    """
+
+    def __init__(self, engine, **kwargs):
+        """
+        :param engine: SQLAlchemy engine for the database the job table lives in.
+        :param kwargs:
+            - table_name: name of the job table. Default is cliflo_jobs.
+            - lease_seconds: how long a claim lasts without a heartbeat. Default is 600.
+            - heartbeat_seconds: how often the heartbeat thread renews leases. Default is a third of lease_seconds.
+            - max_attempts: number of claims before a job is marked as failed. Default is 3.
+            - worker_id: name of this worker, must be unique to this JobQueue. Default is host name, process id and
+                         a random suffix.
+        """
+        self.engine = engine
+        self.table_name = kwargs.get('table_name', 'cliflo_jobs')
+        self.lease_seconds = kwargs.get('lease_seconds', 600)
+        self.heartbeat_seconds = kwargs.get('heartbeat_seconds', self.lease_seconds / 3)
+        self.max_attempts = kwargs.get('max_attempts', 3)
+        self.worker_id = kwargs.get('worker_id', socket.gethostname() + ':' + str(os.getpid()) + ':' +
+                                    uuid.uuid4().hex[:8])
+        # data types this worker has claimed jobs for, heartbeat and release only touch these
+        self.data_types = set()
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat_thread = None
+
+        JobQueue.create_table(self)
+
+    def create_table(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS %s (
+                    data_type    TEXT NOT NULL,
+                    station      TEXT NOT NULL,
+                    year         INTEGER NOT NULL,
+                    status       TEXT NOT NULL DEFAULT 'pending',
+                    worker       TEXT,
+                    lease_until  TIMESTAMPTZ,
+                    heartbeat_at TIMESTAMPTZ,
+                    attempts     INTEGER NOT NULL DEFAULT 0,
+                    updated_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (data_type, station, year))""" % self.table_name))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS %s_claim_idx ON %s (data_type, status, lease_until)'
+                              % (self.table_name, self.table_name)))
+
+    def add_jobs(self, data_type, station_list, years):
+        """Adds a job for every station and year. Jobs that already exist (in any status) are left alone."""
+
+        rows = [{'data_type': data_type, 'station': str(station), 'year': int(year)}
+                for station in station_list for year in years]
+        if rows:
+            with self.engine.begin() as conn:
+                conn.execute(text('INSERT INTO %s (data_type, station, year) VALUES (:data_type, :station, :year) '
+                                  'ON CONFLICT DO NOTHING' % self.table_name), rows)
+        return len(rows)
+
+    def claim(self, data_type, n=1):
+        """
+        Claims up to n jobs for this worker. Jobs that are pending or whose lease has run out can be claimed, rows
+        locked by another worker's claim are skipped rather than waited on.
+
+        :return: list of (station, year) tuples, ordered by station so a worker can keep the same station selected.
+        """
+        self.data_types.add(data_type)
+        with self.engine.begin() as conn:
+            # leases that ran out on their last attempt will never be claimed again
+            conn.execute(text("UPDATE %s SET status = 'failed', worker = NULL, updated_at = now() "
+                              "WHERE data_type = :data_type AND status = 'leased' AND lease_until < now() "
+                              "AND attempts >= :max_attempts" % self.table_name),
+                         {'data_type': data_type, 'max_attempts': self.max_attempts})
+            rows = conn.execute(text("""
+                WITH c AS (SELECT data_type, station, year FROM {0}
+                           WHERE data_type = :data_type
+                           AND (status = 'pending' OR (status = 'leased' AND lease_until < now()))
+                           AND attempts < :max_attempts
+                           ORDER BY station, year
+                           LIMIT :n
+                           FOR UPDATE SKIP LOCKED)
+                UPDATE {0} AS j
+                SET status = 'leased', worker = :worker, attempts = j.attempts + 1,
+                    lease_until = now() + :lease * interval '1 second', heartbeat_at = now(), updated_at = now()
+                FROM c
+                WHERE j.data_type = c.data_type AND j.station = c.station AND j.year = c.year
+                RETURNING j.station, j.year""".format(self.table_name)),
+                {'worker': self.worker_id, 'lease': self.lease_seconds, 'data_type': data_type,
+                 'max_attempts': self.max_attempts, 'n': n}).fetchall()
+
+        return sorted((row[0], row[1]) for row in rows)
+
+    def heartbeat(self):
+        """Renews the lease on every job this worker holds. Returns the number of leases renewed."""
+
+        with self.engine.begin() as conn:
+            result = conn.execute(text("UPDATE %s SET lease_until = now() + :lease * interval '1 second', "
+                                       "heartbeat_at = now() WHERE worker = :worker AND status = 'leased' "
+                                       "AND data_type = ANY(CAST(:data_types AS text[]))" % self.table_name),
+                                  {'lease': self.lease_seconds, 'worker': self.worker_id,
+                                   'data_types': sorted(self.data_types)})
+        return result.rowcount
+
+    def start_heartbeat(self):
+        def beat():
+            while not self.heartbeat_stop.wait(self.heartbeat_seconds):
+                try:
+                    JobQueue.heartbeat(self)
+                except Exception as e:
+                    print('heartbeat failed: ', e)
+
+        self.heartbeat_stop.clear()
+        self.heartbeat_thread = threading.Thread(target=beat, name='cliflo_job_heartbeat', daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self.heartbeat_stop.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    def complete(self, data_type, station, year):
+        JobQueue.set_status(self, data_type, station, year, 'done')
+
+    def fail(self, data_type, station, year):
+        """Hands a job back to the queue, or marks it failed once it has used up its attempts."""
+
+        with self.engine.begin() as conn:
+            conn.execute(text("UPDATE %s SET status = CASE WHEN attempts >= :max_attempts THEN 'failed' "
+                              "ELSE 'pending' END, worker = NULL, lease_until = NULL, updated_at = now() "
+                              "WHERE data_type = :data_type AND station = :station AND year = :year "
+                              "AND worker = :worker" % self.table_name),
+                         {'max_attempts': self.max_attempts, 'data_type': data_type, 'station': str(station),
+                          'year': int(year), 'worker': self.worker_id})
+
+    def set_status(self, data_type, station, year, status):
+        with self.engine.begin() as conn:
+            conn.execute(text('UPDATE %s SET status = :status, lease_until = NULL, updated_at = now() '
+                              'WHERE data_type = :data_type AND station = :station AND year = :year '
+                              'AND worker = :worker' % self.table_name),
+                         {'status': status, 'data_type': data_type, 'station': str(station), 'year': int(year),
+                          'worker': self.worker_id})
+
+    def release(self, data_type=None):
+        """
+        Puts every job this worker still holds back to pending, used when a worker shuts down cleanly.
+
+        :param data_type: only jobs of this data_type. Default is every data_type this worker has claimed.
+        """
+        data_types = sorted(self.data_types) if data_type is None else [data_type]
+        with self.engine.begin() as conn:
+            result = conn.execute(text("UPDATE %s SET status = 'pending', worker = NULL, lease_until = NULL, "
+                                       "attempts = greatest(attempts - 1, 0), updated_at = now() "
+                                       "WHERE worker = :worker AND status = 'leased' "
+                                       "AND data_type = ANY(CAST(:data_types AS text[]))" % self.table_name),
+                                  {'worker': self.worker_id, 'data_types': data_types})
+        return result.rowcount
+
+    def progress(self, data_type=None):
+        """Number of jobs in each status, as a dict. Optionally for a single data_type."""
+
+        args = 'SELECT status, count(*) FROM %s' % self.table_name
+        params = {}
+        if data_type is not None:
+            args += ' WHERE data_type = :data_type'
+            params['data_type'] = data_type
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(args + ' GROUP BY status'), params).fetchall()
+        return {row[0]: row[1] for row in rows}
@@ -0,0 +1,144 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Manifest
+Status:        In Progress
+Maintained:    Yes
+Overview:      A checkpoint file for Cliflo.update_data. Every (data_type, station, year) job is written to a small
+               SQLite database with its state, so if a run dies partway the next run picks up the jobs that are
+               left instead of checking every csv file and re-querying the database for every station. SQLite is
+               used so it also works with csv_only=True where there is no database.
+How to use:    cliflo.update_data(..., manifest='C:\\data\\rainfall\\cliflo_manifest.sqlite')
+               Manifest('...sqlite').summary() for progress.
+Requirements:  NA
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+from collections                import defaultdict
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+
+###########
+# CLASSES #
+###########
+
+
+class Manifest:
+    """
+    SQLite manifest of update_data jobs.
+
+    Class Variables: - states: the states a job moves through, in order. A job ends either loaded (in the database)
+                               or empty (Cliflo has no data for that station and year).
+    """
+
+    states = ['pending', 'downloaded', 'parsed', 'loaded', 'empty']
+
+    def __init__(self, path):
+        """
+        :param path: sqlite file to use, created if it does not exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    data_type  TEXT NOT NULL,
+                    station    TEXT NOT NULL,
+                    year       INTEGER NOT NULL,
+                    state      TEXT NOT NULL DEFAULT 'pending',
+                    rows       INTEGER,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (data_type, station, year));
+                CREATE INDEX IF NOT EXISTS jobs_state_idx ON jobs (data_type, state);
+                CREATE TABLE IF NOT EXISTS plans (
+                    data_type  TEXT NOT NULL,
+                    station    TEXT NOT NULL,
+                    start_year INTEGER NOT NULL,
+                    end_year   INTEGER NOT NULL,
+                    planned_at REAL NOT NULL,
+                    PRIMARY KEY (data_type, station));""")
+
+    def plan(self, data_type, station, start_year, end_year, years):
+        """
+        Records the years a station needs as pending jobs (existing jobs keep their state) and marks the station as
+        planned for start_year to end_year, all in one transaction.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany('INSERT OR IGNORE INTO jobs (data_type, station, year, state, updated_at) '
+                                      "VALUES (?, ?, ?, 'pending', ?)",
+                                      [(data_type, str(station), int(year), now) for year in years])
+                self.conn.execute('INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?, ?)',
+                                  (data_type, str(station), start_year, end_year, now))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def planned_stations(self, data_type, start_year, end_year):
+        """Stations already planned for this data_type and year range."""
+
+        with self.lock:
+            rows = self.conn.execute('SELECT station FROM plans WHERE data_type = ? AND start_year = ? '
+                                     'AND end_year = ?', (data_type, start_year, end_year)).fetchall()
+        return set(row[0] for row in rows)
+
+    def remaining(self, data_type, done_states=('loaded', 'empty')):
+        """
+        Jobs that are not finished.
+
+        :param done_states: states that count as finished. With csv_only runs 'parsed' is also finished.
+        :return: {station: [years]}
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT station, year FROM jobs WHERE data_type = ? AND state NOT IN (%s) '
+                                     'ORDER BY station, year' % ', '.join('?' * len(done_states)),
+                                     (data_type,) + tuple(done_states)).fetchall()
+        remaining = defaultdict(list)
+        [remaining[station].append(year) for station, year in rows]
+        return remaining
+
+    def set_state(self, data_type, station, year, state, rows=None):
+        if state not in Manifest.states:
+            raise ValueError('unknown manifest state: ' + str(state))
+        with self.lock:
+            self.conn.execute('INSERT INTO jobs (data_type, station, year, state, rows, updated_at) '
+                              'VALUES (?, ?, ?, ?, ?, ?) '
+                              'ON CONFLICT (data_type, station, year) DO UPDATE SET state = excluded.state, '
+                              'rows = coalesce(excluded.rows, jobs.rows), updated_at = excluded.updated_at',
+                              (data_type, str(station), int(year), state, rows, time.time()))
+
+    def progress(self, data_type):
+        """Number of jobs in each state for a data_type, as a dict."""
+
+        with self.lock:
+            rows = self.conn.execute('SELECT state, count(*) FROM jobs WHERE data_type = ? GROUP BY state',
+                                     (data_type,)).fetchall()
+        return {state: count for state, count in rows}
+
+    def summary(self):
+        """Jobs and rows in each state for every data_type, as a dataframe."""
+
+        with self.lock:
+            return pd.read_sql('SELECT data_type, state, count(*) AS jobs, sum(rows) AS rows, '
+                               'max(updated_at) AS last_update FROM jobs GROUP BY data_type, state '
+                               'ORDER BY data_type, state', self.conn)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,223 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Metrics
+Status:        In Progress
+Maintained:    Yes
+Overview:      Timings and throughput for Cliflo runs. Each stage of getting a station year (cf_login,
+               cf_get_station_data, cf_change_dates, cf_get_data, station_obs_preprocess, df_to_db) is timed by the
+               timed decorator, every station year finished is counted with its rows, and from those a rolling
+               rows / min and jobs / min and an ETA for the jobs planned are kept. There is one Metrics object per
+               process (metrics) shared by every Cliflo object and worker thread, like Cliflo.wait_log.
+               Exported as:
+                   - cliflo_metrics.jsonl: one line per stage call and per finished job, appended as they happen.
+                   - cliflo_metrics.prom:  Prometheus text format of the totals and rates, rewritten every
+                                           export_seconds so a local scraper (e.g node_exporter's textfile
+                                           collector) can read it.
+How to use:    cliflo.update_data(..., metrics='C:\\cliflo\\metrics')  (folder the two files go in)
+               metrics.summary() for the stage timings as a dataframe.
+Requirements:  NA
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+from collections                import defaultdict, deque
+import functools
+import json
+import os
+import threading
+import time
+import pandas as pd
+
+###########
+# CLASSES #
+###########
+
+
+class Metrics:
+    """
+    Stage timers, job counts and rolling rates for a process.
+
+    Class Variables: - stages: the stages Cliflo times, always exported (as 0) so a scraper sees every series.
+    """
+
+    stages = ['cf_login', 'cf_get_station_data', 'cf_change_dates', 'cf_get_data', 'station_obs_preprocess',
+              'df_to_db']
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs:
+            - folder: where cliflo_metrics.jsonl and cliflo_metrics.prom are written. Default is None (kept in memory
+                      only).
+            - window_seconds: rates are over this many seconds. Default is 600.
+            - export_seconds: most often the prometheus file is rewritten. Default is 15.
+        """
+        self.lock = threading.Lock()
+        self.folder = None
+        self.window_seconds = kwargs.get('window_seconds', 600)
+        self.export_seconds = kwargs.get('export_seconds', 15)
+        self.stage_calls = defaultdict(int)
+        self.stage_errors = defaultdict(int)
+        self.stage_seconds = defaultdict(float)
+        self.stage_max = defaultdict(float)
+        self.jobs = 0
+        self.rows = 0
+        self.planned = 0
+        self.recent = deque()
+        self.started = time.time()
+        self.last_export = 0
+        Metrics.configure(self, kwargs.get('folder'))
+
+    def configure(self, folder, **kwargs):
+        """Sets (or with None, stops) the folder the files are written to. Keeps everything counted so far."""
+
+        with self.lock:
+            self.folder = folder
+            if folder is not None:
+                os.makedirs(folder, exist_ok=True)
+            self.window_seconds = kwargs.get('window_seconds', self.window_seconds)
+            self.export_seconds = kwargs.get('export_seconds', self.export_seconds)
+
+    def add_planned(self, jobs):
+        """Adds station years to the jobs the ETA is worked out for (update_data calls this once it has planned)."""
+
+        with self.lock:
+            self.planned += jobs
+
+    def record_stage(self, stage, seconds, ok=True):
+        with self.lock:
+            self.stage_calls[stage] += 1
+            self.stage_seconds[stage] += seconds
+            self.stage_max[stage] = max(self.stage_max[stage], seconds)
+            if not ok:
+                self.stage_errors[stage] += 1
+        Metrics.log(self, {'type': 'stage', 'stage': stage, 'seconds': round(seconds, 4), 'ok': ok})
+
+    def record_job(self, data_type, station, year, rows):
+        """Counts a finished station year and its rows."""
+
+        now = time.time()
+        with self.lock:
+            self.jobs += 1
+            self.rows += rows or 0
+            self.recent.append((now, rows or 0))
+        rates = Metrics.rates(self)
+        Metrics.log(self, dict({'type': 'job', 'data_type': data_type, 'station': str(station), 'year': int(year),
+                                'rows': rows or 0}, **rates))
+
+    def rates(self):
+        """Rolling rows / min and jobs / min over window_seconds, and the ETA in seconds for the planned jobs."""
+
+        now = time.time()
+        with self.lock:
+            while self.recent and self.recent[0][0] < now - self.window_seconds:
+                self.recent.popleft()
+            minutes = max(min(self.window_seconds, now - self.started), 1) / 60
+            jobs_per_min = len(self.recent) / minutes
+            rows_per_min = sum(rows for t, rows in self.recent) / minutes
+            remaining = max(self.planned - self.jobs, 0)
+        eta = remaining / jobs_per_min * 60 if jobs_per_min else None
+        return {'rows_per_min': round(rows_per_min, 2), 'jobs_per_min': round(jobs_per_min, 3),
+                'eta_s': None if eta is None else round(eta), 'remaining_jobs': remaining}
+
+    def log(self, entry):
+        if self.folder is None:
+            return
+        entry = dict({'time': time.strftime('%Y-%m-%dT%H:%M:%S')}, **entry)
+        with self.lock:
+            with open(os.path.join(self.folder, 'cliflo_metrics.jsonl'), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+            due = time.time() - self.last_export >= self.export_seconds
+        if due:
+            Metrics.export(self)
+
+    def export(self, wait_log=None):
+        """
+        Rewrites cliflo_metrics.prom. The file is written next to it and renamed over it so a scraper never reads
+        half a file.
+
+        :param wait_log: Cliflo.wait_log, exported as page wait times per step. Default is None (left out).
+        """
+        if self.folder is None:
+            return
+        rates = Metrics.rates(self)
+        with self.lock:
+            self.last_export = time.time()
+            lines = ['# HELP cliflo_stage_seconds_total Seconds spent in each stage.',
+                     '# TYPE cliflo_stage_seconds_total counter']
+            lines += ['cliflo_stage_seconds_total{stage="%s"} %f' % (stage, self.stage_seconds[stage])
+                      for stage in Metrics.stage_names(self)]
+            lines += ['# HELP cliflo_stage_calls_total Times each stage was run.',
+                      '# TYPE cliflo_stage_calls_total counter']
+            lines += ['cliflo_stage_calls_total{stage="%s"} %d' % (stage, self.stage_calls[stage])
+                      for stage in Metrics.stage_names(self)]
+            lines += ['# HELP cliflo_stage_errors_total Times each stage raised an error.',
+                      '# TYPE cliflo_stage_errors_total counter']
+            lines += ['cliflo_stage_errors_total{stage="%s"} %d' % (stage, self.stage_errors[stage])
+                      for stage in Metrics.stage_names(self)]
+            lines += ['# HELP cliflo_stage_seconds_max Longest single run of each stage.',
+                      '# TYPE cliflo_stage_seconds_max gauge']
+            lines += ['cliflo_stage_seconds_max{stage="%s"} %f' % (stage, self.stage_max[stage])
+                      for stage in Metrics.stage_names(self)]
+            if wait_log:
+                lines += ['# HELP cliflo_wait_seconds_total Seconds waited on each page step (Cliflo.wait_log).',
+                          '# TYPE cliflo_wait_seconds_total counter']
+                lines += ['cliflo_wait_seconds_total{step="%s"} %f' % (step, sum(times))
+                          for step, times in sorted(list(wait_log.items()))]
+            lines += ['# TYPE cliflo_jobs_total counter', 'cliflo_jobs_total %d' % self.jobs,
+                      '# TYPE cliflo_rows_total counter', 'cliflo_rows_total %d' % self.rows,
+                      '# TYPE cliflo_jobs_planned gauge', 'cliflo_jobs_planned %d' % self.planned,
+                      '# TYPE cliflo_jobs_remaining gauge', 'cliflo_jobs_remaining %d' % rates['remaining_jobs'],
+                      '# TYPE cliflo_rows_per_minute gauge', 'cliflo_rows_per_minute %f' % rates['rows_per_min'],
+                      '# TYPE cliflo_jobs_per_minute gauge', 'cliflo_jobs_per_minute %f' % rates['jobs_per_min'],
+                      '# TYPE cliflo_eta_seconds gauge',
+                      'cliflo_eta_seconds %s' % ('NaN' if rates['eta_s'] is None else rates['eta_s'])]
+            path = os.path.join(self.folder, 'cliflo_metrics.prom')
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(path + '.tmp', path)
+
+    def stage_names(self):
+        return Metrics.stages + sorted(stage for stage in list(self.stage_calls) if stage not in Metrics.stages)
+
+    def summary(self):
+        """Calls, errors, total, mean and max seconds for each stage as a dataframe, slowest total first."""
+
+        with self.lock:
+            summary = pd.DataFrame([{'stage': stage, 'count': self.stage_calls[stage],
+                                     'errors': self.stage_errors[stage], 'total_s': self.stage_seconds[stage],
+                                     'mean_s': self.stage_seconds[stage] / self.stage_calls[stage],
+                                     'max_s': self.stage_max[stage]}
+                                    for stage in list(self.stage_calls) if self.stage_calls[stage]],
+                                   columns=['stage', 'count', 'errors', 'total_s', 'mean_s', 'max_s'])
+        return summary.sort_values('total_s', ascending=False).reset_index(drop=True)
+
+
+#############
+# FUNCTIONS #
+#############
+
+# the one Metrics object for the process, see the overview
+metrics = Metrics()
+
+
+def timed(stage):
+    """Decorator that adds the time each call of a function takes to metrics under stage."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            ok = False
+            try:
+                result = func(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                metrics.record_stage(stage, time.perf_counter() - start, ok)
+        return wrapper
+    return decorator
@@ -0,0 +1,196 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Parser
+Status:        In Progress
+Maintained:    Yes
+Overview:      Fast parser for the observation tables on Cliflo result pages. pd.read_html builds a dataframe of the
+               whole table, guesses every column type and then Cliflo.station_obs_quick_clean has to pull the header
+               rows back out. This streams the rows out of the html instead: it finds the header row (the one with
+               Date(NZST) in it), keeps only the columns named in Cliflo.station_clean_dict and converts the values
+               straight to floats, giving the same frame station_obs_quick_clean would (Station and Date(NZST) as
+               text, values as numbers). A page with no observation table raises ResultsPageError unless it says the
+               query found no rows, so an error page is not stored as an empty station year.
+How to use:    df = parse_obs_table(html, 'rainfall') or cliflo.update_data(..., parser='stream')
+               python Cliflo_Parser.py <folder of saved result tables> <data_type>  to benchmark against read_html.
+Requirements:  NA
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+import html
+import io
+import os
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+#############
+# FUNCTIONS #
+#############
+
+
+def parse_obs_table(page, data_type):
+    """
+    Parses the observation table from a Cliflo result page (or just the table's outerHTML).
+
+    :param page: the html as a string, or any iterable of string chunks (e.g. a response being read in blocks).
+    :param data_type: keyword for Cliflo.station_clean_dict so either 'rainfall', 'sunshine_hours' etc.
+    :return: dataframe with Station and Date(NZST) as text and the data_type's value columns as floats, or an
+             empty dataframe if the table has no rows or the page says the query found none.
+    """
+    parser = ObsTableParser(data_type)
+    for chunk in ([page] if isinstance(page, str) else page):
+        parser.feed(chunk)
+        if parser.finished:
+            break
+    parser.close()
+    if parser.col_index is None and not parser.no_rows:
+        raise ResultsPageError('no observation table (Date(NZST) header) on the results page')
+    return parser.to_frame()
+
+
+def known_columns(data_type):
+    # imported here so Cliflo can import this module without a circular import
+    import Cliflo
+    return ['Station', 'Date(NZST)'] + [col for col in Cliflo.Cliflo.station_clean_dict[data_type][0]
+                                        if col != 'Station']
+
+
+def benchmark(pages, data_type, repeat=3):
+    """
+    Times parse_obs_table against the read_html + station_obs_quick_clean path on the same pages.
+
+    :param pages: list of html strings, the observation tables as cf_get_data gets them (table outerHTML).
+    :return: dict of best time in seconds for each path, rows parsed and the speed up.
+    """
+    import Cliflo
+
+    def current_path():
+        for page in pages:
+            Cliflo.Cliflo.station_obs_quick_clean(pd.read_html(io.StringIO(page))[0])
+
+    def stream_path():
+        for page in pages:
+            parse_obs_table(page, data_type)
+
+    results = {}
+    for name, run in [('read_html', current_path), ('stream', stream_path)]:
+        times = []
+        for n in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        results[name + '_s'] = min(times)
+    results['rows'] = sum(len(parse_obs_table(page, data_type)) for page in pages)
+    results['speed_up'] = results['read_html_s'] / results['stream_s'] if results['stream_s'] else np.nan
+    return results
+
+
+###########
+# CLASSES #
+###########
+
+
+class ResultsPageError(Exception):
+    """
+    A results page has no observation table and does not say the query found no rows, e.g an error page or one
+    that did not finish loading. Only a table with no rows (or a no rows message) is an empty station year.
+    """
+
+
+class ObsTableParser:
+    """
+    Streaming parser that collects the rows of the first table with a Date(NZST) header cell. Cliflo tables are
+    plain rows of cells so rows are picked out with regular expressions rather than a full html parser, which is
+    far quicker. Chunks can be fed in as they arrive, only the unfinished row at the end is kept between feeds.
+    Rows are kept as lists per column so the conversion to arrays happens once at the end.
+    """
+
+    row_re = re.compile(r'<tr(?:\s[^>]*)?>(.*?)</tr\s*>|</table\s*>', re.S | re.I)
+    cell_re = re.compile(r'<t[dh](?:\s[^>]*)?>(.*?)</t[dh]\s*>', re.S | re.I)
+    tag_re = re.compile(r'<[^>]*>')
+    no_rows_re = re.compile(r'no (?:rows|data)(?: were)? (?:found|returned)', re.I)
+
+    def __init__(self, data_type):
+        self.data_type = data_type
+        self.wanted = known_columns(data_type)
+        self.buffer = ''
+        self.col_index = None
+        self.columns = {}
+        self.width = 0
+        self.finished = False
+        self.no_rows = False
+
+    def feed(self, chunk):
+        if self.finished:
+            return
+        self.buffer += chunk
+        if self.col_index is None and not self.no_rows:
+            self.no_rows = ObsTableParser.no_rows_re.search(self.buffer) is not None
+        last = 0
+        for match in ObsTableParser.row_re.finditer(self.buffer):
+            last = match.end()
+            if match.group(1) is None:
+                # end of a table, only matters once the observation table has started
+                if self.col_index is not None:
+                    self.finished = True
+                    break
+            else:
+                ObsTableParser.end_row(self, ObsTableParser.cell_re.findall(match.group(1)))
+        self.buffer = '' if self.finished else self.buffer[last:]
+
+    def close(self):
+        self.buffer = ''
+
+    @staticmethod
+    def cell_text(cell):
+        if '<' in cell:
+            cell = ObsTableParser.tag_re.sub('', cell)
+        if '&' in cell:
+            cell = html.unescape(cell)
+        return cell.strip()
+
+    def end_row(self, cells):
+        if self.col_index is None:
+            header = [' '.join(ObsTableParser.cell_text(cell).split()) for cell in cells]
+            if 'Date(NZST)' in header:
+                # header row, remember which position each column we want is in
+                self.col_index = {col: header.index(col) for col in self.wanted if col in header}
+                self.columns = {col: [] for col in self.col_index}
+                self.width = len(header)
+            return
+        if len(cells) != self.width:
+            return
+        for col, i in self.col_index.items():
+            self.columns[col].append(ObsTableParser.cell_text(cells[i]))
+
+    def to_frame(self):
+        if not self.columns or not self.columns['Date(NZST)']:
+            return pd.DataFrame()
+        data = {}
+        for col, values in self.columns.items():
+            if col in ('Station', 'Date(NZST)'):
+                data[col] = np.array(values, dtype=object)
+            else:
+                data[col] = pd.to_numeric(np.array(values, dtype=object), errors='coerce').astype('float64')
+        return pd.DataFrame(data, columns=list(self.columns))
+
+
+if __name__ == '__main__':
+    # python Cliflo_Parser.py <folder of saved result tables (.html)> <data_type>
+    folder = sys.argv[1]
+    page_data_type = sys.argv[2] if len(sys.argv) > 2 else 'rainfall'
+    saved_pages = []
+    for file_name in sorted(os.listdir(folder)):
+        if file_name.endswith('.html'):
+            with open(os.path.join(folder, file_name), encoding='utf-8') as f:
+                saved_pages.append(f.read())
+    print(str(len(saved_pages)) + ' tables')
+    print(benchmark(saved_pages, page_data_type))
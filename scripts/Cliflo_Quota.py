@@ -0,0 +1,175 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Quota
+Status:        In Progress
+Maintained:    Yes
+Overview:      Keeps track of the Cliflo row allowance so long runs do not stop partway through. The rows left are read
+               off the page after logging in, every query takes its rows off them and Cliflo.cf_query logs in again
+               (which clicks sub_refresh and resets the allowance) before a query would take them below
+               refresh_below. Pages Cliflo sends back instead of results (allowance used up, row limit, login page
+               once the session has expired) are recognised so they are not stored as empty station years.
+               gap_value and prioritise put the stations with the station years worth the most first so the
+               allowance goes on them:
+                   - a year missing from inside the range a station already has loaded (a hole in its record)
+                   - then years of stations that are known to report the data type
+                   - then stations nothing is known about
+                   - last stations that have only ever come back empty
+               A station's jobs stay together (newest years first) so it is only selected on Cliflo once.
+How to use:    cliflo.update_data(..., refresh_below=10000, prioritise=True)   (the defaults)
+               cliflo.quota.summary() for the rows used, logins and refreshes so far.
+Requirements:  NA
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+import re
+import threading
+
+###########
+# CLASSES #
+###########
+
+
+class QuotaError(Exception):
+    """
+    Cliflo sent back a page saying the query can not be run instead of results.
+
+    reason is one of:
+        - allowance: the rows left are used up, and logging in again did not reset them.
+        - login: the session expired, and logging in again did not work.
+    A query over the row limit is not a QuotaError as only that query needs to be smaller (see Cliflo.cf_query).
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class RowQuota:
+    """
+    Rows left on the Cliflo account, shared by every worker of a Cliflo object.
+
+    Class Variables: - page_patterns: regular expressions for the pages Cliflo sends back instead of results, as
+                                      {reason: pattern}. See QuotaError for the reasons, and row_limit.
+                     - rows_left_pattern: regular expression for the rows left shown after logging in.
+    """
+
+    page_patterns = {'allowance': re.compile(r'row allowance (?:exceeded|used up)|no rows left|insufficient rows',
+                                             re.IGNORECASE),
+                     'row_limit': re.compile(r'row limit exceeded|too many rows', re.IGNORECASE),
+                     'login': re.compile(r'name=["\']?cusername', re.IGNORECASE)}
+
+    rows_left_pattern = re.compile(r'rows?\s+(?:left|remaining)[^0-9<]{0,40}([0-9][0-9,]*)', re.IGNORECASE)
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs:
+            - refresh_below: log in again (refreshing the allowance) before a query would leave fewer rows than
+                             this. Default is 10,000.
+            - prioritise: put the most valuable station years first (see prioritise). Default is True.
+        """
+        self.lock = threading.Lock()
+        self.refresh_below = kwargs.get('refresh_below', 10000)
+        self.prioritise = kwargs.get('prioritise', True)
+        # None until a page has shown it, queries then only react to the pages Cliflo sends back
+        self.rows_left = None
+        self.rows_used = 0
+        self.queries = 0
+        self.logins = 0
+        self.refreshes = 0
+
+    def read_page(self, page, login=False):
+        """
+        Reads the rows left off a page, if it shows them, and checks for a page sent instead of results.
+
+        :param login: the page is the one after logging in, counted in logins.
+        :return: the reason (see QuotaError) if the page is one sent instead of results, otherwise None.
+        """
+        match = RowQuota.rows_left_pattern.search(page or '')
+        with self.lock:
+            if login:
+                self.logins += 1
+            if match:
+                self.rows_left = int(match.group(1).replace(',', ''))
+        for reason, pattern in RowQuota.page_patterns.items():
+            if pattern.search(page or ''):
+                return reason
+        return None
+
+    def use(self, rows):
+        """Takes the rows a query returned off the rows left."""
+
+        with self.lock:
+            self.queries += 1
+            self.rows_used += rows
+            if self.rows_left is not None:
+                self.rows_left = max(self.rows_left - rows, 0)
+
+    def needs_refresh(self, rows):
+        """True if a query of about this many rows would leave fewer than refresh_below rows."""
+
+        with self.lock:
+            return self.rows_left is not None and self.rows_left - rows < self.refresh_below
+
+    def refreshed(self, rows):
+        """Counts a refresh. Returns False if the rows left are still too low for the next query afterwards."""
+
+        with self.lock:
+            self.refreshes += 1
+        return not RowQuota.needs_refresh(self, rows)
+
+    def summary(self):
+        with self.lock:
+            return {'rows_left': self.rows_left, 'rows_used': self.rows_used, 'queries': self.queries,
+                    'logins': self.logins, 'refreshes': self.refreshes}
+
+
+#############
+# FUNCTIONS #
+#############
+
+
+def gap_value(year, loaded, empty):
+    """
+    How much a station year is worth downloading (see the overview).
+
+    :param loaded: years already loaded for the station.
+    :param empty: years that came back empty for the station.
+    """
+    if loaded and min(loaded) < year < max(loaded):
+        return 3
+    if loaded:
+        return 2
+    if empty:
+        return 0.5
+    return 1
+
+
+def prioritise(jobs, loaded, empty):
+    """
+    Sorts Cliflo.batch_jobs jobs so the most valuable go first. Jobs for the same stations are kept together, as
+    each change of stations is another station search on Cliflo: the stations are ranked by the mean gap_value of all
+    the station years they need (then their newest year), and their own jobs are put newest years first.
+
+    :param jobs: list of (station_ids, years, {station: years needed}).
+    :param loaded & empty: {station (str): set of years}, as from Cliflo_Status.StatusTable.years.
+    :return: the jobs, sorted.
+    """
+    groups = {}
+    for n, (station_ids, years, year_lists) in enumerate(jobs):
+        group = groups.setdefault(tuple(station_ids), {'first': n, 'values': [], 'newest': min(years), 'jobs': []})
+        group['values'] += [gap_value(year, loaded.get(str(station_id), ()), empty.get(str(station_id), ()))
+                            for station_id in station_ids for year in years if year in year_lists[station_id]]
+        group['newest'] = max(group['newest'], max(years))
+        group['jobs'].append((n, (station_ids, years, year_lists)))
+
+    def group_key(group):
+        return -sum(group['values']) / max(len(group['values']), 1), -group['newest'], group['first']
+
+    return [job for group in sorted(groups.values(), key=group_key)
+            for n, job in sorted(group['jobs'], key=lambda n_job: (-max(n_job[1][1]), n_job[0]))]
@@ -0,0 +1,492 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Server
+Status:        In Progress
+Maintained:    Yes
+Overview:      Local stand in for the Cliflo website so the pipeline can be run, load tested and timed with no network
+               and no NIWA account. It serves the pages Cliflo and Cliflo_HTTP use, with the same field names, link
+               texts and xpaths:
+                   - login page (cusername, cpwd, submit) and the row allowance refresh (sub_refresh).
+                   - query form (datatype2, agent, date1_* / date2_*, submit_sq) and the results page with the
+                     observation table third and a CliFlo Home link.
+                   - datatype popup (Daily and Hourly Observations > category > data set, then it closes itself).
+                   - station search popup (by agent number or lat / long) and Replace Selected Stations.
+               Observations are made up but the same for a station day every time, so any date window lines up with
+               any other, or are recorded result pages replayed in turn. Latency, failure and hang rates, the rows a
+               query may return, a row allowance per login and how long a login lasts can all be set.
+               Selections made in the popups are kept on the server session (cookie) so the browser transport works
+               without javascript writing back to the form. Fields posted with the query (the HTTP transport) are
+               used when the session has none.
+How to use:    python Cliflo_Server.py --port 8000 --latency 0.2 --failure-rate 0.05
+               Cliflo(website='http://127.0.0.1:8000/', transport='http' or 'selenium', ...)
+               or in a script:  server = start_server(latency=0.1) ... server.url ... server.shutdown()
+               http://127.0.0.1:8000/stats gives the requests, failures and rows served as json.
+Requirements:  NA
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+from http.server                import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse               import parse_qs, urlparse, quote
+import argparse
+import datetime
+import hashlib
+import html
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
+import Cliflo
+import Cliflo_HTTP as CH
+
+###########
+# CLASSES #
+###########
+
+
+class CliFloState:
+    """
+    Settings, sessions and counters shared by every request the server handles.
+
+    Class Variables: - paths: the urls Cliflo and Cliflo_HTTP post to.
+    """
+
+    paths = {'login': '/pls/niwp/wa.logindb',
+             'refresh': '/pls/niwp/wa.rowsleft',
+             'form': '/pls/niwp/wgenf.genform1',
+             'query': '/' + CH.CliFloSession.query_path,
+             'datatype': '/pls/niwp/wgenf.choose_datatype',
+             'station_popup': '/pls/niwp/wstn.stn_search',
+             'station_search': '/' + CH.CliFloSession.station_search_path,
+             'replace': '/pls/niwp/wstn.update_stn_query',
+             'stats': '/stats'}
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs:
+            - latency: seconds added to every request, or (min, max) for a random latency. Default is 0.
+            - failure_rate: fraction of queries and station searches that get a 500 error. Default is 0.
+            - hang_rate: fraction of queries and station searches that wait hang_seconds before a 500 error, like a
+                         query that never comes back. Default is 0.
+            - hang_seconds: Default is 30.
+            - row_limit: most rows one query may return, bigger queries get the row limit message instead of a
+                         table. Default is None (no limit).
+            - row_allowance: rows a login may download in total, after that queries get the allowance message.
+                             Default is None (no limit).
+            - session_seconds: how long a login lasts, after that every page is the login page. Default is None
+                               (logins never expire).
+            - empty_rate: fraction of station years with no data. Default is 0.05.
+            - missing_rate: fraction of values that are missing ('-'). Default is 0.05.
+            - stations: number of stations in the catalogue the station search returns. Default is 200.
+            - fixtures: folder of recorded result pages (.html) to replay in turn instead of made up data.
+            - username & password: the only login accepted. Default is None (any login is accepted).
+            - seed: for the latency and failures so a load test can be repeated. Default is 0.
+        """
+        self.latency = kwargs.get('latency', 0)
+        self.failure_rate = kwargs.get('failure_rate', 0)
+        self.hang_rate = kwargs.get('hang_rate', 0)
+        self.hang_seconds = kwargs.get('hang_seconds', 30)
+        self.row_limit = kwargs.get('row_limit', None)
+        self.row_allowance = kwargs.get('row_allowance', None)
+        self.session_seconds = kwargs.get('session_seconds', None)
+        self.empty_rate = kwargs.get('empty_rate', 0.05)
+        self.missing_rate = kwargs.get('missing_rate', 0.05)
+        self.username = kwargs.get('username', None)
+        self.password = kwargs.get('password', None)
+        self.random = random.Random(kwargs.get('seed', 0))
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.stats = {'requests': 0, 'logins': 0, 'queries': 0, 'failures': 0, 'hangs': 0, 'rows': 0,
+                      'row_limited': 0, 'allowance_exceeded': 0, 'expired': 0}
+        self.catalogue = CliFloState.make_catalogue(kwargs.get('stations', 200))
+        self.fixtures = []
+        self.next_fixture = 0
+        if kwargs.get('fixtures'):
+            for file_name in sorted(os.listdir(kwargs['fixtures'])):
+                if file_name.endswith('.html'):
+                    with open(os.path.join(kwargs['fixtures'], file_name), encoding='utf-8') as f:
+                        self.fixtures.append(f.read())
+        self.data_types = {fields['dt1']: data_type for data_type, fields in CH.CliFloSession.datatype_dict.items()}
+
+    @staticmethod
+    def make_catalogue(stations):
+        rng = np.random.default_rng(stations)
+        return pd.DataFrame({'Name': ['Station ' + str(n) for n in range(stations)],
+                             'AgentNumber': [str(100000 + n) for n in range(stations)],
+                             'Network': ['X' + str(n) for n in range(stations)],
+                             'Start Date': ['01-Jan-' + str(year) for year in rng.integers(1900, 1990, stations)],
+                             'End Date': ['31-Dec-' + str(year) for year in rng.integers(2015, 2020, stations)],
+                             'PercentComplete': rng.integers(80, 101, stations),
+                             'Lat(dec deg)': np.round(-47 + rng.random(stations) * 13, 4),
+                             'Long(dec deg)': np.round(166 + rng.random(stations) * 12, 4)})
+
+    def wait(self):
+        latency = self.latency
+        if isinstance(latency, (list, tuple)):
+            with self.lock:
+                latency = self.random.uniform(latency[0], latency[1])
+        if latency:
+            time.sleep(latency)
+
+    def outcome(self):
+        """'ok', 'fail' or 'hang' for a query or station search, from the failure and hang rates."""
+
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.hang_rate:
+            return 'hang'
+        if draw < self.hang_rate + self.failure_rate:
+            return 'fail'
+        return 'ok'
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def session(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None and self.session_seconds is not None and \
+                    time.time() - session['started'] > self.session_seconds:
+                del self.sessions[session_id]
+                self.stats['expired'] += 1
+                return None
+            return session
+
+    def login(self, username, password):
+        if self.username is not None and (username != self.username or password != self.password):
+            return None
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = {'user': username, 'data_type': None, 'stations': None,
+                                         'rows_left': self.row_allowance, 'started': time.time()}
+        CliFloState.count(self, 'logins')
+        return session_id
+
+    def use_rows(self, session, rows):
+        """Takes rows off the session's allowance. Returns False (and takes nothing) if there are not enough left."""
+
+        with self.lock:
+            if session['rows_left'] is not None:
+                if rows > session['rows_left']:
+                    return False
+                session['rows_left'] -= rows
+            self.stats['rows'] += rows
+        return True
+
+    @staticmethod
+    def year_draw(station, year):
+        """
+        Number in [0, 1) for a station year, the same every run. Hashed so neighbouring stations and years are
+        independent, a station year is empty when it is below empty_rate.
+        """
+        digest = hashlib.md5(('%s/%d' % (station, year)).encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) / 16 ** 8
+
+    def obs_rows(self, stations, data_type, start_date, end_date):
+        """
+        Made up observations for each station and day from start_date up to (not including) end_date. A value
+        depends only on the station and day so overlapping queries agree.
+
+        :return: list of rows (lists of cell text), header row first.
+        """
+        value_cols = [col for col in Cliflo.Cliflo.station_clean_dict[data_type][0] if col != 'Station']
+        header = ['Station', 'Date(NZST)'] + value_cols + ['Period(Hrs)', 'Freq']
+        days = pd.date_range(start_date, end_date - datetime.timedelta(1))
+        rows = [header]
+        if len(days) == 0:
+            return rows
+        ordinals = np.array([day.toordinal() for day in days], dtype='int64')
+        dates = days.strftime('%Y%m%d:0900')
+        years = days.year.to_numpy()
+        for station in stations:
+            number = int(station) if str(station).isdigit() else sum(map(ord, str(station)))
+            empty_years = {year: CliFloState.year_draw(station, year) < self.empty_rate for year in set(years)}
+            empty = np.array([empty_years[year] for year in years], dtype=bool)
+            for c, col in enumerate(value_cols):
+                seed = (number * 7919 + ordinals * 104729 + c * 1299709) % 1000003
+                values = np.round((seed % 2003) / 100.0, 1).astype(str)
+                values[(seed % 997) / 997 < self.missing_rate] = '-'
+                if c == 0:
+                    table = [[str(station), date] for date in dates]
+                [row.append(value) for row, value in zip(table, values)]
+            rows += [row + ['24', 'D'] for row, is_empty in zip(table, empty) if not is_empty]
+        return rows
+
+
+class CliFloHandler(BaseHTTPRequestHandler):
+    """Serves one request. The server's CliFloState is self.server.state."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # quiet, the counts are on /stats
+        pass
+
+    def do_GET(self):
+        CliFloHandler.handle_request(self, parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        fields = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True)
+        fields.update(parse_qs(urlparse(self.path).query))
+        CliFloHandler.handle_request(self, fields)
+
+    def handle_request(self, fields):
+        state = self.server.state
+        state.count('requests')
+        state.wait()
+        path = urlparse(self.path).path
+        session = state.session(CliFloHandler.cookie(self))
+        fields = {name: values[0] if len(values) == 1 else values for name, values in fields.items()}
+
+        if path == CliFloState.paths['stats']:
+            return CliFloHandler.send(self, json.dumps(state.stats), content_type='application/json')
+        if path == CliFloState.paths['login']:
+            return CliFloHandler.login(self, fields)
+        if session is None:
+            return CliFloHandler.send(self, CliFloHandler.login_page())
+        if path == CliFloState.paths['refresh']:
+            # redirected so the query form is a GET in the browser history and driver.back() can return to it
+            return CliFloHandler.send(self, '', status=303, headers={'Location': CliFloState.paths['form']})
+        if path == CliFloState.paths['form']:
+            return CliFloHandler.send(self, CliFloHandler.form_page(session))
+        if path == CliFloState.paths['datatype']:
+            return CliFloHandler.datatype_page(self, session, fields)
+        if path == CliFloState.paths['station_popup']:
+            return CliFloHandler.send(self, CliFloHandler.station_popup_page())
+        if path == CliFloState.paths['replace']:
+            cstn = fields.get('cstn', [])
+            session['stations'] = cstn if isinstance(cstn, list) else [cstn]
+            return CliFloHandler.send(self, CliFloHandler.page('<p>Selected stations: ' +
+                                                               html.escape(', '.join(session['stations'])) + '</p>'))
+
+        if path in (CliFloState.paths['query'], CliFloState.paths['station_search']):
+            outcome = state.outcome()
+            if outcome == 'hang':
+                state.count('hangs')
+                time.sleep(state.hang_seconds)
+            if outcome != 'ok':
+                state.count('failures')
+                return CliFloHandler.send(self, CliFloHandler.page('<p>Server error</p>'), status=500)
+            if path == CliFloState.paths['query']:
+                return CliFloHandler.query(self, session, fields)
+            return CliFloHandler.station_search(self, fields)
+        return CliFloHandler.send(self, CliFloHandler.login_page())
+
+    def cookie(self):
+        for part in (self.headers.get('Cookie') or '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'cliflo_session':
+                return value
+        return None
+
+    def send(self, body, status=200, content_type='text/html; charset=utf-8', headers=None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        [self.send_header(name, value) for name, value in (headers or {}).items()]
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def page(body, title='CliFlo'):
+        return '<html><head><title>' + title + '</title></head><body>' + body + '</body></html>'
+
+    @staticmethod
+    def login_page():
+        return CliFloHandler.page('<form action="' + CliFloState.paths['login'] + '" method="post">'
+                                  'Username <input type="text" name="cusername"> '
+                                  'Password <input type="password" name="cpwd"> '
+                                  '<input type="submit" name="submit" value="login"></form>', 'CliFlo Login')
+
+    def login(self, fields):
+        session_id = self.server.state.login(fields.get('cusername'), fields.get('cpwd'))
+        if session_id is None:
+            return CliFloHandler.send(self, CliFloHandler.login_page())
+        body = CliFloHandler.page('<form action="' + CliFloState.paths['refresh'] + '" method="post">'
+                                  'Logged in as ' + html.escape(str(fields.get('cusername'))) +
+                                  ' <input type="submit" name="sub_refresh" value="Refresh"></form>')
+        CliFloHandler.send(self, body, headers={'Set-Cookie': 'cliflo_session=' + session_id + '; Path=/'})
+
+    @staticmethod
+    def form_page(session):
+        dt1 = ''
+        if session['data_type'] is not None:
+            dt1 = CH.CliFloSession.datatype_dict[session['data_type']]['dt1']
+        dates = ''.join('<input type="text" name="date%d_%d" size="4">' % (n, part)
+                        for n in (1, 2) for part in (1, 2, 3, 4))
+        rows_left = 'unlimited' if session['rows_left'] is None else str(session['rows_left'])
+        return CliFloHandler.page(
+            '<p>Rows left: ' + rows_left + '</p>'
+            '<form action="' + CliFloState.paths['query'] + '" method="post">'
+            '<input type="hidden" name="dt1" value="' + dt1 + '"><input type="hidden" name="prm1" value="1">'
+            '<input type="hidden" name="cstn_id" value="A"><input type="hidden" name="mimeselect" value="htmltable">'
+            '<input type="button" name="datatype2" value="Choose datatype" '
+            'onclick="window.open(\'' + CliFloState.paths['datatype'] + '\', \'datatype\')">'
+            '<input type="button" name="agent" value="Choose stations" '
+            'onclick="window.open(\'' + CliFloState.paths['station_popup'] + '\', \'stations\')">'
+            + dates + '<input type="submit" name="submit_sq" value="Send Query"></form>', 'CliFlo Query')
+
+    def datatype_page(self, session, fields):
+        """Popup: Daily and Hourly Observations, then the category, then the data set which closes the popup."""
+
+        path = CliFloState.paths['datatype']
+        if 'data_type' in fields:
+            session['data_type'] = fields['data_type']
+            return CliFloHandler.send(self, CliFloHandler.page('<script>window.close();</script>'))
+        if 'category' in fields:
+            links = [(data_type, sets[1]) for data_type, sets in Cliflo.Cliflo.data_type_dict.items()
+                     if sets[0] == fields['category']]
+            body = ''.join('<a href="' + path + '?data_type=' + data_type + '">' + html.escape(name) + '</a><br>'
+                           for data_type, name in links)
+        elif 'level' in fields:
+            categories = sorted(set(sets[0] for sets in Cliflo.Cliflo.data_type_dict.values()))
+            body = ''.join('<a href="' + path + '?category=' + quote(category) + '">' + html.escape(category) +
+                           '</a><br>' for category in categories)
+        else:
+            body = '<a href="' + path + '?level=1">Daily and Hourly Observations</a>'
+        CliFloHandler.send(self, CliFloHandler.page(body, 'Datatype'))
+
+    @staticmethod
+    def station_popup_page():
+        return CliFloHandler.page(
+            '<form action="' + CliFloState.paths['station_search'] + '" method="post">'
+            '<input type="radio" name="cstype" value="ag" checked> Agent numbers '
+            '<input type="text" name="cAgent"><br>'
+            '<input type="radio" name="cstype" value="latlongc"> Lat <input type="text" name="clat1"> '
+            'Long <input type="text" name="clong1"> Radius <input type="text" name="crad"><br>'
+            '<input type="submit" name="Submit" value="Get Station List"></form>', 'Station search')
+
+    def station_search(self, fields):
+        """Station list (every station in the catalogue for a lat / long search) in the form cf_get_data reads."""
+
+        catalogue = self.server.state.catalogue
+        if fields.get('cstype') == 'ag':
+            agents = [agent.strip() for agent in str(fields.get('cAgent', '')).split(',') if agent.strip()]
+            found = catalogue.set_index('AgentNumber').reindex(agents).reset_index()
+            found['Name'] = found['Name'].fillna('Station ' + found['AgentNumber'])
+            found = found.fillna('')[catalogue.columns]
+        else:
+            found = catalogue
+        header = '<tr><td>Select</td>' + ''.join('<td>' + html.escape(col) + '</td>' for col in found.columns) + \
+                 '</tr>'
+        rows = ''.join('<tr><td><input type="checkbox" name="cstn" value="' + html.escape(str(row[1])) + '"></td>' +
+                       ''.join('<td>' + html.escape(str(value)) + '</td>' for value in row) + '</tr>'
+                       for row in found.itertuples(index=False))
+        CliFloHandler.send(self, CliFloHandler.page(
+            '<a href="/">CliFlo Home</a><form action="' + CliFloState.paths['replace'] + '" method="post">'
+            '<table>' + header + rows + '</table>'
+            '<input type="submit" name="Submit" value="Replace Selected Stations"></form>', 'Station list'))
+
+    def query(self, session, fields):
+        """Results page for the selected stations, data type and dates (1 Jan if any date part is missing)."""
+
+        state = self.server.state
+        state.count('queries')
+        data_type = session['data_type'] or state.data_types.get(fields.get('dt1'), 'rainfall')
+        stations = session['stations'] or [station for station in str(fields.get('agents', '')).split(',')
+                                           if station]
+
+        def date(n):
+            try:
+                return datetime.date(int(fields.get('date%d_1' % n)), int(fields.get('date%d_2' % n) or 1),
+                                     int(fields.get('date%d_3' % n) or 1))
+            except (TypeError, ValueError):
+                return None
+
+        start_date, end_date = date(1), date(2)
+        if start_date is None or end_date is None:
+            return CliFloHandler.send(self, CliFloHandler.results_page('<p>Invalid date</p>'))
+
+        if state.fixtures:
+            with state.lock:
+                page = state.fixtures[state.next_fixture % len(state.fixtures)]
+                state.next_fixture += 1
+            return CliFloHandler.send(self, page)
+
+        rows = state.obs_rows(stations, data_type, start_date, end_date)
+        if state.row_limit is not None and len(rows) - 1 > state.row_limit:
+            state.count('row_limited')
+            return CliFloHandler.send(self, CliFloHandler.results_page(
+                '<p class="error">Row limit exceeded: the query would return ' + str(len(rows) - 1) +
+                ' rows, the limit is ' + str(state.row_limit) + '</p>'))
+        if not state.use_rows(session, len(rows) - 1):
+            state.count('allowance_exceeded')
+            return CliFloHandler.send(self, CliFloHandler.results_page(
+                '<p class="error">Row allowance exceeded: ' + str(session['rows_left']) + ' rows left</p>'))
+
+        table = ('<table><tr><td colspan="' + str(len(rows[0])) + '">' + data_type + ': Daily</td></tr>' +
+                 ''.join('<tr><td>' + '</td><td>'.join(row) + '</td></tr>' for row in rows) + '</table>')
+        CliFloHandler.send(self, CliFloHandler.results_page(table))
+
+    @staticmethod
+    def results_page(body):
+        # observation table is the third table, as cf_get_data expects
+        return CliFloHandler.page('<a href="/">CliFlo Home</a><table><tr><td>CliFlo</td></tr></table>'
+                                  '<table><tr><td>Query results</td></tr></table>' + body, 'CliFlo Results')
+
+
+#############
+# FUNCTIONS #
+#############
+
+
+def start_server(host='127.0.0.1', port=0, **kwargs):
+    """
+    Starts the server in a background thread.
+
+    :param port: 0 picks a free port.
+    :param kwargs: settings for CliFloState (latency, failure_rate etc.).
+    :return: the server, with its state and url. Stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), CliFloHandler)
+    server.daemon_threads = True
+    server.state = CliFloState(**kwargs)
+    server.url = 'http://%s:%d/' % (host, server.server_address[1])
+    threading.Thread(target=server.serve_forever, name='cliflo_server', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand in for the Cliflo website.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, nargs='+', default=[0],
+                        help='seconds per request, or min and max for a random latency')
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--hang-rate', type=float, default=0)
+    parser.add_argument('--hang-seconds', type=float, default=30)
+    parser.add_argument('--row-limit', type=int, default=None)
+    parser.add_argument('--row-allowance', type=int, default=None)
+    parser.add_argument('--session-seconds', type=float, default=None)
+    parser.add_argument('--empty-rate', type=float, default=0.05)
+    parser.add_argument('--stations', type=int, default=200)
+    parser.add_argument('--fixtures', default=None, help='folder of recorded result pages to replay')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cliflo_server = start_server(args.host, args.port,
+                                 latency=args.latency[0] if len(args.latency) == 1 else tuple(args.latency[:2]),
+                                 failure_rate=args.failure_rate, hang_rate=args.hang_rate,
+                                 hang_seconds=args.hang_seconds, row_limit=args.row_limit,
+                                 row_allowance=args.row_allowance, session_seconds=args.session_seconds,
+                                 empty_rate=args.empty_rate, stations=args.stations, fixtures=args.fixtures,
+                                 seed=args.seed)
+    print('Cliflo stand in running at ' + cliflo_server.url)
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(cliflo_server.state.stats))
+    except KeyboardInterrupt:
+        cliflo_server.shutdown()
@@ -0,0 +1,190 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Status
+Status:        In Progress
+Maintained:    Yes
+Overview:      Long format status table for Cliflo.update_data, one row per (data_type, station, year) with its
+               status ('loaded' or 'empty'), how complete the data was and when it was last updated. It replaces the
+               wide stations table with a column per data_type_year, so a longer year range needs no new columns.
+               Writes are buffered and flushed in one transaction per batch rather than one commit per station year.
+How to use:    cliflo.update_data(..., status_table='cliflo_status')   (the default)
+               StatusTable(cliflo.engine).import_wide('cliflo_rainfall_station_info_table_test3', 'rainfall')
+               copies the statuses out of an existing wide stations table.
+Requirements:  PostgreSQL 9.5 or later (ON CONFLICT).
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+from collections                import defaultdict
+from sqlalchemy                 import text
+import re
+import threading
+import time
+import pandas as pd
+
+###########
+# CLASSES #
+###########
+
+
+class StatusTable:
+    """
+    Buffered writer and reader for the status table.
+
+    Status is one of:
+        - loaded: Cliflo had data for the station year, completeness is the fraction of values that were not missing.
+        - empty:  Cliflo had no data for the station year.
+    """
+
+    def __init__(self, engine, **kwargs):
+        """
+        :param engine: SQLAlchemy engine for the database the table lives in.
+        :param kwargs:
+            - table_name: name of the status table. Default is cliflo_status.
+            - flush_rows: statuses to buffer before writing them. Default is 500.
+            - flush_seconds: longest time a status waits in the buffer. Default is 60.
+        """
+        self.engine = engine
+        self.table_name = kwargs.get('table_name', 'cliflo_status')
+        self.flush_rows = kwargs.get('flush_rows', 500)
+        self.flush_seconds = kwargs.get('flush_seconds', 60)
+        self.lock = threading.Lock()
+        self.buffer = {}
+        self.last_flush = time.time()
+
+        StatusTable.create_table(self)
+
+    def create_table(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS %s (
+                    data_type    TEXT NOT NULL,
+                    station      INTEGER NOT NULL,
+                    year         SMALLINT NOT NULL,
+                    status       TEXT NOT NULL,
+                    completeness DOUBLE PRECISION,
+                    updated_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (data_type, station, year))""" % self.table_name))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS %s_status_idx ON %s (data_type, status, station, year)'
+                              % (self.table_name, self.table_name)))
+
+    @staticmethod
+    def to_status(entry_status):
+        """Turns the output of Cliflo.analyse_cf_data ('empty' or the fraction missing) into (status, completeness)."""
+
+        if entry_status == 'empty':
+            return 'empty', None
+        try:
+            return 'loaded', 1 - float(entry_status)
+        except (TypeError, ValueError):
+            return 'loaded', None
+
+    def record(self, data_type, station, year, entry_status):
+        """Buffers the status of a station year, flushing when the buffer is full or old enough."""
+
+        status, completeness = StatusTable.to_status(entry_status)
+        with self.lock:
+            self.buffer[(data_type, int(station), int(year))] = (status, completeness)
+            due = len(self.buffer) >= self.flush_rows or time.time() - self.last_flush >= self.flush_seconds
+        if due:
+            StatusTable.flush(self)
+
+    def flush(self):
+        """Writes every buffered status in one transaction. Returns the number written."""
+
+        with self.lock:
+            rows = [{'data_type': key[0], 'station': key[1], 'year': key[2], 'status': value[0],
+                     'completeness': value[1]} for key, value in self.buffer.items()]
+            self.buffer = {}
+            self.last_flush = time.time()
+            if rows:
+                with self.engine.begin() as conn:
+                    conn.execute(text('INSERT INTO %s (data_type, station, year, status, completeness) '
+                                      'VALUES (:data_type, :station, :year, :status, :completeness) '
+                                      'ON CONFLICT (data_type, station, year) DO UPDATE SET status = excluded.status, '
+                                      'completeness = excluded.completeness, updated_at = now()' % self.table_name),
+                                 rows)
+        return len(rows)
+
+    def years(self, data_type, status=None):
+        """
+        Years with a status for every station of a data_type.
+
+        :param status: only years with this status (e.g 'empty'). Default is any status.
+        :return: {station (str): set of years}
+        """
+        args = 'SELECT station, year FROM %s WHERE data_type = :data_type' % self.table_name
+        params = {'data_type': data_type}
+        if status is not None:
+            args += ' AND status = :status'
+            params['status'] = status
+        years = defaultdict(set)
+        with self.engine.connect() as conn:
+            [years[str(station)].add(int(year)) for station, year in conn.execute(text(args), params)]
+        return years
+
+    def missing(self, data_type, station_list, start_year, end_year):
+        """
+        Station years in start_year to end_year (inclusive) with no status yet, worked out in the database.
+
+        :return: dataframe of station, year.
+        """
+        with self.engine.connect() as conn:
+            return pd.read_sql(text("""
+                SELECT s.station, y.year
+                FROM unnest(CAST(:stations AS integer[])) AS s (station)
+                CROSS JOIN generate_series(:start_year, :end_year) AS y (year)
+                WHERE NOT EXISTS (SELECT 1 FROM {0} t WHERE t.data_type = :data_type AND t.station = s.station
+                                  AND t.year = y.year)
+                ORDER BY s.station, y.year""".format(self.table_name)), conn,
+                params={'stations': [int(station) for station in station_list], 'start_year': start_year,
+                        'end_year': end_year, 'data_type': data_type})
+
+    def forget(self, data_type, station_list, status=None):
+        """
+        Deletes the statuses of the stations so their years are planned again, e.g after Cliflo changed a station's
+        details (see Cliflo.update_changed_stations).
+
+        :param status: only statuses of this status (e.g 'empty'). Default is any status.
+        :return: number of statuses deleted.
+        """
+        StatusTable.flush(self)
+        args = 'DELETE FROM %s WHERE data_type = :data_type AND station = ANY(CAST(:stations AS integer[]))' \
+               % self.table_name
+        params = {'data_type': data_type, 'stations': [int(station) for station in station_list]}
+        if status is not None:
+            args += ' AND status = :status'
+            params['status'] = status
+        with self.engine.begin() as conn:
+            return conn.execute(text(args), params).rowcount
+
+    def import_wide(self, wide_table_name, data_type):
+        """
+        Copies statuses out of a wide stations table (a data_type_year column per year, see
+        Cliflo.create_stations_table) into the status table. Existing statuses are overwritten.
+
+        :return: number of statuses imported.
+        """
+        wide = pd.read_sql('SELECT * FROM %s' % wide_table_name, self.engine)
+        year_cols = [col for col in wide.columns if re.fullmatch(re.escape(data_type) + r'_\d{4}', col)]
+        long = wide.melt(id_vars=['stations'], value_vars=year_cols, var_name='col', value_name='entry_status')
+        long = long[long['entry_status'].notna()]
+        for row in long.itertuples(index=False):
+            with self.lock:
+                status, completeness = StatusTable.to_status(row.entry_status)
+                self.buffer[(data_type, int(row.stations), int(row.col[-4:]))] = (status, completeness)
+        StatusTable.flush(self)
+        print(str(len(long)) + ' statuses imported from ' + wide_table_name)
+        return len(long)
+
+    def summary(self):
+        """Station years in each status for every data_type, as a dataframe."""
+
+        return pd.read_sql('SELECT data_type, status, count(*) AS station_years, avg(completeness) AS completeness, '
+                           'max(updated_at) AS last_update FROM %s GROUP BY data_type, status '
+                           'ORDER BY data_type, status' % self.table_name, self.engine)
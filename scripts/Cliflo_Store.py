@@ -0,0 +1,160 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Cliflo_Store
+Status:        In Progress
+Maintained:    Yes
+Overview:      Columnar store for cleaned Cliflo observations. Observations are written as parquet files partitioned
+               by data_type / station / year (hive style folders, e.g. data_type=rainfall/station=1234/year=1999) so
+               reading a few stations over a range of years only opens the files it needs and only the columns
+               asked for. It is the third place Cliflo.update_data can send data, alongside the database and csv.
+How to use:    cliflo.update_data(..., sink='parquet', parquet_folder='C:\\data\\cliflo_parquet')
+               ParquetStore(folder).read('rainfall', stations=[...], start_year=1987, end_year=2018)
+Requirements:  pyarrow
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+import os
+import threading
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+###########
+# CLASSES #
+###########
+
+
+class ParquetStore:
+    """
+    Parquet observation store partitioned by data_type, station and year.
+
+    station and year are held in the folder names rather than in the files, every other column of the cleaned
+    observations (see Cliflo.station_obs_preprocess) is stored in the file with a proper type.
+    """
+
+    partition_cols = ['station', 'year']
+    int_cols = ['month', 'day']
+
+    def __init__(self, folder, **kwargs):
+        """
+        :param folder: root folder of the store, created if it does not exist.
+        :param kwargs:
+            - compression: parquet compression codec. Default is zstd.
+        """
+        if pa is None:
+            raise ImportError('ParquetStore needs pyarrow, install it with "pip install pyarrow"')
+        self.folder = folder
+        self.compression = kwargs.get('compression', 'zstd')
+        self.lock = threading.Lock()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def partition_path(self, data_type, station=None, year=None):
+        path = os.path.join(self.folder, 'data_type=' + data_type)
+        if station is not None:
+            path = os.path.join(path, 'station=' + str(station))
+        if year is not None:
+            path = os.path.join(path, 'year=' + str(int(year)))
+        return path
+
+    def write(self, df, data_type):
+        """
+        Writes cleaned observations, replacing whatever is already stored for each station year in df so writing
+        the same data twice gives the same store.
+
+        :return: number of rows written.
+        """
+        if df.empty:
+            return 0
+        df = ParquetStore.to_types(df)
+        for (station, year), part in df.groupby(ParquetStore.partition_cols, sort=False):
+            path = ParquetStore.partition_path(self, data_type, station, year)
+            with self.lock:
+                if not os.path.exists(path):
+                    os.makedirs(path)
+            table = pa.Table.from_pandas(part.drop(columns=ParquetStore.partition_cols), preserve_index=False)
+            tmp_file = os.path.join(path, 'part-0.parquet.' + str(threading.get_ident()) + '.tmp')
+            pq.write_table(table, tmp_file, compression=self.compression)
+            os.replace(tmp_file, os.path.join(path, 'part-0.parquet'))
+        return len(df)
+
+    @staticmethod
+    def to_types(df):
+        """Typed copy of a cleaned observation frame: counts as small ints, values as floats, keys as strings."""
+
+        df = df.copy()
+        for col in df.columns:
+            if col in ParquetStore.partition_cols or col == 'rowid':
+                df[col] = df[col].astype(str)
+            elif col in ParquetStore.int_cols:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int16')
+            elif col.endswith('_estimated'):
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int8')
+            else:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+        return df
+
+    def years(self, data_type, station):
+        """Years stored for a station, as a set of ints."""
+
+        path = ParquetStore.partition_path(self, data_type, station)
+        if not os.path.exists(path):
+            return set()
+        return set(int(name[5:]) for name in os.listdir(path)
+                   if name.startswith('year=') and os.path.exists(os.path.join(path, name, 'part-0.parquet')))
+
+    def read(self, data_type, **kwargs):
+        """
+        Reads observations for a data_type. Only the partitions and columns asked for are read.
+
+        :param kwargs:
+            - stations: list of stations to read. Default is all.
+            - start_year & end_year: years to read, inclusive. Default is all.
+            - columns: columns to return (station and year are always returned). Default is all.
+        :return: dataframe
+        """
+        stations = kwargs.get('stations', None)
+        start_year = kwargs.get('start_year', None)
+        end_year = kwargs.get('end_year', None)
+        columns = kwargs.get('columns', None)
+
+        path = ParquetStore.partition_path(self, data_type)
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        partitioning = ds.partitioning(pa.schema([('station', pa.string()), ('year', pa.int16())]), flavor='hive')
+        # build the file list from the station / year folders asked for, so files outside them are never opened (a
+        # dataset over the whole folder reads a file's footer for the schema whether it is asked for or not)
+        folder_stations = sorted(name[8:] for name in os.listdir(path) if name.startswith('station='))
+        files = [os.path.join(ParquetStore.partition_path(self, data_type, station, year), 'part-0.parquet')
+                 for station in (folder_stations if stations is None else stations)
+                 for year in sorted(ParquetStore.years(self, data_type, station))
+                 if (start_year is None or year >= start_year) and (end_year is None or year <= end_year)]
+        if not files:
+            return pd.DataFrame()
+        dataset = ds.dataset(files, format='parquet', partitioning=partitioning, partition_base_dir=path)
+
+        expression = None
+        filters = []
+        if stations is not None:
+            filters.append(ds.field('station').isin([str(station) for station in stations]))
+        if start_year is not None:
+            filters.append(ds.field('year') >= start_year)
+        if end_year is not None:
+            filters.append(ds.field('year') <= end_year)
+        for f in filters:
+            expression = f if expression is None else expression & f
+
+        if columns is not None:
+            columns = ParquetStore.partition_cols + [col for col in columns if col not in ParquetStore.partition_cols]
+        return dataset.to_table(columns=columns, filter=expression).to_pandas()
@@ -0,0 +1,90 @@
+############
+# OVERVIEW #
+############
+"""
+Script Name:   Db_Registry
+Status:        In Progress
+Maintained:    Yes
+Overview:      One database engine (and connection pool) per connection string for the whole process, shared by
+               Cliflo, FarmInputs, MyData and anything else that connects. Tables are reflected one at a time, the
+               first time they are asked for, instead of reflecting the whole database every time an object is made.
+How to use:    engine = get_engine(db_string)
+               Stations = table_class(db_string, 'cliflo_rainfall_station_info_table_test3')
+               session.query(Stations).filter(...)
+Requirements:  NA
+TODO:          NA
+"""
+
+############
+# PACKAGES #
+############
+
+from sqlalchemy                 import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+import threading
+
+#############
+# FUNCTIONS #
+#############
+
+engines = {}
+bases = {}
+classes = {}
+lock = threading.RLock()
+
+
+def get_engine(db_string, **kwargs):
+    """
+    Engine for a connection string, created the first time it is asked for.
+
+    :param kwargs:
+        - pool_size & max_overflow: used when the engine is created. Defaults are 50 and 0.
+    """
+    with lock:
+        if db_string not in engines:
+            engines[db_string] = create_engine(db_string, pool_size=kwargs.get('pool_size', 50),
+                                               max_overflow=kwargs.get('max_overflow', 0))
+        return engines[db_string]
+
+
+def get_base(db_string):
+    """Declarative base for a connection string. Its metadata only holds the tables reflected so far."""
+
+    with lock:
+        if db_string not in bases:
+            bases[db_string] = declarative_base()
+        return bases[db_string]
+
+
+def table_class(db_string, table_name):
+    """
+    ORM class for an existing table. Only this table is reflected, and only the first time it is asked for, after
+    that the same class is returned.
+    """
+    with lock:
+        if (db_string, table_name) not in classes:
+            base = get_base(db_string)
+            if table_name not in base.metadata.tables:
+                base.metadata.reflect(get_engine(db_string), only=[table_name])
+            classes[(db_string, table_name)] = type('Table_' + table_name, (base,), {'__tablename__': table_name})
+        return classes[(db_string, table_name)]
+
+
+def forget(db_string, table_name):
+    """Drops a table's class and reflection so it is reflected again next time, used after a table is altered."""
+
+    with lock:
+        classes.pop((db_string, table_name), None)
+        if db_string in bases:
+            # a fresh base, classes already handed out keep working with the old one
+            tables = bases[db_string].metadata.tables
+            if table_name in tables:
+                bases[db_string] = declarative_base()
+                [classes.pop(key) for key in list(classes) if key[0] == db_string]
+
+
+def dispose():
+    """Closes every pooled connection, e.g. before forking worker processes."""
+
+    with lock:
+        [engine.dispose() for engine in engines.values()]
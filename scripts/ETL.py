@@ -1,11 +1,29 @@
 import Cliflo as CF
+import Cliflo_Jobs as CJ
+import Cliflo_Status as CST
+import Cliflo_Manifest as CM
+import Cliflo_Cache as CC
+import Cliflo_Catalogue as CCT
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import os
+import time
+import pandas as pd
 
 extract_data = 'Cliflo'
 extract = True #Means it will extrat data from NIWA.
 key_val1 = 'sunshine_hours' # options include rainfall, soil_moisture, evaporation, sunshine_hours
 start_year = 1987
 end_year = 2018
+use_job_queue = False # Share the work with other machines through a job table in the database (see Cliflo_Jobs).
+fill_gaps = False # Re-estimate missing days from neighbouring stations once the data is loaded (see Cliflo_Gaps).
+delta = False # Only fetch the days after each station's latest stored day, for keeping the tables current.
+migrate_tables = False # Convert tables made before the typed schema (all text columns) in place, safe to re-run.
+output_root = os.environ.get('LAND_USE_DATA', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                           'data')) # station lists and downloads go in here
+concurrency = 4 # data types run at the same time, each with its own Cliflo login
+workers = 1 # browser sessions per data type (see Cliflo.update_data)
+catalogue_ttl = 168 # hours a saved station list is used before the station search is run again (see Cliflo_Catalogue)
 
 # file dict specifies the folder name, the station list name, the obs data_table and the station info data table.
 
@@ -29,51 +47,213 @@ file_dict = {'rainfall': ['cliflo_rainfall_station_data',
              }
 
 
-def main():
-
-    for key_val, value in file_dict.items():
-        path_results = 'C:\\Users\\risid\\Google Drive\\Python\\land-use-models\\data\\' + file_dict[key_val][0]
-        path_stations = 'C:\\Users\\risid\\Google Drive\\Python\\land-use-models\\data\\station_lists'
-
-        if extract_data == 'Cliflo':
-            
-            #Set up cliflo session with username and password
-            cliflo = CF.Cliflo(username=os.environ.get('CLIFLO_USER'),
-                               password=os.environ.get('CLIFLO_PW'),
-                               db_name='sandpit', # optional if wanting to extract data to a database
-                               db_user_name=os.environ.get('POSTGRES_USER'),
-                               db_user_password=os.environ.get('POSTGRES_PW'))
-
-            if extract:
-                # Works out what stations we want to use from Cliflo                
-                cliflo.extract_stations(to_folder=path_stations, # where the data goes
-                                        file_name=file_dict[key_val][1], #csv file name of stations 
-                                        data_type=key_val, # type of data we want the stations for i.e rainfall
-                                        start_year=start_year, # beginning year we want to make sure is included in the station data
-                                        end_year=end_year, # as above but the last year.
-                                        min_perc_complete=100, # percentage complete of the data in the CLIflo dataset. 
-                                        station_table_name=file_dict[key_val][3], # only relevant if putting values into SQL
-                                        use_file=path_stations+'\\'+file_dict[key_val][1] + '.xlsx') # if this is false it will query Clifo directty but if you already have a csv of ths stations you want use that :)
-
-            cliflo.update_data(stations=path_stations + '\\' + file_dict[key_val][1] + '.xlsx',
-                               to_folder=path_results,
-                               data_type=key_val,
-                               freq='daily',
-                               update_table=True,
-                               table_name=file_dict[key_val][2],
-                               use_existing_data=True,
-                               csv_only=False, # IMPORTANT - MAKE TRUE TO ONLY EXTRACT DATA TO CSV FORMAT AND NOT TO A DATABASE TOO.
-                               start_year=start_year,
-                               end_year=end_year,
-                               station_table_name=file_dict[key_val][3])
-
-        # elif extract_data == 'MaMiro':
-        #     mmd = ETL.MaMiroData(db_name='sandpit',
-        #                          db_user_name='postgres',
-        #                          db_user_password='&MaM!r0postgres&')
-        # 
-        #     mmd.update_data(file='C:\\Users\\risid\\Google Drive\\Python\\land-use-models\\data\\mamiro_cost_estimates\\pricing_database.xlsx',
-        #                     table_name='mamirodata2')
+def parse_args(argv=None):
+    """Command line options, the defaults are the settings at the top of this file."""
+
+    parser = argparse.ArgumentParser(description='Extract Cliflo data for several data types at once.')
+    parser.add_argument('data_types', nargs='*', default=list(file_dict),
+                        help='data types to run (default all of: ' + ', '.join(file_dict) + ')')
+    parser.add_argument('--start-year', type=int, default=start_year)
+    parser.add_argument('--end-year', type=int, default=end_year)
+    parser.add_argument('--output-root', default=output_root,
+                        help='folder for station lists, downloads and the manifest (default %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=concurrency, help='data types to run at once')
+    parser.add_argument('--workers', type=int, default=workers, help='browser sessions per data type')
+    parser.add_argument('--db-name', default='sandpit')
+    parser.add_argument('--db-host', default='127.0.0.1')
+    parser.add_argument('--transport', default='selenium', choices=['selenium', 'http'])
+    parser.add_argument('--website', default='https://cliflo.niwa.co.nz/',
+                        help='Cliflo url, change to point at a local stand in server (see Cliflo_Server)')
+    parser.add_argument('--parser', default='read_html', choices=['read_html', 'stream'])
+    parser.add_argument('--cache', action='store_true', help='keep raw downloads in a compressed cache '
+                                                            '(output root/raw_cache) instead of csv files')
+    parser.add_argument('--metrics', default=None, help='folder for the stage timings, rates and ETA as json lines '
+                                                        'and a Prometheus text file (default output root/metrics)')
+    parser.add_argument('--refresh-below', type=int, default=10000,
+                        help='log in again to refresh the Cliflo row allowance below this many rows left')
+    parser.add_argument('--csv-only', action='store_true', help='do not load the data into the database')
+    parser.add_argument('--no-extract', dest='extract', action='store_false', default=extract,
+                        help='use the saved station lists rather than checking the stations')
+    parser.add_argument('--catalogue-ttl', type=float, default=catalogue_ttl,
+                        help='hours a saved station list is used before searching Cliflo again')
+    parser.add_argument('--refresh-stations', action='store_true',
+                        help='search Cliflo for the stations even if the saved list is fresh')
+    parser.add_argument('--job-queue', action='store_true', default=use_job_queue)
+    parser.add_argument('--fill-gaps', action='store_true', default=fill_gaps)
+    parser.add_argument('--delta', action='store_true', default=delta,
+                        help="only fetch the days since each station's latest stored day (see Cliflo.delta_sync)")
+    parser.add_argument('--migrate-tables', action='store_true', default=migrate_tables)
+    args = parser.parse_args(argv)
+    unknown = [key_val for key_val in args.data_types if key_val not in file_dict]
+    if unknown:
+        parser.error('unknown data types: ' + ', '.join(unknown))
+    if args.fill_gaps and args.csv_only:
+        # the gaps are filled in the observation table, which --csv-only never creates
+        parser.error('--fill-gaps needs the data in the database, it can not be used with --csv-only')
+    return args
+
+
+def run_data_type(key_val, args, shared):
+    """
+    Runs the extraction of one data type. Everything but the Cliflo login is shared with the other data types
+    running at the same time: the database engine (see Db_Registry), status table, manifest and raw cache.
+
+    :param shared: dict of the shared status table, manifest and cache (False if not used), metrics folder and
+                   station catalogue.
+    :return: dict of jobs, rows and time taken for the summary.
+    """
+    start = time.time()
+    path_results = os.path.join(args.output_root, file_dict[key_val][0])
+    path_stations = os.path.join(args.output_root, 'station_lists')
+    station_file = os.path.join(path_stations, file_dict[key_val][1] + '.xlsx')
+    os.makedirs(path_results, exist_ok=True)
+    os.makedirs(path_stations, exist_ok=True)
+
+    #Set up cliflo session with username and password
+    cliflo = CF.Cliflo(username=os.environ.get('CLIFLO_USER'),
+                       password=os.environ.get('CLIFLO_PW'),
+                       db_name=args.db_name, # optional if wanting to extract data to a database
+                       db_user_name=os.environ.get('POSTGRES_USER'),
+                       db_user_password=os.environ.get('POSTGRES_PW'),
+                       host=args.db_host,
+                       transport=args.transport,
+                       website=args.website)
+
+    if args.extract:
+        # Works out what stations we want to use from Cliflo
+        cliflo.extract_stations(to_folder=path_stations, # where the data goes
+                                file_name=file_dict[key_val][1], #csv file name of stations
+                                data_type=key_val, # type of data we want the stations for i.e rainfall
+                                start_year=args.start_year, # beginning year we want to make sure is included in the station data
+                                end_year=args.end_year, # as above but the last year.
+                                min_perc_complete=100, # percentage complete of the data in the CLIflo dataset.
+                                station_table_name=file_dict[key_val][3], # only relevant if putting values into SQL
+                                status_table=shared['status'], # changed stations have their empty years checked again
+                                catalogue=shared['catalogue'], # only searches Cliflo once the saved list is older than --catalogue-ttl
+                                refresh_catalogue=args.refresh_stations)
+
+    if args.migrate_tables:
+        cliflo.migrate_table(file_dict[key_val][2], key_val)
+        cliflo.migrate_table(file_dict[key_val][3], key_val, stations=True)
+        if shared['status']: # no status table with --csv-only
+            shared['status'].import_wide(file_dict[key_val][3], key_val) # statuses to the long table
+
+    if args.job_queue:
+        # Every machine offers the same jobs (ones already in the table are skipped) then claims what is left.
+        jobs = CJ.JobQueue(cliflo.engine)
+        cliflo.queue_jobs(jobs,
+                          stations=station_file,
+                          data_type=key_val,
+                          start_year=args.start_year,
+                          end_year=args.end_year,
+                          table_name=file_dict[key_val][2],
+                          use_existing_data=True,
+                          csv_only=args.csv_only,
+                          station_table_name=file_dict[key_val][3],
+                          status_table=shared['status'])
+        cliflo.run_job_queue(jobs,
+                             to_folder=path_results,
+                             data_type=key_val,
+                             freq='daily',
+                             table_name=file_dict[key_val][2],
+                             use_existing_data=True,
+                             csv_only=args.csv_only,
+                             station_table_name=file_dict[key_val][3],
+                             status_table=shared['status'],
+                             parser=args.parser,
+                             metrics=shared['metrics'],
+                             refresh_below=args.refresh_below)
+    elif args.delta:
+        cliflo.delta_sync(stations=station_file,
+                          data_type=key_val,
+                          table_name=file_dict[key_val][2],
+                          station_table_name=file_dict[key_val][3],
+                          first_year=args.start_year, # stations with nothing stored start here
+                          status_table=shared['status'],
+                          parser=args.parser,
+                          metrics=shared['metrics'],
+                          refresh_below=args.refresh_below)
+    else:
+        cliflo.update_data(stations=station_file,
+                           to_folder=path_results,
+                           data_type=key_val,
+                           freq='daily',
+                           update_table=True,
+                           table_name=file_dict[key_val][2],
+                           use_existing_data=True,
+                           csv_only=args.csv_only, # IMPORTANT - MAKE TRUE TO ONLY EXTRACT DATA TO CSV FORMAT AND NOT TO A DATABASE TOO.
+                           start_year=args.start_year,
+                           end_year=args.end_year,
+                           station_table_name=file_dict[key_val][3],
+                           workers=args.workers,
+                           parser=args.parser,
+                           manifest=shared['manifest'], # checkpoint so a failed run picks up where it left off
+                           cache=shared['cache'],
+                           status_table=shared['status'],
+                           metrics=shared['metrics'], # stage timings, rows / min and ETA (see Cliflo_Metrics)
+                           refresh_below=args.refresh_below) # keeps the row allowance topped up (see Cliflo_Quota)
+
+    if args.fill_gaps:
+        cliflo.fill_gaps(data_type=key_val,
+                         table_name=file_dict[key_val][2],
+                         station_table_name=file_dict[key_val][3]) # lat / long comes from here
+
+    return {'data_type': key_val,
+            'jobs': cliflo.job_counts['parsed'],
+            'empty': cliflo.job_counts['empty'],
+            'loaded': cliflo.job_counts['loaded'],
+            'rows': cliflo.job_counts['parsed_rows'],
+            'failed': cliflo.job_counts['failed'],
+            'minutes': round((time.time() - start) / 60, 2),
+            'error': '' if not cliflo.job_counts['worker_errors'] else
+            str(cliflo.job_counts['worker_errors']) + ' workers stopped early'}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if extract_data == 'Cliflo':
+        os.makedirs(args.output_root, exist_ok=True)
+        # engine, status table, manifest and cache shared by every data type, their rows are all keyed by data type
+        db = CF.Cliflo(db_name=args.db_name,
+                       db_user_name=os.environ.get('POSTGRES_USER'),
+                       db_user_password=os.environ.get('POSTGRES_PW'),
+                       host=args.db_host)
+        shared = {'status': False if args.csv_only else CST.StatusTable(db.engine),
+                  'manifest': CM.Manifest(os.path.join(args.output_root, 'cliflo_manifest.sqlite')),
+                  'cache': CC.RawCache(os.path.join(args.output_root, 'raw_cache')) if args.cache else False,
+                  'metrics': args.metrics or os.path.join(args.output_root, 'metrics'),
+                  'catalogue': CCT.StationCatalogue(os.path.join(args.output_root, 'station_catalogue'),
+                                                    ttl_hours=args.catalogue_ttl)}
+
+        def run(key_val):
+            start = time.time()
+            try:
+                return run_data_type(key_val, args, shared)
+            except Exception as e:
+                # one data type failing does not stop the others, it shows up in the summary instead
+                print(key_val + ' failed: ' + repr(e))
+                return {'data_type': key_val, 'minutes': round((time.time() - start) / 60, 2), 'error': repr(e)}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(args.concurrency, len(args.data_types)))) as pool:
+            results = list(pool.map(run, args.data_types))
+
+        counts = ['jobs', 'empty', 'loaded', 'rows', 'failed']
+        summary = pd.DataFrame(results, columns=['data_type'] + counts + ['minutes', 'error'])
+        summary[counts] = summary[counts].astype('Int64')
+        print(summary.to_string(index=False))
+        if shared['status']:
+            shared['status'].flush()
+        shared['manifest'].close()
+        return summary
+
+    # elif extract_data == 'MaMiro':
+    #     mmd = ETL.MaMiroData(db_name='sandpit',
+    #                          db_user_name='postgres',
+    #                          db_user_password='&MaM!r0postgres&')
+    # 
+    #     mmd.update_data(file='C:\\Users\\risid\\Google Drive\\Python\\land-use-models\\data\\mamiro_cost_estimates\\pricing_database.xlsx',
+    #                     table_name='mamirodata2')
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,8 @@
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine
 from sqlalchemy import Table, Column, String, MetaData, select, update
-from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+import Db_Registry as DB
 import geopy.distance
 import datetime
 
@@ -112,12 +111,11 @@ class FarmInputs:
                                                      port,
                                                      self.db_name)
 
-        self.engine = create_engine(self.db_string, pool_size=50, max_overflow=0)
+        # engine shared with every other object using the same database, tables are reflected when first used
+        self.engine = DB.get_engine(self.db_string)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
-        self.Base = declarative_base()
-        # Look up the existing tables from database
-        self.Base.metadata.reflect(self.engine)
+        self.Base = DB.get_base(self.db_string)
 
         #TODO develop formula to estimate yard area based on rotary / herringbone and cow numbers
 
@@ -554,7 +552,7 @@ class Effluent:
         self.remaining_eff_area = self.eff_area - self.eff_area_low_risk - self.min_eff_area_high_risk
 
         # self.effluent_pump
-        self.Deficit = type('deficit_table', (self.Base,), {'__tablename__': 'cliflo_rainfall_station_info_test'})
+        self.Deficit = DB.table_class(self.FI.db_string, 'cliflo_rainfall_station_info_test')
 
     @staticmethod
     def effleunt_catchemnts(**kwargs):
@@ -729,8 +727,8 @@ class Effluent:
         :return:
         """
 
-        Stations = type('station_data', (self.FI.Base,), {'__tablename__': 'cliflo_rainfall_station_info_table_test2'})
-        Deficit = type('deficit_table', (self.FI.Base,), {'__tablename__': 'cliflo_rainfall_daily_test2'})
+        Stations = DB.table_class(self.FI.db_string, 'cliflo_rainfall_station_info_table_test2')
+        Deficit = DB.table_class(self.FI.db_string, 'cliflo_rainfall_daily_test2')
         station_location_list = [({'lat': float(d.lat), 'lon': float(d.long), 'station': int(d.stations)})
                                  for d in self.FI.session.query(Stations).all()]
 
@@ -743,9 +741,10 @@ class Effluent:
         for val in range(0, 10):
             closest_tuple = (min(distance, key=lambda t: t[1]))
             closest_station = closest_tuple[0]
-            query_total = self.FI.session.query(Deficit).filter(Deficit.station == str(closest_station))
-            query_est = self.FI.session.query(Deficit).filter(Deficit.station == str(closest_station),
-                                                                   Deficit.deficit_mm_estimated == '1')
+            # station and the estimated flag are integers in the typed Cliflo tables (Cliflo.obs_table_schema)
+            query_total = self.FI.session.query(Deficit).filter(Deficit.station == int(closest_station))
+            query_est = self.FI.session.query(Deficit).filter(Deficit.station == int(closest_station),
+                                                                   Deficit.deficit_mm_estimated == 1)
             if (query_est.count() / query_total.count()) < 0.05:
                 break
             else:
@@ -754,7 +753,8 @@ class Effluent:
 
         # create database for volumes of effluent generated over 30 years
 
-        station_info = self.session.query(Deficit).filter(Deficit.station == str(closest_station))
+        station_info = self.session.query(Deficit).filter(Deficit.station == int(closest_station)).order_by(
+            Deficit.date)
 
         eff_vol_df = pd.Dataframe(columns=['year', 'month', 'day', 'eff_vol_rainfall', 'eff_vol_cow', 'eff_vol_wash'],
                                   index=np.arrange(0, station_info.count()))
@@ -22,6 +22,8 @@ import re
 import time
 import pandas as pd
 import numpy as np
+from sqlalchemy.orm import sessionmaker
+import Db_Registry as DB
 
 ###########
 # CLASSES #
@@ -49,12 +51,11 @@ class MyData:
                                                      port,
                                                      self.db_name)
 
-        self.engine = create_engine(self.db_string, pool_size=50, max_overflow=0)
+        # engine shared with every other object using the same database, tables are reflected when first used
+        self.engine = DB.get_engine(self.db_string)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
-        self.Base = declarative_base()
-        # Look up the existing tables from database
-        self.Base.metadata.reflect(self.engine)
+        self.Base = DB.get_base(self.db_string)
         self.station_df = pd.DataFrame(columns=['stations'])
 
     def update_data(self, **kwargs):
@@ -0,0 +1,16 @@
+import os
+
+import Cliflo_Benchmarks as CB
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'cliflo')
+
+
+def test_pipeline_benchmark_runs_on_fixtures():
+    results = CB.bench_pipeline(CB.load_fixtures(fixtures), scales=(1, 3), repeat=1, stations=10)
+    steps = {(result['step'], result['scale']): result for result in results}
+
+    for step in ['read_html', 'parse_obs_table', 'station_obs_quick_clean', 'station_obs_preprocess_batch',
+                 'analyse_cf_data']:
+        assert 'error' not in steps[(step, 3)], steps[(step, 3)].get('error')
+        assert steps[(step, 3)]['source'] == 'fixtures'
+    assert steps[('parse_obs_table', 3)]['rows'] == 365 * 3 + 2
@@ -0,0 +1,65 @@
+import gzip
+
+import pandas as pd
+
+import Cliflo_Cache as CC
+
+
+def raw_table(amounts):
+    return pd.DataFrame({'Station': 100001, 'Date(NZST)': ['20000101:0900', '20000102:0900', '20000103:0900'],
+                         'Amount(mm)': amounts})
+
+
+def test_miss_then_hit_after_reopening(tmp_path):
+    cache = CC.RawCache(str(tmp_path))
+    assert cache.get('rainfall', 'daily', 100001, 2000, 2001) is False
+
+    df = raw_table(['1.5', '-', '0.2'])
+    cache.put(df, 'rainfall', 'daily', 100001, 2000, 2001)
+    # the index is read back from disk by a new object
+    reopened = CC.RawCache(str(tmp_path))
+    pd.testing.assert_frame_equal(reopened.get('rainfall', 'daily', 100001, 2000, 2001), df)
+    assert reopened.get('rainfall', 'daily', 100001, 2001, 2002) is False
+    assert reopened.get('sunshine_hours', 'daily', 100001, 2000, 2001) is False
+
+
+def test_files_are_gzipped_and_shared(tmp_path):
+    cache = CC.RawCache(str(tmp_path))
+    df = raw_table(['1.5', '-', '0.2'])
+    entry = cache.put(df, 'rainfall', 'daily', 100001, 2000, 2001)
+    cache.put(df, 'rainfall', 'daily', 100001, 2005, 2006)
+
+    with gzip.open(cache.object_path(entry['sha256']), 'rb') as f:
+        assert f.read() == df.to_csv(index=False).encode('utf-8')
+    summary = cache.summary()
+    assert summary['entries'] == 2 and summary['files'] == 1 and summary['rows'] == 6
+
+
+def test_empty_download_is_a_hit(tmp_path):
+    cache = CC.RawCache(str(tmp_path))
+    cache.put(pd.DataFrame(), 'rainfall', 'daily', 100001, 2000, 2001)
+    cached = CC.RawCache(str(tmp_path)).get('rainfall', 'daily', 100001, 2000, 2001)
+    assert cached is not False and cached.empty
+
+
+def test_last_entry_for_a_key_wins(tmp_path):
+    cache = CC.RawCache(str(tmp_path))
+    cache.put(raw_table(['1.5', '-', '0.2']), 'rainfall', 'daily', 100001, 2000, 2001)
+    cache.put(raw_table(['1.5', '2.0', '0.2']), 'rainfall', 'daily', 100001, 2000, 2001)
+    reopened = CC.RawCache(str(tmp_path))
+    assert reopened.get('rainfall', 'daily', 100001, 2000, 2001)['Amount(mm)'].tolist() == [1.5, 2.0, 0.2]
+    reopened.compact()
+    with open(reopened.index_file, encoding='utf-8') as f:
+        assert len(f.readlines()) == 1
+
+
+def test_checksum_mismatch_is_a_miss(tmp_path):
+    cache = CC.RawCache(str(tmp_path))
+    entry = cache.put(raw_table(['1.5', '-', '0.2']), 'rainfall', 'daily', 100001, 2000, 2001)
+    with gzip.open(cache.object_path(entry['sha256']), 'wb') as f:
+        f.write(raw_table(['9.9', '9.9', '9.9']).to_csv(index=False).encode('utf-8'))
+
+    assert cache.get('rainfall', 'daily', 100001, 2000, 2001) is False
+    # without verify the changed file is read as it is
+    unverified = CC.RawCache(str(tmp_path), verify=False)
+    assert unverified.get('rainfall', 'daily', 100001, 2000, 2001)['Amount(mm)'].tolist() == [9.9, 9.9, 9.9]
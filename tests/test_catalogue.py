@@ -0,0 +1,89 @@
+import json
+
+import pandas as pd
+import pytest
+
+import Cliflo_Catalogue as CCT
+
+
+def station_table(rows):
+    """Raw station table as cf_get_stations returns it: numbered columns, header in the first row."""
+    return pd.DataFrame([['Select', 'AgentNumber', 'Name', 'End Date']] + rows)
+
+
+class Search:
+    """Stand in for cf_get_stations that counts its calls and can fail."""
+
+    def __init__(self, table):
+        self.table = table
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self, data_type):
+        self.calls += 1
+        if self.fail:
+            raise IOError('station search failed')
+        return self.table
+
+
+def age(catalogue, data_type, hours):
+    """Makes the saved list look hours old, as a new StationCatalogue reading index.json would see it."""
+    catalogue.index[data_type]['fetched_at'] -= hours * 3600
+    with open(catalogue.index_file, 'w', encoding='utf-8') as f:
+        json.dump(catalogue.index, f)
+
+
+def test_saved_list_used_until_ttl_expires(tmp_path):
+    search = Search(station_table([['', '1', 'A', '-'], ['', '2', 'B', '-']]))
+    catalogue = CCT.StationCatalogue(str(tmp_path), ttl_hours=24)
+
+    table, changes = catalogue.get('rainfall', search)
+    assert search.calls == 1
+    assert changes == {'added': ['1', '2'], 'removed': [], 'changed': {}}
+
+    # fresh, from a new object reading the folder too
+    age(catalogue, 'rainfall', 23)
+    catalogue = CCT.StationCatalogue(str(tmp_path), ttl_hours=24)
+    saved, changes = catalogue.get('rainfall', search)
+    assert search.calls == 1 and changes is None
+    assert list(saved[1]) == list(table[1]) and list(saved[3]) == list(table[3])
+    assert catalogue.get('rainfall', search, refresh=True)[1] is not None
+    assert search.calls == 2
+
+    age(catalogue, 'rainfall', 25)
+    catalogue = CCT.StationCatalogue(str(tmp_path), ttl_hours=24)
+    assert catalogue.get('rainfall', search)[1] == {'added': [], 'removed': [], 'changed': {}}
+    assert search.calls == 3
+    # other data types have their own list
+    catalogue.get('temperature', search)
+    assert search.calls == 4
+
+
+def test_added_removed_and_changed_stations(tmp_path):
+    catalogue = CCT.StationCatalogue(str(tmp_path), ttl_hours=0)
+    catalogue.get('rainfall', Search(station_table([['', '1', 'A', '-'], ['', '2', 'B', '-'], ['', '3', 'C', '-']])))
+
+    new = station_table([['x', '1', 'A', '-'], ['', '2', 'B', '01-Jan-2019'], ['', '4', 'D', '-']])
+    table, changes = catalogue.get('rainfall', Search(new))
+    assert changes == {'added': ['4'], 'removed': ['3'], 'changed': {'2': {'End Date': ['-', '01-Jan-2019']}}}
+    assert table is new
+
+    recorded = catalogue.changes('rainfall')
+    assert list(zip(recorded['station'], recorded['change'])) == \
+        [('1', 'added'), ('2', 'added'), ('3', 'added'), ('4', 'added'), ('3', 'removed'), ('2', 'changed')]
+    assert recorded['columns'].iloc[-1] == {'End Date': ['-', '01-Jan-2019']}
+    assert catalogue.changes('temperature').empty
+    assert json.load(open(catalogue.index_file))['rainfall']['stations'] == 3
+
+
+def test_failed_search_falls_back_to_saved_list(tmp_path):
+    search = Search(station_table([['', '1', 'A', '-']]))
+    catalogue = CCT.StationCatalogue(str(tmp_path), ttl_hours=0)
+    catalogue.get('rainfall', search)
+
+    search.fail = True
+    table, changes = catalogue.get('rainfall', search)
+    assert changes is None
+    assert list(table[1]) == ['AgentNumber', '1']
+    with pytest.raises(IOError):
+        catalogue.get('temperature', search)
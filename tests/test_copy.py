@@ -0,0 +1,74 @@
+import pandas as pd
+from sqlalchemy import text
+
+import Cliflo
+
+
+def station_year(station, year, amount):
+    """Preprocessed rainfall frame (as df_to_db loads it) for the first three days of a year."""
+    days = ['01', '02', '03']
+    return pd.DataFrame({'rowid': ['rainfall' + str(station) + str(year) + '01' + day for day in days],
+                         'day': days, 'year': str(year), 'month': '01', 'station': str(station),
+                         'amount_mm': [str(amount)] * 3, 'deficit_mm': '0.0',
+                         'amount_mm_estimated': '0', 'deficit_mm_estimated': '0'})
+
+
+def amounts(engine, table_name):
+    with engine.connect() as conn:
+        return {row[0]: row[1] for row in conn.execute(text('SELECT rowid, amount_mm FROM %s' % table_name))}
+
+
+def test_copy_inserts_new_rows(engine, table_name):
+    Cliflo.Cliflo.obs_table_schema(table_name, 'rainfall').create(engine)
+    assert Cliflo.Cliflo.copy_df_to_db(station_year(100001, 2000, 1.5), table_name, engine) == 3
+    assert Cliflo.Cliflo.copy_df_to_db(station_year(100002, 2000, 2.5), table_name, engine) == 3
+    loaded = amounts(engine, table_name)
+    assert len(loaded) == 6
+    assert loaded['rainfall10000120000101'] == 1.5
+    with engine.connect() as conn:
+        assert str(conn.execute(text('SELECT date FROM %s LIMIT 1' % table_name)).scalar()).startswith('2000-01-0')
+
+
+def test_copy_keeps_rows_already_loaded(engine, table_name):
+    Cliflo.Cliflo.obs_table_schema(table_name, 'rainfall').create(engine)
+    Cliflo.Cliflo.copy_df_to_db(station_year(100001, 2000, 1.5), table_name, engine)
+
+    # DO NOTHING: a second load of the same station year adds nothing and changes nothing
+    assert Cliflo.Cliflo.copy_df_to_db(station_year(100001, 2000, 9.0), table_name, engine) == 0
+    assert set(amounts(engine, table_name).values()) == {1.5}
+
+
+def test_copy_update_replaces_rows(engine, table_name):
+    Cliflo.Cliflo.obs_table_schema(table_name, 'rainfall').create(engine)
+    Cliflo.Cliflo.copy_df_to_db(station_year(100001, 2000, 1.5), table_name, engine)
+
+    new = pd.concat([station_year(100001, 2000, 9.0), station_year(100001, 2001, 4.0)], ignore_index=True)
+    assert Cliflo.Cliflo.copy_df_to_db(new, table_name, engine, update=True) == 6
+    loaded = amounts(engine, table_name)
+    assert len(loaded) == 6
+    assert loaded['rainfall10000120000101'] == 9.0
+    assert loaded['rainfall10000120010101'] == 4.0
+
+
+def test_copy_keeps_last_of_duplicate_keys(engine, table_name):
+    Cliflo.Cliflo.obs_table_schema(table_name, 'rainfall').create(engine)
+    df = pd.concat([station_year(100001, 2000, 1.5), station_year(100001, 2000, 3.0)], ignore_index=True)
+    assert Cliflo.Cliflo.copy_df_to_db(df, table_name, engine) == 3
+    assert set(amounts(engine, table_name).values()) == {3.0}
+
+
+def test_failed_copy_leaves_table_unchanged(engine, table_name):
+    Cliflo.Cliflo.obs_table_schema(table_name, 'rainfall').create(engine)
+    Cliflo.Cliflo.copy_df_to_db(station_year(100001, 2000, 1.5), table_name, engine)
+
+    bad = station_year(100001, 2001, 2.0)
+    bad.loc[2, 'amount_mm'] = 'not a number'
+    try:
+        Cliflo.Cliflo.copy_df_to_db(bad, table_name, engine)
+    except Exception:
+        pass
+    else:
+        raise AssertionError('copy_df_to_db loaded a value that is not a number')
+    assert len(amounts(engine, table_name)) == 3
+    # the staging table went with the rolled back transaction, the next load works
+    assert Cliflo.Cliflo.copy_df_to_db(station_year(100001, 2001, 2.0), table_name, engine) == 3
@@ -0,0 +1,32 @@
+import datetime
+
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+
+def server_year(cliflo_server, station, year):
+    """Rows the server has for a station year and the fraction of their amounts that are missing."""
+    rows = cliflo_server.state.obs_rows([station], 'rainfall', datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1))
+    amounts = [row[2] for row in rows[1:]]
+    return len(amounts), amounts.count('-') / len(amounts) if amounts else None
+
+
+def test_delta_sync_adds_new_days_and_keeps_completeness(engine, table_name, cliflo, cliflo_server):
+    stations = [station for station in range(100001, 100030) if server_year(cliflo_server, station, 2010)[0] == 365]
+    stations = pd.DataFrame({'AgentNumber': stations[:2]})
+    kwargs = {'stations': stations, 'data_type': 'rainfall', 'table_name': table_name + '_obs',
+              'status_table': table_name + '_status', 'first_year': 2010}
+
+    first = cliflo.delta_sync(until=datetime.date(2010, 6, 30), **kwargs)
+    assert first == 2 * 181
+    assert cliflo.delta_sync(until=datetime.date(2010, 12, 31), **kwargs) == 2 * 184
+    assert cliflo.delta_sync(until=datetime.date(2010, 12, 31), **kwargs) == 0
+
+    with engine.connect() as conn:
+        completeness = {str(station): value for station, value in conn.execute(text(
+            'SELECT station, completeness FROM %s_status WHERE year = 2010' % table_name))}
+        assert conn.execute(text('SELECT count(*) FROM %s_obs' % table_name)).scalar() == 2 * 365
+    for station in stations['AgentNumber']:
+        # the whole year, not only the second window
+        assert completeness[str(station)] == pytest.approx(1 - server_year(cliflo_server, station, 2010)[1])
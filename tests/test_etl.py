@@ -0,0 +1,42 @@
+import os
+
+import pandas as pd
+import pytest
+
+import ETL
+from conftest import drop_tables
+
+
+def test_fill_gaps_rejected_with_csv_only():
+    with pytest.raises(SystemExit):
+        ETL.parse_args(['rainfall', '--csv-only', '--fill-gaps'])
+    assert ETL.parse_args(['rainfall', '--fill-gaps']).fill_gaps
+
+
+@pytest.mark.parametrize('csv_only', [False, True])
+def test_main_against_the_stand_in_server(engine, cliflo, cliflo_server, monkeypatch, tmp_path, csv_only):
+    # the cliflo fixture registers the test database under this login, host and name
+    monkeypatch.setenv('POSTGRES_USER', 'test')
+    monkeypatch.setenv('POSTGRES_PW', 'test')
+    tables = ETL.file_dict['rainfall'][2:4]
+    [drop_tables(engine, table) for table in tables]
+    os.makedirs(tmp_path / 'station_lists')
+    stations = pd.DataFrame({'AgentNumber': [100001, 100002, 100003]})
+    # what extract_stations leaves behind, --no-extract uses them
+    stations.to_excel(tmp_path / 'station_lists' / (ETL.file_dict['rainfall'][1] + '.xlsx'))
+    cliflo.create_stations_table(stations, 2008, 2010, 'rainfall', tables[1])
+    queries = cliflo_server.state.stats['queries']
+
+    try:
+        summary = ETL.main(['rainfall', '--start-year', '2008', '--end-year', '2010', '--output-root', str(tmp_path),
+                            '--db-name', 'test', '--db-host', 'test', '--transport', 'http', '--parser', 'stream',
+                            '--website', cliflo_server.url, '--no-extract', '--concurrency', '1']
+                           + (['--csv-only'] if csv_only else []))
+    finally:
+        [drop_tables(engine, table) for table in tables]
+
+    row = summary.iloc[0]
+    assert row['error'] == ''
+    assert (row['jobs'], row['failed']) == (6, 0)
+    assert cliflo_server.state.stats['queries'] - queries == 6
+    assert os.path.exists(tmp_path / 'metrics' / 'cliflo_metrics.prom')
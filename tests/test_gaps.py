@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+
+import Cliflo_Gaps as CG
+
+
+def observations(values):
+    """Cleaned rainfall rows from {station: [amount or None for missing, one per day from 1 Jan 2000]}."""
+    rows = []
+    for station, amounts in values.items():
+        for day, amount in enumerate(amounts, 1):
+            rows.append({'station': station, 'year': '2000', 'month': '01', 'day': str(day).zfill(2),
+                         'amount_mm': 0.0 if amount is None else amount,
+                         'amount_mm_estimated': '1' if amount is None else '0'})
+    return pd.DataFrame(rows)
+
+
+# on the equator 0.1 degrees apart, so b is about 11 km from a and c twice that, and d is far away
+stations = pd.DataFrame({'stations': ['a', 'b', 'c', 'd'], 'lat': [0.0, 0.0, 0.0, 0.0],
+                         'long': [0.0, 0.1, 0.2, 5.0]})
+
+
+def test_nearest_stations_in_distance_order():
+    neighbours, distances = CG.nearest_stations(stations['lat'], stations['long'], k=2)
+    assert neighbours[0].tolist() == [1, 2]
+    assert distances[0, 1] == pytest.approx(2 * distances[0, 0])
+    assert distances[0, 0] == pytest.approx(11.12, abs=0.01)
+
+
+def test_fill_gaps_from_neighbours():
+    df = observations({'a': [None, 5.0, None, None], 'b': [10.0, 6.0, None, None],
+                       'c': [20.0, 7.0, 8.0, None], 'd': [99.0, 99.0, 99.0, 99.0]})
+    filled, changed = CG.fill_gaps(df, stations, 'rainfall', k=3, max_km=100, value_cols=['amount_mm'])
+    amounts = filled.set_index(['station', 'day'])['amount_mm']
+
+    # weights 1 / distance ** 2 are 4 : 1 for b : c, d is past max_km
+    assert amounts[('a', '01')] == pytest.approx((4 * 10.0 + 20.0) / 5)
+    # b has no value on day 3 so only c counts, for a and for b
+    assert amounts[('a', '03')] == pytest.approx(8.0)
+    assert amounts[('b', '03')] == pytest.approx(8.0)
+    # no neighbour has a value on day 4, the old value stays
+    assert amounts[('a', '04')] == 0.0
+    assert amounts[('b', '04')] == 0.0
+
+    # observed values and the flags are left alone, estimates are still flagged
+    observed = df['amount_mm_estimated'] == '0'
+    assert filled.loc[observed, 'amount_mm'].tolist() == df.loc[observed, 'amount_mm'].tolist()
+    assert filled['amount_mm_estimated'].tolist() == df['amount_mm_estimated'].tolist()
+    assert changed.tolist() == (~observed & ~df['day'].eq('04')).tolist()
+    assert filled.index.equals(df.index)
@@ -0,0 +1,36 @@
+import datetime
+
+import pandas as pd
+
+import Cliflo
+import Cliflo_HTTP as CH
+
+
+def query(cliflo_server, stations, start_date, end_date):
+    session = CH.CliFloSession(cliflo_server.url, 'test', 'test').login()
+    session.specify_data('rainfall')
+    session.select_stations(stations)
+    session.send_dates(start_date, end_date)
+    return session
+
+
+def test_http_query_round_trip(cliflo_server):
+    stations, start_date, end_date = ['100001', '100002', '100003'], datetime.date(2010, 1, 1), datetime.date(2010, 3, 1)
+    expected = cliflo_server.state.obs_rows(stations, 'rainfall', start_date, end_date)
+    assert len(expected) > 1
+    session = query(cliflo_server, stations, start_date, end_date)
+
+    # the table as pd.read_html gives it: the data type title row, then the header, then the rows as text
+    df = Cliflo.Cliflo.cf_get_data(session, data='station_obs')
+    assert df.iloc[1:].astype(str).values.tolist() == [[str(cell) for cell in row] for row in expected]
+
+    parsed = Cliflo.Cliflo.cf_get_data(session, data='station_obs', data_type='rainfall', parser='stream')
+    assert list(parsed.columns) == expected[0][:4]
+    assert list(parsed['Station'].astype(str)) == [row[0] for row in expected[1:]]
+    assert parsed['Amount(mm)'].equals(pd.to_numeric(pd.Series([row[2] for row in expected[1:]]), errors='coerce'))
+
+
+def test_http_station_search(cliflo):
+    stations = cliflo.cf_get_stations('rainfall')
+    assert list(stations.iloc[0, :3]) == ['Select', 'Name', 'AgentNumber']
+    assert '100001' in set(stations[2].astype(str))
@@ -0,0 +1,100 @@
+import pandas as pd
+from sqlalchemy import text
+
+import Cliflo_Jobs as CJ
+
+
+def statuses(engine, table_name):
+    with engine.connect() as conn:
+        return {(row[0], row[1], row[2]): (row[3], row[4]) for row in conn.execute(text(
+            'SELECT data_type, station, year, status, worker FROM %s' % table_name))}
+
+
+def test_queues_in_one_process_have_their_own_worker_id(engine, table_name):
+    first = CJ.JobQueue(engine, table_name=table_name)
+    second = CJ.JobQueue(engine, table_name=table_name)
+    assert first.worker_id != second.worker_id
+
+
+def test_queues_in_one_process_keep_their_own_leases(engine, table_name):
+    rainfall = CJ.JobQueue(engine, table_name=table_name)
+    sunshine = CJ.JobQueue(engine, table_name=table_name)
+    rainfall.add_jobs('rainfall', [1, 2], [2000])
+    sunshine.add_jobs('sunshine_hours', [1], [2000])
+
+    assert rainfall.claim('rainfall', 10) == [('1', 2000), ('2', 2000)]
+    assert sunshine.claim('sunshine_hours', 10) == [('1', 2000)]
+
+    # the sunshine runner finishing must not hand back rainfall's jobs
+    assert sunshine.release() == 1
+    assert sunshine.heartbeat() == 0
+    assert rainfall.heartbeat() == 2
+    other_host = CJ.JobQueue(engine, table_name=table_name)
+    assert other_host.claim('rainfall', 10) == []
+
+    rainfall.complete('rainfall', 1, 2000)
+    rainfall.complete('rainfall', 2, 2000)
+    jobs = statuses(engine, table_name)
+    assert jobs[('rainfall', '1', 2000)][0] == 'done'
+    assert jobs[('rainfall', '2', 2000)][0] == 'done'
+    assert jobs[('sunshine_hours', '1', 2000)] == ('pending', None)
+
+
+def test_claims_do_not_overlap(engine, table_name):
+    first = CJ.JobQueue(engine, table_name=table_name)
+    second = CJ.JobQueue(engine, table_name=table_name)
+    first.add_jobs('rainfall', [1, 2, 3], [2000, 2001])
+
+    claimed = first.claim('rainfall', 4) + second.claim('rainfall', 4)
+    assert len(claimed) == 6
+    assert len(set(claimed)) == 6
+    assert second.claim('rainfall', 4) == []
+
+
+def test_expired_lease_can_be_claimed_by_another_worker(engine, table_name):
+    first = CJ.JobQueue(engine, table_name=table_name, lease_seconds=0)
+    second = CJ.JobQueue(engine, table_name=table_name)
+    first.add_jobs('rainfall', [1], [2000])
+
+    assert first.claim('rainfall') == [('1', 2000)]
+    assert second.claim('rainfall') == [('1', 2000)]
+    # the first worker lost its lease so finishing late changes nothing
+    first.complete('rainfall', 1, 2000)
+    assert statuses(engine, table_name)[('rainfall', '1', 2000)] == ('leased', second.worker_id)
+
+
+def test_fail_gives_up_after_max_attempts(engine, table_name):
+    worker = CJ.JobQueue(engine, table_name=table_name, max_attempts=2)
+    worker.add_jobs('rainfall', [1], [2000])
+
+    worker.claim('rainfall')
+    worker.fail('rainfall', 1, 2000)
+    assert statuses(engine, table_name)[('rainfall', '1', 2000)] == ('pending', None)
+    worker.claim('rainfall')
+    worker.fail('rainfall', 1, 2000)
+    assert statuses(engine, table_name)[('rainfall', '1', 2000)] == ('failed', None)
+    assert worker.claim('rainfall') == []
+    assert worker.progress('rainfall') == {'failed': 1}
+
+
+def test_queue_jobs_then_run_job_queue(engine, table_name, cliflo, cliflo_server, tmp_path):
+    stations = pd.DataFrame({'AgentNumber': [100001, 100002, 100003]})
+    cliflo.create_stations_table(stations, 2008, 2011, 'rainfall', table_name + '_stations')
+    kwargs = {'data_type': 'rainfall', 'table_name': table_name + '_obs', 'station_table_name': table_name + '_stations',
+              'status_table': table_name + '_status'}
+    job_queue = CJ.JobQueue(engine, table_name=table_name + '_jobs')
+
+    assert cliflo.queue_jobs(job_queue, stations=stations, start_year=2008, end_year=2011, **kwargs) == 9
+    assert cliflo.run_job_queue(job_queue, to_folder=str(tmp_path), parser='stream', **kwargs) == 9
+    assert cliflo_server.state.stats['queries'] == 9
+    jobs = statuses(engine, table_name + '_jobs')
+    assert len(jobs) == 9
+    assert set(status for status, worker in jobs.values()) == {'done'}
+    with engine.connect() as conn:
+        loaded = conn.execute(text('SELECT count(DISTINCT (station, year)) FROM %s_obs' % table_name)).scalar()
+        recorded = conn.execute(text('SELECT count(*) FROM %s_status' % table_name)).scalar()
+    assert loaded > 0 and recorded == 9
+
+    # every station year is loaded or known to be empty, so a second host has nothing to queue or download
+    assert cliflo.queue_jobs(CJ.JobQueue(engine, table_name=table_name + '_jobs2'), stations=stations,
+                             start_year=2008, end_year=2011, **kwargs) == 0
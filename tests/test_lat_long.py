@@ -0,0 +1,48 @@
+import pandas as pd
+from sqlalchemy import event, text
+
+COORDS = pd.DataFrame({'AgentNumber': [100001, 100002, 100003, 100001],
+                       'lat': ['-41.5', '-36.9', None, '0'], 'long': [174.2, 'x', 170.5, 0]})
+
+
+def update_statements(engine, cliflo, table):
+    """Runs update_lat_long on table, returning the UPDATE statements it sent."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('UPDATE'):
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        cliflo.update_lat_long(COORDS, table)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return statements
+
+
+def coordinates(engine, table):
+    with engine.connect() as conn:
+        return {str(station): (None if lat is None else float(lat), None if long is None else float(long))
+                for station, lat, long in conn.execute(text('SELECT stations, lat, long FROM %s' % table))}
+
+
+def test_update_lat_long_typed_table(engine, table_name, cliflo):
+    stations = pd.DataFrame({'AgentNumber': [100001, 100002, 100003, 100004]})
+    cliflo.create_stations_table(stations, 2008, 2009, 'rainfall', table_name)
+
+    assert len(update_statements(engine, cliflo, table_name)) == 1
+    # the first row of a repeated station is used, values that are not numbers are left empty
+    assert coordinates(engine, table_name) == {'100001': (-41.5, 174.2), '100002': (-36.9, None),
+                                               '100003': (None, 170.5), '100004': (None, None)}
+
+
+def test_update_lat_long_text_table(engine, table_name, cliflo):
+    # stations tables made before the typed schema hold everything as text
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE %s (stations text, lat text, long text)' % table_name))
+        conn.execute(text("INSERT INTO %s (stations) VALUES ('100001'), ('100002'), ('100003')" % table_name))
+
+    assert len(update_statements(engine, cliflo, table_name)) == 1
+    assert coordinates(engine, table_name) == {'100001': (-41.5, 174.2), '100002': (-36.9, None),
+                                               '100003': (None, 170.5)}
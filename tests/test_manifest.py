@@ -0,0 +1,55 @@
+import pandas as pd
+import pytest
+
+import Cliflo_Manifest as CM
+
+
+def test_plan_and_remaining(tmp_path):
+    manifest = CM.Manifest(str(tmp_path / 'manifest.sqlite'))
+    manifest.plan('rainfall', 100001, 2008, 2011, [2008, 2009, 2010])
+    manifest.set_state('rainfall', 100001, 2008, 'loaded', 365)
+    manifest.set_state('rainfall', 100001, 2009, 'parsed', 365)
+
+    assert manifest.planned_stations('rainfall', 2008, 2011) == {'100001'}
+    assert manifest.planned_stations('rainfall', 2008, 2012) == set()
+    assert dict(manifest.remaining('rainfall')) == {'100001': [2009, 2010]}
+    assert dict(manifest.remaining('rainfall', ('parsed', 'loaded', 'empty'))) == {'100001': [2010]}
+    # planning again keeps the states jobs have reached
+    manifest.plan('rainfall', 100001, 2008, 2011, [2008, 2009, 2010])
+    assert manifest.progress('rainfall') == {'loaded': 1, 'parsed': 1, 'pending': 1}
+    with pytest.raises(ValueError):
+        manifest.set_state('rainfall', 100001, 2010, 'done')
+
+
+def test_interrupted_run_resumes_where_it_stopped(engine, table_name, new_cliflo, cliflo_server, tmp_path):
+    stations = pd.DataFrame({'AgentNumber': [100001, 100002, 100003]})
+    first = new_cliflo()
+    first.create_stations_table(stations, 2008, 2010, 'rainfall', table_name + '_stations')
+    kwargs = {'stations': stations, 'to_folder': str(tmp_path), 'sink': 'csv', 'start_year': 2008, 'end_year': 2010,
+              'table_name': table_name + '_obs', 'station_table_name': table_name + '_stations',
+              'status_table': False, 'manifest': str(tmp_path / 'manifest.sqlite')}
+
+    # the server starts failing after the third query, which stops the run
+    obs_rows = cliflo_server.state.obs_rows
+    queried = []
+
+    def failing_after_three(stations, *args):
+        queried.append(stations)
+        if len(queried) == 3:
+            cliflo_server.state.failure_rate = 1
+        return obs_rows(stations, *args)
+
+    cliflo_server.state.obs_rows = failing_after_three
+    with pytest.raises(Exception):
+        first.update_data(**kwargs)
+    assert len(queried) == 3
+    assert first.job_counts['parsed'] == 3
+
+    cliflo_server.state.failure_rate = 0
+    second = new_cliflo()
+    second.update_data(**kwargs)
+    # only the three jobs left are planned, downloaded and parsed
+    assert len(queried) == 6
+    assert second.job_counts['parsed'] == 3
+    assert sorted(queried) == sorted([[str(station)] for station in stations['AgentNumber'] for year in [2008, 2009]])
+    assert CM.Manifest(kwargs['manifest']).remaining('rainfall', ('parsed', 'loaded', 'empty')) == {}
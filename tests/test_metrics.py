@@ -0,0 +1,95 @@
+import json
+import re
+
+import pytest
+
+import Cliflo_Metrics as CMT
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake time.time for Cliflo_Metrics, moved on by setting clock.now."""
+
+    class Clock:
+        now = 1000000.0
+
+    monkeypatch.setattr(CMT.time, 'time', lambda: Clock.now)
+    return Clock
+
+
+def test_rates_and_eta(clock):
+    metrics = CMT.Metrics(window_seconds=300)
+    metrics.add_planned(10)
+    for minute in range(4):
+        clock.now += 30
+        metrics.record_job('rainfall', 1, 2000 + minute, 100)
+
+    clock.now = 1000000.0 + 120
+    # 4 jobs and 400 rows over the 2 minutes since starting, 6 jobs left at 2 a minute
+    assert metrics.rates() == {'rows_per_min': 200.0, 'jobs_per_min': 2.0, 'eta_s': 180, 'remaining_jobs': 6}
+
+    # only the jobs inside the window count once it has filled
+    clock.now = 1000000.0 + 400
+    assert metrics.rates() == {'rows_per_min': 20.0, 'jobs_per_min': 0.2, 'eta_s': 1800, 'remaining_jobs': 6}
+    clock.now += 300
+    assert metrics.rates() == {'rows_per_min': 0.0, 'jobs_per_min': 0.0, 'eta_s': None, 'remaining_jobs': 6}
+
+
+def test_timed_counts_calls_errors_and_time(monkeypatch):
+    metrics = CMT.Metrics()
+    monkeypatch.setattr(CMT, 'metrics', metrics)
+
+    @CMT.timed('cf_get_data')
+    def stage(fail=False):
+        if fail:
+            raise ValueError('failed')
+        return 'page'
+
+    assert stage() == 'page' and stage() == 'page'
+    with pytest.raises(ValueError):
+        stage(fail=True)
+    summary = metrics.summary()
+    assert summary.to_dict('records')[0]['stage'] == 'cf_get_data'
+    assert (summary.at[0, 'count'], summary.at[0, 'errors']) == (3, 1)
+    assert 0 <= summary.at[0, 'max_s'] <= summary.at[0, 'total_s']
+    assert stage.__name__ == 'stage'
+
+
+def test_exports_jsonl_and_prometheus_text(clock, tmp_path):
+    metrics = CMT.Metrics(folder=str(tmp_path), export_seconds=0)
+    metrics.add_planned(3)
+    metrics.record_stage('cf_login', 0.5)
+    metrics.record_stage('cf_get_data', 2.0, ok=False)
+    metrics.record_stage('bench_step', 1.0)
+    clock.now += 60
+    metrics.record_job('rainfall', 1234, 2010, 365)
+    metrics.export(wait_log={'results_page': [1.0, 2.5]})
+
+    entries = [json.loads(line) for line in open(tmp_path / 'cliflo_metrics.jsonl')]
+    assert [entry['type'] for entry in entries] == ['stage', 'stage', 'stage', 'job']
+    assert entries[1] == dict(entries[1], stage='cf_get_data', seconds=2.0, ok=False)
+    assert entries[3] == dict(entries[3], station='1234', year=2010, rows=365, remaining_jobs=2, eta_s=120)
+
+    lines = open(tmp_path / 'cliflo_metrics.prom').read().splitlines()
+    sample = re.compile(r'^[a-z_]+(\{[a-z]+="[a-z_]+"\})? (-?[0-9.]+|NaN)$')
+    samples = {}
+    for line in lines:
+        if line.startswith('#'):
+            assert re.match(r'^# (HELP [a-z_]+ .+|TYPE [a-z_]+ (counter|gauge))$', line), line
+        else:
+            assert sample.match(line), line
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    # every metric is typed before its samples
+    types = [line.split()[2] for line in lines if line.startswith('# TYPE')]
+    assert all(re.sub(r'\{.*', '', name) in types for name in samples)
+
+    assert samples['cliflo_stage_seconds_total{stage="cf_get_data"}'] == 2.0
+    assert samples['cliflo_stage_errors_total{stage="cf_get_data"}'] == 1
+    # stages that have not run are still exported, and others are added after them
+    assert samples['cliflo_stage_calls_total{stage="df_to_db"}'] == 0
+    assert samples['cliflo_stage_calls_total{stage="bench_step"}'] == 1
+    assert samples['cliflo_wait_seconds_total{step="results_page"}'] == 3.5
+    assert (samples['cliflo_jobs_total'], samples['cliflo_rows_total'], samples['cliflo_jobs_remaining']) == (1, 365, 2)
+    assert samples['cliflo_eta_seconds'] == 120
+    assert not list(tmp_path.glob('*.tmp'))
@@ -0,0 +1,37 @@
+import datetime
+
+import pandas as pd
+from sqlalchemy import inspect, text
+
+
+def column_types(engine, table):
+    return {col['name']: type(col['type']).__name__ for col in inspect(engine).get_columns(table)}
+
+
+def test_migrate_table_converts_text_columns(engine, table_name, cliflo):
+    pd.DataFrame({'rowid': ['1_2010_1_1', '1_2010_1_2'], 'day': ['1', '2'], 'year': ['2010', '2010'],
+                  'month': ['1', '1'], 'station': ['1', '1'], 'amount_mm': ['0.4', '-'],
+                  'amount_mm_estimated': ['0', '1']}).to_sql(table_name, engine, index=False)
+
+    converted = cliflo.migrate_table(table_name, 'rainfall')
+    assert set(converted) == {'day', 'year', 'month', 'station', 'amount_mm', 'amount_mm_estimated'}
+    assert column_types(engine, table_name)['amount_mm'] == 'DOUBLE_PRECISION'
+    with engine.connect() as conn:
+        assert list(conn.execute(text('SELECT amount_mm, date FROM %s ORDER BY day' % table_name))) == \
+            [(0.4, datetime.date(2010, 1, 1)), (None, datetime.date(2010, 1, 2))]
+    # safe to run again
+    assert cliflo.migrate_table(table_name, 'rainfall') == []
+
+
+def test_migrate_table_ignores_tables_in_other_schemas(engine, table_name, cliflo):
+    cliflo.create_typed_table(cliflo.obs_table_schema(table_name, 'rainfall'))
+    with engine.begin() as conn:
+        # an old all text copy of the table under the same name in another schema
+        conn.execute(text('CREATE SCHEMA IF NOT EXISTS %s_old' % table_name))
+        conn.execute(text('CREATE TABLE %s_old.%s (rowid text, day text, year text, month text, station text, '
+                          'amount_mm text, amount_mm_estimated text)' % (table_name, table_name)))
+    try:
+        assert cliflo.migrate_table(table_name, 'rainfall') == []
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text('DROP SCHEMA %s_old CASCADE' % table_name))
@@ -0,0 +1,76 @@
+import datetime
+import io
+import os
+
+import pandas as pd
+import pytest
+
+import Cliflo
+import Cliflo_Benchmarks as CB
+import Cliflo_Parser as CP
+import Cliflo_Server as SV
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'cliflo')
+
+
+def server_page(stations, start, end, data_type='rainfall', **kwargs):
+    """Results table the way Cliflo_Server sends it, observation table third."""
+    rows = SV.CliFloState(**kwargs).obs_rows(stations, data_type, start, end)
+    table = ('<table><tr><td colspan="' + str(len(rows[0])) + '">' + data_type + ': Daily</td></tr>' +
+             ''.join('<tr><td>' + '</td><td>'.join(row) + '</td></tr>' for row in rows) + '</table>')
+    return SV.CliFloHandler.results_page(table)
+
+
+def read_html_path(page):
+    return Cliflo.Cliflo.station_obs_quick_clean(pd.read_html(io.StringIO(page))[2])
+
+
+@pytest.mark.parametrize('stations, start, end', [
+    (['100001'], datetime.date(2000, 1, 1), datetime.date(2001, 1, 1)),
+    (['100001', '100002', '100003'], datetime.date(1999, 6, 1), datetime.date(2001, 1, 1)),
+])
+def test_stream_parser_matches_read_html(stations, start, end):
+    page = server_page(stations, start, end, empty_rate=0, missing_rate=0.2)
+    streamed = CP.parse_obs_table(page, 'rainfall')
+    expected = read_html_path(page)
+
+    assert list(streamed.columns) == CP.known_columns('rainfall')
+    assert len(streamed) == len(expected)
+    assert list(streamed['Station']) == list(expected['Station'].astype(str))
+    assert list(streamed['Date(NZST)']) == list(expected['Date(NZST)'].astype(str))
+    amounts = pd.to_numeric(expected['Amount(mm)'], errors='coerce').reset_index(drop=True)
+    pd.testing.assert_series_equal(streamed['Amount(mm)'], amounts, check_names=False)
+
+
+@pytest.mark.parametrize('page', CB.load_fixtures(fixtures))
+def test_stream_parser_matches_read_html_on_fixtures(page):
+    streamed = CP.parse_obs_table(page, 'rainfall')
+    expected = Cliflo.Cliflo.station_obs_quick_clean(CB.obs_frame(page))
+
+    assert len(streamed) == len(expected) > 0
+    assert list(streamed['Date(NZST)']) == list(expected['Date(NZST)'].astype(str))
+    for col in ['Amount(mm)', 'Deficit(mm)']:
+        values = pd.to_numeric(expected[col], errors='coerce').reset_index(drop=True)
+        pd.testing.assert_series_equal(streamed[col], values, check_names=False)
+
+
+def test_stream_parser_reads_chunks():
+    page = server_page(['100001'], datetime.date(2000, 1, 1), datetime.date(2000, 3, 1), empty_rate=0)
+    chunks = [page[n:n + 100] for n in range(0, len(page), 100)]
+    pd.testing.assert_frame_equal(CP.parse_obs_table(iter(chunks), 'rainfall'), CP.parse_obs_table(page, 'rainfall'))
+
+
+def test_table_with_no_rows_is_empty():
+    page = server_page(['100001'], datetime.date(2000, 1, 1), datetime.date(2001, 1, 1), empty_rate=1)
+    assert CP.parse_obs_table(page, 'rainfall').empty
+
+
+def test_no_rows_message_is_empty():
+    page = SV.CliFloHandler.results_page('<p>No rows found for the selected stations</p>')
+    assert CP.parse_obs_table(page, 'rainfall').empty
+
+
+def test_page_without_results_table_is_an_error():
+    page = SV.CliFloHandler.results_page('<p>Invalid date</p>')
+    with pytest.raises(CP.ResultsPageError):
+        CP.parse_obs_table(page, 'rainfall')
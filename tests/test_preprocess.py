@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Cliflo
+import Cliflo_Benchmarks as CB
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'cliflo')
+
+
+def per_call_preprocess(df, data_type):
+    """
+    station_obs_preprocess as it was before the batch version, ported to current pandas (date_range for the
+    DatetimeIndex constructor, split with n=, and the median taken of the values as numbers).
+    """
+    vals = Cliflo.Cliflo.station_clean_dict[data_type][1]
+    df['year'] = df['Date(NZST)'].str[:4]
+    df['month'] = df['Date(NZST)'].str[4:6]
+    df['day'] = df['Date(NZST)'].str[6:8]
+    for val in vals:
+        df[val + '_estimated'] = str(0)
+
+    period = pd.Period('2018', freq='Y')
+    x = pd.Series(pd.date_range(start=period.start_time, end=period.end_time, freq='D')).to_frame('date')
+    x[['year', 'month', 'day']] = x['date'].astype(str).str.split('-', n=2, expand=True)
+    z = x.merge(df, how='right')
+    z = z.rename(columns=Cliflo.Cliflo.station_clean_dict[data_type][0])
+    z = z.drop(columns='date').fillna('-')
+    for val in vals:
+        z.loc[z[val] == '-', val + '_estimated'] = str(1)
+    for val in vals:
+        z[val] = z[val].replace({'-': np.nan})
+        z[val] = z[val].fillna(pd.to_numeric(z[val]).median())
+    z['rowid'] = data_type + z[['station', 'year', 'month', 'day']].apply(lambda p: ''.join(p), axis=1)
+    cols = ['rowid', 'day', 'year', 'month', 'station'] + vals + [val + '_estimated' for val in vals]
+    return z[cols]
+
+
+def quick_cleaned(page):
+    df = Cliflo.Cliflo.station_obs_quick_clean(CB.obs_frame(page))
+    return df.astype({col: str for col in df.columns if col != 'index'})
+
+
+@pytest.mark.parametrize('pages', [CB.load_fixtures(fixtures)[:1], CB.load_fixtures(fixtures)])
+def test_batch_preprocess_matches_per_call(pages):
+    frames = [quick_cleaned(page) for page in pages]
+    # every fixture has missing values, so the median fill and the flags are checked
+    assert all((df['Amount(mm)'] == '-').any() for df in frames)
+
+    batch = Cliflo.Cliflo.station_obs_preprocess_batch([df.copy() for df in frames], 'rainfall')
+    for df, batch_df in zip(frames, batch):
+        expected = per_call_preprocess(df.copy(), 'rainfall')
+        pd.testing.assert_frame_equal(batch_df, expected, check_dtype=True)
+        assert (batch_df['amount_mm_estimated'] == '1').sum() == (df['Amount(mm)'] == '-').sum()
@@ -0,0 +1,35 @@
+import pandas as pd
+
+import Cliflo_Metrics as CMT
+import Cliflo_Quota as CQ
+
+
+def station_jobs(stations, years):
+    """Jobs as Cliflo.batch_jobs makes them with one station and one year per job."""
+    return [([station], [year], {station: years}) for station in stations for year in years]
+
+
+def test_prioritise_keeps_each_stations_jobs_together():
+    jobs = station_jobs(['a', 'b', 'c'], [2008, 2009, 2010])
+    # b has a hole in its record, a reports the data type, c has only come back empty
+    loaded = {'a': {2000}, 'b': {2000, 2012}}
+    empty = {'c': {2000}}
+
+    order = [(station_ids[0], years[0]) for station_ids, years, year_lists in CQ.prioritise(jobs, loaded, empty)]
+    assert order == [('b', 2010), ('b', 2009), ('b', 2008), ('a', 2010), ('a', 2009), ('a', 2008),
+                     ('c', 2010), ('c', 2009), ('c', 2008)]
+
+
+def test_prioritise_leaves_a_fresh_backfill_in_station_order():
+    jobs = station_jobs(['a', 'b', 'c'], [2008, 2009, 2010])
+    order = [station_ids[0] for station_ids, years, year_lists in CQ.prioritise(jobs, {}, {})]
+    assert order == ['a'] * 3 + ['b'] * 3 + ['c'] * 3
+
+
+def test_backfill_selects_each_station_once(engine, table_name, cliflo, tmp_path):
+    stations = pd.DataFrame({'AgentNumber': [100001, 100002, 100003]})
+    selections = CMT.metrics.stage_calls['cf_get_station_data']
+    cliflo.update_data(stations=stations, to_folder=str(tmp_path), sink='csv', start_year=2008, end_year=2011,
+                       table_name=table_name + '_obs', status_table=table_name + '_status', prioritise=True)
+    assert cliflo.job_counts['parsed'] == 9
+    assert CMT.metrics.stage_calls['cf_get_station_data'] - selections == 3
@@ -0,0 +1,31 @@
+import datetime
+
+import Cliflo_Server as SV
+
+
+def empty_years(state, stations, years):
+    empty = set()
+    for station in stations:
+        for year in years:
+            # a year is empty or not as a whole, so its first day shows which
+            if len(state.obs_rows([station], 'rainfall', datetime.date(year, 1, 1), datetime.date(year, 1, 2))) == 1:
+                empty.add((station, year))
+    return empty
+
+
+def test_empty_years_spread_over_stations_and_years():
+    state = SV.CliFloState(empty_rate=0.2)
+    stations, years = [str(station) for station in range(100000, 100100)], range(1990, 2010)
+    empty = empty_years(state, stations, years)
+
+    assert 0.15 < len(empty) / (len(stations) * len(years)) < 0.25
+    # neighbouring stations share empty years no more than chance would (about empty_rate of them)
+    same = sum((stations[n], year) in empty and (stations[n + 1], year) in empty
+               for n in range(len(stations) - 1) for year in years)
+    assert same < 0.3 * len(empty)
+    assert len(set(year for station, year in empty)) == len(years)
+    # the same every time, and a year is empty however the query window is cut
+    assert empty_years(SV.CliFloState(empty_rate=0.2), stations[:10], years) == \
+        set((station, year) for station, year in empty if station in stations[:10])
+    station, year = sorted(empty)[0]
+    assert len(state.obs_rows([station], 'rainfall', datetime.date(year, 6, 1), datetime.date(year + 1, 1, 1))) == 1
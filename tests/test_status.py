@@ -0,0 +1,19 @@
+import pandas as pd
+
+import Cliflo
+import Cliflo_Status as CST
+
+
+def test_completeness_counts_estimated_values():
+    df = pd.DataFrame({'rowid': ['a', 'b', 'c', 'd'], 'amount': ['1.0', '2.0', '1.5', '3.0'],
+                       'amount_estimated': ['0', '1', '0', '0']})
+    assert CST.StatusTable.to_status(Cliflo.Cliflo.analyse_cf_data(df, 'rainfall', 'amount')) == ('loaded', 0.75)
+
+
+def test_completeness_counts_missing_values_without_flags():
+    df = pd.DataFrame({'rowid': ['a', 'b'], 'amount': [1.0, None]})
+    assert CST.StatusTable.to_status(Cliflo.Cliflo.analyse_cf_data(df, 'rainfall', 'amount')) == ('loaded', 0.5)
+
+
+def test_empty_station_year():
+    assert CST.StatusTable.to_status(Cliflo.Cliflo.analyse_cf_data(pd.DataFrame(), 'rainfall', 'amount'))[0] == 'empty'
@@ -0,0 +1,82 @@
+import datetime
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+import Cliflo_Store as CS
+
+
+def observations(station, year, days=3, value=1.0):
+    return pd.DataFrame({'station': station, 'year': year, 'month': 1, 'day': range(1, days + 1),
+                         'rainfall': [value + day for day in range(days)], 'rainfall_estimated': 0})
+
+
+def test_write_read_round_trip(tmp_path):
+    store = CS.ParquetStore(str(tmp_path))
+    df = pd.concat([observations(1, 2008), observations(1, 2009), observations(2, 2009)], ignore_index=True)
+    assert store.write(df, 'rainfall') == 9
+    assert store.years('rainfall', 1) == {2008, 2009}
+    assert store.years('rainfall', 3) == set()
+
+    read = store.read('rainfall').sort_values(['station', 'year', 'day']).reset_index(drop=True)
+    expected = CS.ParquetStore.to_types(df)
+    assert list(read['station']) == list(expected['station'])
+    assert list(read['year']) == list(expected['year'].astype(int))
+    for col in ['month', 'day', 'rainfall', 'rainfall_estimated']:
+        assert list(read[col]) == list(expected[col])
+    assert str(read['rainfall_estimated'].dtype) == 'Int8'
+
+    columns = store.read('rainfall', columns=['rainfall'])
+    assert sorted(columns.columns) == ['rainfall', 'station', 'year']
+
+
+def test_read_only_opens_the_partitions_asked_for(tmp_path):
+    store = CS.ParquetStore(str(tmp_path))
+    store.write(pd.concat([observations(station, year) for station in [1, 2] for year in [2008, 2009, 2010]]),
+                'rainfall')
+    # any partition outside the reads that is opened fails them
+    for station, year in [(1, 2008), (1, 2010), (2, 2008), (2, 2010)]:
+        with open(os.path.join(store.partition_path('rainfall', station, year), 'part-0.parquet'), 'wb') as f:
+            f.write(b'not parquet')
+
+    read = store.read('rainfall', stations=[1], start_year=2009, end_year=2009)
+    assert list(zip(read['station'], read['year'])) == [('1', 2009)] * 3
+    read = store.read('rainfall', start_year=2009, end_year=2009)
+    assert sorted(set(zip(read['station'], read['year']))) == [('1', 2009), ('2', 2009)]
+    assert len(read) == 6
+    with pytest.raises(Exception):
+        store.read('rainfall', stations=[1])
+
+
+def test_rewriting_a_year_replaces_it(tmp_path):
+    store = CS.ParquetStore(str(tmp_path))
+    store.write(pd.concat([observations(1, 2008), observations(1, 2009)]), 'rainfall')
+    # a rerun of 2009, with a corrected value, and fewer days
+    store.write(observations(1, 2009, days=2, value=5.0), 'rainfall')
+
+    read = store.read('rainfall').sort_values(['year', 'day']).reset_index(drop=True)
+    assert len(read) == 5
+    assert list(read.loc[read['year'] == 2009, 'rainfall']) == [5.0, 6.0]
+    assert os.listdir(store.partition_path('rainfall', 1, 2009)) == ['part-0.parquet']
+
+
+def test_update_data_rerun_does_not_duplicate(engine, table_name, cliflo, cliflo_server, tmp_path):
+    stations = pd.DataFrame({'AgentNumber': [100001, 100002, 100003]})
+    cliflo.create_stations_table(stations, 2008, 2011, 'rainfall', table_name + '_stations')
+    folder = str(tmp_path / 'parquet')
+    kwargs = {'stations': stations, 'to_folder': str(tmp_path), 'sink': 'parquet', 'parquet_folder': folder,
+              'start_year': 2008, 'end_year': 2011, 'station_table_name': table_name + '_stations',
+              'status_table': False, 'use_existing_data': False}
+    server_rows = len(cliflo_server.state.obs_rows(stations['AgentNumber'], 'rainfall', datetime.date(2008, 1, 1),
+                                                   datetime.date(2011, 1, 1))) - 1
+    assert server_rows > 0
+
+    cliflo.update_data(**kwargs)
+    assert len(CS.ParquetStore(folder).read('rainfall')) == server_rows
+    cliflo.update_data(**kwargs)
+    read = CS.ParquetStore(folder).read('rainfall')
+    assert len(read) == server_rows
+    assert not read.duplicated(['station', 'year', 'month', 'day']).any()
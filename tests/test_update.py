@@ -0,0 +1,25 @@
+import os
+
+import pandas as pd
+from sqlalchemy import text
+
+
+def test_update_data_with_only_a_status_table(engine, table_name, cliflo, cliflo_server, tmp_path):
+    stations = pd.DataFrame({'AgentNumber': [100001, 100002]})
+    kwargs = {'stations': stations, 'to_folder': str(tmp_path), 'sink': 'csv', 'start_year': 2008, 'end_year': 2011,
+              'table_name': table_name + '_obs', 'status_table': table_name + '_status', 'parser': 'stream',
+              # never created, the status table takes its place
+              'station_table_name': table_name + '_stations'}
+
+    cliflo.update_data(**kwargs)
+    assert cliflo.job_counts['parsed'] == 6
+    with engine.connect() as conn:
+        statuses = {row[0]: row[1] for row in conn.execute(text(
+            'SELECT status, count(*) FROM %s_status GROUP BY status' % table_name))}
+    assert sum(statuses.values()) == 6
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.csv')]) == statuses.get('loaded', 0)
+
+    # nothing left to download the second time
+    queries = cliflo_server.state.stats['queries']
+    cliflo.update_data(**kwargs)
+    assert cliflo_server.state.stats['queries'] == queries